@@ -13,8 +13,9 @@ setup(
         description='Python script to simulate the display from "The Matrix" in terminal',
         long_description=readme,
         version='0.1.0',
-        py_modules=['unimatrix'],
+        py_modules=['unimatrix', 'unimatrix_bench'],
         entry_points={
-            'console_scripts': ['unimatrix=unimatrix:main'],
+            'console_scripts': ['unimatrix=unimatrix:main',
+                                'unimatrix-bench=unimatrix_bench:main'],
         }
 )
\ No newline at end of file
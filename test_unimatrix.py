@@ -0,0 +1,671 @@
+"""
+Round-trip checks for the parts of unimatrix that are easy to get subtly
+wrong. Run with: python -m unittest test_unimatrix
+"""
+
+import os
+import random
+import unittest
+
+import unimatrix
+
+
+def run_engine(argv, rows, cols, frames, each=None, engine_class=None,
+               resize=None):
+    """
+    Runs a seeded engine into a FrameBuffer, calling each(buffer) after
+    every step, and returns the buffer. The engine is the one make_engine()
+    picks, unless an engine_class is given. If resize is given as (step,
+    rows, cols), the buffer and the engine are resized before that step.
+    """
+    unimatrix.configure(argv + ['--seed', '3'])
+    buffer = unimatrix.FrameBuffer(rows, cols)
+    writer = unimatrix.Writer(buffer)
+    writer.clear(rows, cols)
+    if engine_class is None:
+        engine = unimatrix.make_engine(writer, rows, cols)
+    else:
+        engine = engine_class(writer, rows, cols)
+    for step in range(frames):
+        if resize is not None and step == resize[0]:
+            buffer.resize(*resize[1:])
+            engine.resize(*resize[1:])
+        engine.step()
+        if each is not None:
+            each(buffer)
+    return buffer
+
+
+class FrameBufferTest(unittest.TestCase):
+
+    def check_runs(self, argv, rows=24, cols=61, resize=None):
+        """
+        Applies the runs of every frame to a blank screen, with each
+        character in its own cell, and checks it ends up equal to the grid.
+        A resize, as for run_engine(), starts over on a blank screen.
+        """
+        screen = []
+
+        def apply(buffer):
+            if len(screen) != buffer.rows * buffer.cols:
+                screen[:] = [(' ', 0)] * (buffer.rows * buffer.cols)
+            for y, x, text, attr in buffer.runs():
+                for offset, character in enumerate(text):
+                    screen[y * buffer.cols + x + offset] = (character, attr)
+            self.assertEqual(screen, list(zip(buffer.chars, buffer.attrs)))
+
+        run_engine(argv, rows, cols, 200, apply, resize=resize)
+
+    def test_runs_rebuild_grid(self):
+        for argv in ([], ['-a', '-f'], ['-f', '--gradient'], ['-w']):
+            with self.subTest(argv=argv):
+                self.check_runs(argv)
+
+    def test_numpy_runs_rebuild_grid(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs NumPy')
+        for argv in (['-a', '-f'], ['-f', '--gradient', '--flash-budget', '5'],
+                     ['-w']):
+            for resize in ((100, 30, 40), (100, 12, 80)):
+                with self.subTest(argv=argv, resize=resize):
+                    self.check_runs(['--numpy'] + argv, resize=resize)
+
+    def test_runs_rebuild_grid_after_resize(self):
+        buffer = run_engine(['-f'], 24, 61, 50)
+        buffer.runs()
+        buffer.resize(30, 40)
+        screen = [(' ', 0)] * (30 * 40)
+        for y, x, text, attr in buffer.runs():
+            for offset, character in enumerate(text):
+                screen[y * 40 + x + offset] = (character, attr)
+        self.assertEqual(screen, list(zip(buffer.chars, buffer.attrs)))
+
+    def test_overlays_are_clipped_to_the_screen(self):
+        buffer = run_engine([], 5, 10, 5)
+        near = buffer.overlay(0, 4)
+        beyond = buffer.overlay(0, 12)
+        buffer.show(near, 'status text')
+        buffer.show(beyond, 'stats')
+        runs = buffer.runs()
+        self.assertEqual(runs[-1], (0, 4, 'status', unimatrix.STATUS))
+        self.assertEqual(buffer.redrawn, [near])
+        for y, x, text, attr in runs + buffer.full_runs():
+            self.assertLessEqual(x + len(text), 10)
+
+    def test_limited_runs_catch_up(self):
+        rows, cols = 24, 61
+        screen = [(' ', 0)] * (rows * cols)
+
+        def apply(runs):
+            for y, x, text, attr in runs:
+                for offset, character in enumerate(text):
+                    screen[y * cols + x + offset] = (character, attr)
+
+        def limited(buffer):
+            runs = buffer.runs(400)
+            self.assertLessEqual(buffer.flushed_bytes, 400)
+            apply(runs)
+
+        buffer = run_engine(['-f', '--gradient'], rows, cols, 200, limited)
+        self.assertTrue(buffer.dirty or buffer.low_dirty)
+        apply(buffer.runs())
+        self.assertEqual(screen, list(zip(buffer.chars, buffer.attrs)))
+
+    def test_low_byte_rate_still_sends(self):
+        budget = unimatrix.ByteBudget(10)
+        buffer = run_engine([], 5, 10, 5)
+        buffer.runs(budget.available())
+        self.assertGreater(buffer.flushed_cells, 0)
+
+    def test_wide_characters_end_runs(self):
+        # A terminal moves two columns past a wide character, so anything
+        # after one in the same run would be drawn a column too far right
+        for argv in (['-u', '漢字'], ['-l', 'e']):
+            with self.subTest(argv=argv):
+                def check(buffer):
+                    for y, x, text, attr in buffer.runs():
+                        for character in text[:-1]:
+                            self.assertFalse(unimatrix.is_wide(character),
+                                             (y, x, text))
+
+                run_engine(argv, 24, 61, 200, check)
+                self.check_runs(argv)
+
+
+class CountdownCanvas(unimatrix.Canvas):
+    """
+    Spawns the way Canvas did before its timing wheel: every column counts
+    its own timer down on every step
+    """
+
+    def spawn(self):
+        for col in self.columns:
+            if col.timer == 0:
+                col.spawn_node(self)
+            col.timer -= 1
+
+
+class CountdownEngine(unimatrix.Engine):
+
+    def reflow(self, rows, cols):
+        if self.canvas is None:
+            self.canvas = CountdownCanvas(rows, cols, self.pool)
+        else:
+            self.canvas.resize(rows, cols)
+
+
+class WalkEngine(unimatrix.Engine):
+    """
+    Steps the rain the way Engine did before it kept the async speeds of
+    its nodes apart: every node is visited, and async ones check the clock
+    themselves. No --gradient, and with -a no -f: async writers now roll
+    for a flasher once per move instead of once per step.
+    """
+
+    def step(self):
+        args = unimatrix.args
+        canvas = self.canvas
+        canvas.spawn()
+        nodes = []
+        for node in canvas.nodes:
+            if node.n_type == 'writer':
+                if args.flashers and next(unimatrix.rng.floats) < 0.1:
+                    canvas.flashers.add(node.y_coord, node.x_coord)
+            else:
+                canvas.flashers.discard(node.y_coord, node.x_coord)
+            if not args.asynchronous or (
+                    self.async_clock % node.async_speed == 0):
+                self.writer.draw(node)
+                node.y_coord += 1
+            if node.y_coord >= canvas.row_count:
+                if node.white:
+                    node.white = False
+                    node.y_coord -= 1
+                else:
+                    node.expired = True
+                    self.pool.release(node)
+                    continue
+            nodes.append(node)
+        canvas.nodes[:] = nodes
+        canvas.speeds = bytearray(node.async_speed for node in nodes)
+        if args.flashers:
+            canvas.flashers.redraw(self.writer.draw_flasher,
+                                   args.flash_budget)
+        self.async_clock = self.async_clock - 1 if self.async_clock else 5
+        return True
+
+
+class EngineTest(unittest.TestCase):
+
+    def test_timing_wheel_spawns_as_before(self):
+        for argv in ([], ['-w'], ['-a']):
+            with self.subTest(argv=argv):
+                counted = run_engine(argv, 24, 61, 300,
+                                     engine_class=CountdownEngine)
+                wheeled = run_engine(argv, 24, 61, 300,
+                                     engine_class=unimatrix.Engine)
+                self.assertEqual(wheeled.text(), counted.text())
+                self.assertEqual(bytes(wheeled.attrs), bytes(counted.attrs))
+
+    def test_async_nodes_step_as_before(self):
+        for argv in (['-a'], ['-a', '-w'], ['-f']):
+            with self.subTest(argv=argv):
+                walked = run_engine(argv, 24, 61, 300,
+                                    engine_class=WalkEngine)
+                stepped = run_engine(argv, 24, 61, 300,
+                                     engine_class=unimatrix.Engine)
+                self.assertEqual(stepped.text(), walked.text())
+                self.assertEqual(bytes(stepped.attrs), bytes(walked.attrs))
+
+
+class QualityGovernorTest(unittest.TestCase):
+
+    class Engine:
+        quality = unimatrix.FULL_QUALITY
+
+        def set_quality(self, quality):
+            self.quality = quality
+
+    def feed(self, governor, seconds, frames):
+        """
+        Gives the governor frames that each took the given seconds, at 60
+        frames a second, and returns (frame, new level) for each change
+        """
+        changes = []
+        for frame in range(1, frames + 1):
+            if governor.frame(seconds, 1 / 60):
+                changes.append((frame, governor.engine.quality))
+        return changes
+
+    def test_levels_change_with_hysteresis(self):
+        governor = unimatrix.QualityGovernor(self.Engine(), 0.01)
+        # The average first goes over the target on the 4th frame; each
+        # level then takes 15 frames over it, down to the lowest
+        self.assertEqual(self.feed(governor, 0.02, 100),
+                         [(18, 2), (33, 1), (48, 0)])
+        # Between half the target and the target, nothing changes
+        self.assertEqual(self.feed(governor, 0.007, 1000), [])
+        # Under half from the 2nd frame on; 120 of those for each level
+        self.assertEqual(self.feed(governor, 0.001, 1000),
+                         [(121, 1), (241, 2), (361, 3)])
+
+    def test_default_target_is_most_of_the_frame(self):
+        unimatrix.configure([])
+        governor = unimatrix.make_governor(self.Engine())
+        self.assertIsNone(governor.target)
+        # 80% of 1/60 s is 13.3 ms, which the average passes on the 3rd
+        # frame of 15 ms
+        self.assertEqual(self.feed(governor, 0.012, 200), [])
+        self.assertEqual(self.feed(governor, 0.015, 200)[:1], [(17, 2)])
+
+    def test_frame_target(self):
+        unimatrix.configure(['--frame-target', '20'])
+        self.assertEqual(unimatrix.make_governor(self.Engine()).target, 0.02)
+        unimatrix.configure(['--frame-target', '0'])
+        self.assertIsNone(unimatrix.make_governor(self.Engine()))
+
+
+class FlasherIndexTest(unittest.TestCase):
+
+    def test_budget_reaches_every_flasher(self):
+        unimatrix.configure(['-f', '--flash-density', '1'])
+        flashers = unimatrix.FlasherIndex(5, 7)
+        cells = {(y, x) for y in range(5) for x in range(7) if (x + y) % 3}
+        for y, x in cells:
+            flashers.add(y, x)
+        drawn = []
+        for _ in range(len(cells) // 2 + 1):
+            step = []
+            flashers.redraw(lambda y, x: step.append((y, x)), 2)
+            self.assertLessEqual(len(step), 2)
+            drawn += step
+        self.assertEqual(set(drawn), cells)
+
+
+@unittest.skipUnless(hasattr(unimatrix.os, 'fork'), 'needs fork')
+class ShardedEngineTest(unittest.TestCase):
+
+    def test_resize_keeps_the_rain(self):
+        unimatrix.configure(['-f', '--workers', '3', '--seed', '3'])
+        buffer = unimatrix.FrameBuffer(24, 61)
+        writer = unimatrix.Writer(buffer)
+        writer.clear(24, 61)
+        engine = unimatrix.make_engine(writer, 24, 61)
+        self.addCleanup(lambda: engine.close())
+
+        def nodes():
+            found = []
+            for shard in engine.shards:
+                canvas = shard.state()[0]
+                self.assertEqual([col.x_coord for col in canvas.columns],
+                                 list(range(0, shard.cols, 2)))
+                found += [(node.y_coord, shard.x + node.x_coord)
+                          for node in canvas.nodes]
+            return sorted(found)
+
+        for rows, cols in ((20, 45), (30, 81), (24, 61)):
+            for _ in range(40):
+                engine.step()
+            kept = [(y, x) for y, x in nodes() if y < rows and x < cols]
+            screen = [row[:cols].ljust(cols)
+                      for row in buffer.text().split('\n')[:rows]]
+            screen += [' ' * cols] * (rows - len(screen))
+            buffer.resize(rows, cols)
+            engine.resize(rows, cols)
+            self.assertEqual(nodes(), kept)
+            self.assertEqual(buffer.text().split('\n'), screen)
+
+
+def draw_ansi(data, rows, cols, styles=None):
+    """
+    Plays ANSI output on a plain model of a terminal that knows cursor moves
+    and character widths, and returns its rows of characters. If given
+    rows of styles, sets each cell drawn in them to the parameters of the
+    last SGR code.
+    """
+    screen = [[' '] * cols for _ in range(rows)]
+    text = data.decode()
+    y = x = i = 0
+    style = None
+    while i < len(text):
+        if text[i] == '\x1b':
+            end = i + 2
+            while not text[end].isalpha():
+                end += 1
+            params, command = text[i + 2:end], text[end]
+            if command == 'H':
+                row, col = params.split(';')
+                y, x = int(row) - 1, int(col) - 1
+            elif command == 'C':
+                x += int(params)
+            elif command == 'm':
+                style = params
+            i = end + 1
+            continue
+        if x < cols:
+            screen[y][x] = text[i]
+            if styles is not None:
+                styles[y][x] = style
+        x += 2 if unimatrix.is_wide(text[i]) else 1
+        i += 1
+    return [''.join(row) for row in screen]
+
+
+class AnsiEncoderTest(unittest.TestCase):
+
+    def test_each_character_in_its_own_cell(self):
+        for argv in ([], ['-u', '漢字'], ['-l', 'e']):
+            with self.subTest(argv=argv):
+                buffer = run_engine(argv, 12, 41, 60)
+                encoder = unimatrix.AnsiEncoder(depth=8)
+                out = bytearray()
+                encoder.write_runs(out, buffer.full_runs(), 12, 41)
+                self.assertEqual(draw_ansi(out, 12, 41),
+                                 buffer.text().split('\n'))
+
+
+class AnsiScreenTest(unittest.TestCase):
+
+    def setUp(self):
+        import fcntl
+        import struct
+        import termios
+        # A pseudo-terminal stands in for the real one
+        self.master, slave = os.openpty()
+        self.addCleanup(os.close, self.master)
+        self.addCleanup(os.close, slave)
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('4H', 24, 80, 0, 0))
+        unimatrix.configure([])
+        self.screen = unimatrix.AnsiScreen(slave, slave)
+        self.addCleanup(self.screen.close)
+        del self.screen.out[:]
+
+    def test_flush_rebuilds_grid(self):
+        for argv in ([], ['-u', '漢字'], ['-l', 'e']):
+            with self.subTest(argv=argv):
+                buffer = run_engine(argv, 12, 41, 60)
+                self.screen.clear()
+                del self.screen.out[:]
+                self.screen.flush(buffer)
+                self.assertEqual(draw_ansi(self.screen.out, 12, 41),
+                                 buffer.text().split('\n'))
+                del self.screen.out[:]
+
+    def test_color_change_resends_attributes(self):
+        # The next run with the same attribute must still be sent with
+        # the new colors
+        buffer = unimatrix.FrameBuffer(2, 4)
+        self.screen.flush(buffer)
+        del self.screen.out[:]
+        buffer.put(0, 0, 'ab', unimatrix.RAIN)
+        self.screen.flush(buffer)
+        self.assertEqual(self.screen.out, b'\x1b[1;1H\x1b[0;32;49mab')
+        del self.screen.out[:]
+        self.screen.init_pair(1, 4, -1)
+        self.screen.flush(buffer)
+        out = self.screen.out
+        self.assertTrue(out.startswith(b'\x1b[1;1H\x1b[0;34;49mab'), out)
+
+    def test_write_all_waits_for_a_slow_reader(self):
+        import threading
+        import time
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+        data = bytes(range(256)) * 4096
+        received = bytearray()
+
+        def read():
+            while len(received) < len(data):
+                time.sleep(0.001)
+                received.extend(os.read(read_fd, 65536))
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        unimatrix.write_all(write_fd, data)
+        reader.join()
+        os.close(read_fd)
+        os.close(write_fd)
+        self.assertEqual(received, data)
+
+
+class FrameSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        from unittest import mock
+        self.now = 0.0
+        self.slept = []
+        for name, fake in (('monotonic', lambda: self.now),
+                           ('sleep', self.sleep)):
+            patch = mock.patch.object(unimatrix.time, name, fake)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def wait(self, seconds):
+        # A hair longer, so that a step due right then counts despite
+        # rounding
+        self.now += seconds + 1e-9
+
+    def test_first_frame_steps_at_once(self):
+        scheduler = unimatrix.FrameScheduler(60)
+        self.assertEqual(scheduler.due(40), 1)
+        self.assertEqual(scheduler.due(40), 0)
+
+    def test_steps_keep_to_their_deadlines(self):
+        scheduler = unimatrix.FrameScheduler(60)
+        scheduler.due(40)
+        # 100 ms in, two 40 ms steps are due; the third is due 40 ms after
+        # the second was, not 40 ms after this frame
+        self.wait(0.1)
+        self.assertEqual(scheduler.due(40), 2)
+        scheduler.wait(40)
+        self.assertAlmostEqual(self.slept[-1], 0.02)
+        self.wait(0)
+        self.assertEqual(scheduler.due(40), 1)
+
+    def test_max_fps_caps_frames(self):
+        scheduler = unimatrix.FrameScheduler(10)
+        scheduler.due(10)
+        scheduler.wait(10)
+        self.assertAlmostEqual(self.slept[-1], 0.1)
+        # Steps come ten times as fast as frames, so each frame runs ten
+        self.wait(0)
+        self.assertEqual(scheduler.due(10), 10)
+
+    def test_backlog_is_dropped(self):
+        scheduler = unimatrix.FrameScheduler(60)
+        scheduler.due(10)
+        # A second behind: only 250 ms of steps are run, and the rain
+        # carries on from now, with the next frame a 60th of a second away
+        self.wait(1)
+        self.assertEqual(scheduler.due(10), 25)
+        self.assertEqual(scheduler.dropped, 75)
+        scheduler.wait(10)
+        self.assertAlmostEqual(self.slept[-1], 1 / 60)
+
+
+class RecordingTest(unittest.TestCase):
+
+    def test_varints_round_trip(self):
+        numbers = [0, 1, 127, 128, 300, 2 ** 14 - 1, 2 ** 14, 2 ** 35 + 5]
+        data = bytearray()
+        for number in numbers:
+            unimatrix.write_varint(data, number)
+        pos = 0
+        for number in numbers:
+            read, pos = unimatrix.read_varint(data, pos)
+            self.assertEqual(read, number)
+        self.assertEqual(pos, len(data))
+
+    def test_frames_round_trip(self):
+        import tempfile
+        for argv in (['-f', '--gradient'], ['-u', '漢字']):
+            with self.subTest(argv=argv), \
+                    tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'rain.umx')
+                recorder = unimatrix.Recorder(path, 12, 41)
+                colors = (4, -1)
+                frames = 0
+                # Attributes of the screen as the colors change
+                changed = []
+
+                def record(buffer):
+                    nonlocal colors, frames
+                    buffer.runs()
+                    frames += 1
+                    if frames == 29:
+                        # End on the cell the next frame starts with, so
+                        # its attribute is the current one when the colors
+                        # change
+                        buffer.last_runs.append(buffer.full_runs()[0])
+                    if frames == 30:
+                        colors = (1, -1)
+                        changed.extend(buffer.attrs)
+                    recorder.frame(buffer, *colors)
+
+                buffer = run_engine(argv, 12, 41, 60, record)
+                recorder.close()
+                recording = unimatrix.load_recording(path, 12, 41)
+                self.assertEqual(len(recording), 60)
+                # A color change records the whole frame, so every cell was
+                # drawn again, each with the new escape code for its
+                # attribute
+                styles = [[None] * 41 for _ in range(12)]
+                draw_ansi(b''.join(data for _, data in recording[:30]),
+                          12, 41, styles)
+                sgr = unimatrix.AnsiEncoder(1, -1).sgr
+                self.assertEqual(
+                    [style for row in styles for style in row],
+                    [sgr[attr][2:-1].decode() for attr in changed])
+                self.assertEqual(
+                    draw_ansi(b''.join(data for _, data in recording),
+                              12, 41),
+                    buffer.text().split('\n'))
+
+
+class ArrayEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs NumPy')
+
+    def test_steps_through_a_resize(self):
+        for argv in ([], ['-a', '-f'], ['-w']):
+            with self.subTest(argv=argv):
+                unimatrix.configure(['--numpy'] + argv)
+                grid = unimatrix.Grid(24, 61)
+                writer = unimatrix.Writer(grid)
+                engine = unimatrix.make_engine(writer, 24, 61)
+                self.assertIsInstance(engine, unimatrix.ArrayEngine)
+                for rows, cols in ((24, 61), (12, 80), (30, 41)):
+                    writer.target = grid = unimatrix.Grid(rows, cols)
+                    engine.resize(rows, cols)
+                    for _ in range(100):
+                        engine.step()
+                    self.check_grid(engine, grid)
+
+    def check_grid(self, engine, grid):
+        """
+        Checks that every node is on the grid, and that the rain left
+        glyphs of the character set, only in the even columns it falls in.
+        A single wave may have gone by already.
+        """
+        self.assertEqual(len({len(getattr(engine, name))
+                              for name in engine.node_fields}), 1)
+        self.assertTrue((engine.y < grid.rows).all())
+        self.assertTrue((engine.x < grid.cols).all())
+        glyphs = set(unimatrix.chars + ' ')
+        for i, character in enumerate(grid.chars):
+            self.assertIn(character, glyphs)
+            if i % grid.cols % 2:
+                self.assertEqual(character, ' ')
+        if not unimatrix.args.single_wave:
+            self.assertNotEqual(grid.text().strip(), '')
+
+
+class PairAllocatorTest(unittest.TestCase):
+
+    def test_least_recently_used_pair_is_reused(self):
+        from unittest import mock
+        with mock.patch.object(unimatrix.curses, 'init_pair') as init_pair:
+            pairs = unimatrix.PairAllocator(4)
+            self.assertEqual([pairs.pair(fg, -1) for fg in (1, 2, 3)],
+                             [1, 2, 3])
+            self.assertEqual(pairs.pair(1, -1), 1)
+            self.assertEqual(init_pair.call_count, 3)
+            # Every pair is taken, and (2, -1) was used longest ago
+            self.assertEqual(pairs.pair(4, -1), 2)
+            init_pair.assert_called_with(2, 4, -1)
+            self.assertEqual(pairs.pair(2, -1), 3)
+            init_pair.assert_called_with(3, 2, -1)
+            self.assertEqual(pairs.pair(4, -1), 2)
+            self.assertEqual(init_pair.call_count, 5)
+
+    def test_pair_numbers_fit_in_an_attribute(self):
+        self.assertEqual(unimatrix.PairAllocator(32767).limit, 255)
+
+
+def lzw_decode(data, min_size):
+    """
+    Decompresses GIF image data, the way a GIF reader does. Returns the
+    data and the position of the end code's last byte, plus one.
+    """
+    clear = 1 << min_size
+    pos = bits = bit_count = 0
+    size = min_size + 1
+    table = []
+    prev = None
+    out = bytearray()
+    while True:
+        while bit_count < size:
+            bits |= data[pos] << bit_count
+            pos += 1
+            bit_count += 8
+        code = bits & ((1 << size) - 1)
+        bits >>= size
+        bit_count -= size
+        if code == clear:
+            table = [bytes((i,)) for i in range(clear)] + [b'', b'']
+            size = min_size + 1
+            prev = None
+            continue
+        if code == clear + 1:
+            return out, pos
+        if prev is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else prev + prev[:1]
+            table.append(prev + entry[:1])
+            if len(table) == 1 << size and size < 12:
+                size += 1
+        out += entry
+        prev = entry
+
+
+class GifTest(unittest.TestCase):
+
+    def test_lzw_round_trip(self):
+        # Long inputs fill the 4096-entry table, so the encoder has to
+        # clear it and start over
+        rng = random.Random(1)
+        for min_size in (2, 3, 8):
+            for length in (1, 2, 10, 1000, 50000):
+                for values in (1, 2, 1 << min_size):
+                    with self.subTest(min_size=min_size, length=length,
+                                      values=values):
+                        data = bytes(rng.randrange(values)
+                                     for _ in range(length))
+                        encoded = unimatrix.lzw_encode(data, min_size)
+                        self.assertEqual(lzw_decode(encoded, min_size),
+                                         (data, len(encoded)))
+
+
+if __name__ == '__main__':
+    unittest.main()
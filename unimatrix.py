@@ -24,10 +24,13 @@
 # Created by William Mannard
 # 2018/01/19
 
-import argparse
 import curses
+import os
+import signal
+import sys
 import time
-from random import choice, randint
+from itertools import chain, compress
+from random import Random
 
 help_msg = r'''
 USAGE
@@ -70,7 +73,8 @@ OPTIONAL ARGUMENTS
 
   -w                   Single-wave mode: Does a single burst of green rain,
                        exits. You can put in a .bashrc file to run when your
-                       terminal launches. Works well with speed at 95.
+                       terminal launches. Works well with speed at 95, and
+                       with --fast-start.
 
 LONG ARGUMENTS
   -a --asynchronous
@@ -88,6 +92,126 @@ LONG ARGUMENTS
   -u --custom-characters=CUSTOM_CHARACTERS
   -w --single-wave
 
+PERFORMANCE OPTIONS
+  --seed SEED          Seed the random generator with an integer. The same
+                       seed and options give the same rain every time.
+
+  --max-fps FPS        Most frames drawn per second. At high speeds, several
+                       steps of the rain are drawn in one frame. Default=60
+
+  --flash-budget N     Redraw at most N flashers per step of the rain (with
+                       --workers, per worker). Flasher redraws are spread
+                       evenly over steps. Default=0 (no limit)
+
+  --flash-density D    Most flashers allowed at once, as a fraction of the
+                       screen (0 to 1). Default=0.1
+
+  --gradient           Fade the rain behind each head, from a bright shade of
+                       the rain color down to a dark one. Needs a terminal
+                       with 256 colors; with --ansi, truecolor is used when
+                       COLORTERM says the terminal has it. Not drawn by
+                       --export.
+
+  --frame-target MS    When drawing a frame takes longer than MS milliseconds,
+                       lower the quality step by step (no white heads, fewer
+                       flashers, fewer columns) and restore it when frames
+                       are fast again. The level shows in the status area.
+                       Default=80% of the time between frames. 0 turns this
+                       off.
+
+  --idle-fps FPS       Frames per second while nobody can see the rain: the
+                       terminal has lost focus, or the tmux pane isn't on
+                       screen. One step of the rain is drawn per frame, and
+                       the rain carries on from where it was when it is seen
+                       again. 0 pauses it. Default=2
+
+  --ignore-focus       Don't ask the terminal to report focus changes. Also
+                       the case with -i.
+
+  --pipeline           Write frames to the terminal from a thread of its own,
+                       so the next frame is worked out while the last one is
+                       still being sent. Helps over slow links: when the
+                       terminal falls behind, frames are merged instead of
+                       holding up the rain. Overlap and throughput are
+                       printed on exit. Works best with --ansi, as curses
+                       holds up the whole program while it writes.
+
+  --max-bps N          Send at most about N bytes a second to the terminal,
+                       for slow links (a 9600 baud line takes about 960).
+                       Heads and erasers go first; flasher redraws, the green
+                       characters left behind white heads and --gradient
+                       shading wait for later frames. The status message
+                       and --stats count too; --stats is only updated twice
+                       a second. Default=0 (no limit)
+
+  --stats              Show frame timing, node and flasher counts and the
+                       bytes sent per frame (estimated, with curses) at the
+                       top of the screen.
+
+  --stats-file FILE    Write the time spent in each phase of every frame,
+                       with node, flasher and output counts and the cells
+                       held back by --max-bps, to FILE as JSON lines.
+
+  --record FILE        Record the output to FILE. Files ending in .cast are
+                       written in asciicast v2 format, anything else in a
+                       compact binary format.
+
+  --replay FILE        Play back a recording straight to the terminal,
+                       without running the simulation. Uses almost no CPU.
+
+  --replay-speed X     Play back X times faster (or slower, if below 1).
+                       Default=1
+
+  --loop               With --replay, play the recording over and over.
+
+  --fast-start         Start faster, for use in .bashrc: the options of this
+                       exact command line are parsed once and kept in
+                       ~/.cache/unimatrix, so later runs skip loading the
+                       argument parser.
+
+  --serve ADDRESS      Run one simulation and stream it to any number of
+                       --connect clients, each with its own terminal size.
+                       ADDRESS is [HOST:]PORT for TCP, or the path of a Unix
+                       socket. Slow clients skip frames rather than hold up
+                       the others.
+
+  --connect ADDRESS    Show the rain from a --serve server. Uses no more CPU
+                       than it takes to draw it.
+
+  --export FILE        Render the rain without a terminal, far faster than
+                       real time, to an animated GIF (FILE ending in .gif) or
+                       to numbered PNG or PPM images (rain.png gives
+                       rain00000.png, rain00001.png, ...). Uses Pillow to
+                       draw the characters if it is installed; otherwise
+                       draws stand-in block patterns.
+
+  --export-frames N    Number of frames to export. Default=300
+
+  --export-size COLSxROWS
+                       Size of the exported screen, in characters.
+                       Default=80x24
+
+  --export-font FILE   TrueType font to export with. Use one that has the
+                       characters of your character set (e.g. a CJK font for
+                       katakana). Default: Pillow's own font.
+
+  --export-font-size PX
+                       Character height in pixels. Characters are half as
+                       wide. Default=16
+
+  --ansi               Bypass curses and write raw ANSI escape codes, one
+                       write per frame. Lighter on kiosks and serial
+                       consoles. Needs a terminal that understands ANSI
+                       (VT100) codes.
+
+  --numpy              Keep nodes in NumPy arrays and step them in batches.
+                       Much faster on very large screens. Falls back to the
+                       normal engine if NumPy is not installed.
+
+  --workers N          Step the rain in N worker processes, each with its own
+                       slice of the screen, for screens thousands of
+                       characters wide. Not worth it on ordinary terminals.
+
 CHARACTER SETS
   When using '-l' or '--character-list=' option, follow it with one or more of
   the following letters:
@@ -143,287 +267,3857 @@ KEYBOARD CONTROL
   ! to (               set background color (same colors as above, but pressing
                            shift + number)
 
-EXAMPLES
-  Mimic default output of cmatrix (no unicode characters, works in TTY):
-    $ unimatrix -n -s 96 -l o
+EXAMPLES
+  Mimic default output of cmatrix (no unicode characters, works in TTY):
+    $ unimatrix -n -s 96 -l o
+
+  Use the letters from the name of your favorite operating system in bold blue:
+    $ unimatrix -b -u Linux -c blue
+
+  Use default character set, plus dollar symbol (note single quotes around
+      special character):
+    $ unimatrix -l knnssssu -u '$'
+
+  No bold characters, slowly, using emojis, numbers and a few symbols:
+    $ unimatrix -n -l ens -s 50
+
+  Render a 10 second animated GIF with flashers, without a terminal:
+    $ unimatrix -f -s 90 --export rain.gif --export-frames 100
+'''
+
+
+### Set up parser and apply arguments settings
+
+
+def make_parser():
+    """
+    Builds the command line parser. Only needed when the options haven't
+    been cached by --fast-start, so argparse is imported here.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(add_help=False)
+
+    parser.add_argument('-a', '--asynchronous',
+                        action='store_true',
+                        help='use asynchronous scrolling')
+    parser.add_argument('-b', '--all-bold',
+                        action='store_true',
+                        help='use all bold characters')
+    parser.add_argument('-c', '--color',
+                        default='green',
+                        help='one of: green (default), red, blue, white, '
+                             'yellow, cyan, magenta, black',
+                        type=str)
+    parser.add_argument('-f', '--flashers',
+                        action='store_true',
+                        help='some characters will continuously change in '
+                             'place')
+    parser.add_argument('-g', '--bg-color',
+                        default='default',
+                        help='background color (see -c)',
+                        type=str)
+    parser.add_argument('-h', '--help',
+                        help='display extended usage information and exit.',
+                        action='store_true')
+    parser.add_argument('-i', '--ignore-keyboard',
+                        help='ignore all keyboard input.',
+                        action='store_true')
+    parser.add_argument('-l', '--character-list',
+                        help='character set. See details below',
+                        type=str)
+    parser.add_argument('-n', '--no-bold',
+                        action='store_true',
+                        help='do not use bold characters')
+    parser.add_argument('-o', '--status-off',
+                        action='store_true',
+                        help='Disable on-screen status')
+    parser.add_argument('-s', '--speed',
+                        help='speed, integer up to 100. Default=85',
+                        default=85,
+                        type=int)
+    parser.add_argument('-t', '--time',
+                        help='time. See details below',
+                        type=int)
+    parser.add_argument('-u', '--custom-characters',
+                        help='your own string of characters to display',
+                        default='',
+                        type=str)
+    parser.add_argument('-w', '--single-wave',
+                        help='runs a single "wave" of green rain then exits',
+                        action='store_true')
+    parser.add_argument('--seed',
+                        help='seed for the random generator, for repeatable '
+                             'output',
+                        type=int)
+    parser.add_argument('--max-fps',
+                        help='most frames to draw per second. Default=60',
+                        default=60,
+                        type=float)
+    parser.add_argument('--flash-budget',
+                        help='most flashers to redraw per step of the rain. '
+                             'Default=0 (no limit)',
+                        default=0,
+                        type=int)
+    parser.add_argument('--flash-density',
+                        help='most flashers allowed, as a fraction of the '
+                             'screen. Default=0.1',
+                        default=0.1,
+                        type=float)
+    parser.add_argument('--frame-target',
+                        help='lower the quality when frames take longer than '
+                             'MS milliseconds. Default=80%% of the time '
+                             'between frames, 0=off',
+                        type=float)
+    parser.add_argument('--gradient',
+                        help='fade the rain behind each head from a bright '
+                             'to a dark shade, with 256 colors or more',
+                        action='store_true')
+    parser.add_argument('--idle-fps',
+                        help='frames per second while the terminal is '
+                             'unfocused or hidden. Default=2, 0=pause',
+                        default=2,
+                        type=float)
+    parser.add_argument('--ignore-focus',
+                        help="don't ask the terminal to report focus changes",
+                        action='store_true')
+    parser.add_argument('--pipeline',
+                        help='send frames to the terminal from a separate '
+                             'thread',
+                        action='store_true')
+    parser.add_argument('--max-bps',
+                        help='most bytes to send to the terminal per second. '
+                             'Default=0 (no limit)',
+                        default=0,
+                        type=int)
+    parser.add_argument('--stats',
+                        help='show frame timing next to the status area',
+                        action='store_true')
+    parser.add_argument('--stats-file',
+                        help='write timing of every frame to FILE as JSON '
+                             'lines',
+                        type=str)
+    parser.add_argument('--record',
+                        help='record the output to FILE, for --replay',
+                        type=str)
+    parser.add_argument('--replay',
+                        help='play back a recording made with --record',
+                        type=str)
+    parser.add_argument('--replay-speed',
+                        help='playback speed multiplier. Default=1',
+                        default=1.0,
+                        type=float)
+    parser.add_argument('--loop',
+                        help='with --replay, play the recording over and over',
+                        action='store_true')
+    parser.add_argument('--fast-start',
+                        help='cache the parsed options for this command line',
+                        action='store_true')
+    parser.add_argument('--serve',
+                        help='run one simulation for many --connect '
+                             'clients, on [HOST:]PORT or a Unix socket path',
+                        type=str)
+    parser.add_argument('--connect',
+                        help='show the rain from a --serve server',
+                        type=str)
+    parser.add_argument('--export',
+                        help='render frames to a .gif, or .png or .ppm '
+                             'images, without a terminal',
+                        type=str)
+    parser.add_argument('--export-frames',
+                        help='frames to --export. Default=300',
+                        default=300,
+                        type=int)
+    parser.add_argument('--export-size',
+                        help='COLSxROWS to --export. Default=80x24',
+                        default='80x24',
+                        type=str)
+    parser.add_argument('--export-font',
+                        help='TrueType font for --export',
+                        type=str)
+    parser.add_argument('--export-font-size',
+                        help='font size in pixels for --export. Default=16',
+                        default=16,
+                        type=int)
+    parser.add_argument('--ansi',
+                        help='write raw ANSI escape codes instead of using '
+                             'curses',
+                        action='store_true')
+    parser.add_argument('--numpy',
+                        help='step nodes in NumPy arrays, for very large '
+                             'screens',
+                        action='store_true')
+    parser.add_argument('--workers',
+                        help='step the rain in N processes, for very wide '
+                             'screens',
+                        default=0,
+                        type=int)
+    return parser
+
+
+char_set = {
+
+    'a': 'qwertyuiopasdfghjklzxcvbnm',
+    'A': 'QWERTYUIOPASDFGHJKLZXCVBNM',
+    'b': 'ⰰⰱⰲⰳⰴⰼⰵⰶⰷⰸⱚⰺⰻⰽⰾⰿⱞⱀⱁⱂⱃⱄⱅⱛⱆⱇⱈⱉⱋⱌⱍⱎⱏⱜⰹⱐⱓⱑⱔⱕⱗⱘⱙⱊⱝⱒⱖ',
+    'B': 'ⰀⰁⰂⰃⰄⰌⰅⰆⰇⰈⰪⰊⰋⰍⰎⰏⰮⰐⰑⰒⰓⰔⰕⰫⰖⰗⰘⰙⰛⰜⰝⰞⰟⰬⰉⰠⰣⰡⰤⰥⰧⰨⰩⰚⰭⰢⰦ',
+    'c': 'абвгдежзиклмнопрстуфхцчшщъыьэюя',
+    'C': 'АБВГДЕЖЗИКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ',
+    'e': '☺☻✌♡♥❤⚘❀❃❁✼☀✌♫♪☃❄❅❆☕☂★',
+    'g': 'αβγδεζηθικλμνξοπρστυφχψως',
+    'G': 'ΑΒΓΔΕΖΗΘΙΚΛΜΝΞΟΠΡΣΤΥΦΧΨΩ',
+    'k': 'ｦｧｨｩｪｫｬｭｮｯｰｱｲｳｴｵｶｷｸｹｺｻｼｽｾｿﾀﾁﾂﾃﾄﾅﾆﾇﾈﾉﾊﾋﾌﾍﾎﾏﾐﾑﾒﾓﾔﾕﾖﾗﾘﾙﾚﾛﾜﾝ',
+    'm': 'ｦｧｨｩｪｫｬｭｮｯｰｱｲｳｴｵｶｷｸｹｺｻｼｽｾｿﾀﾁﾂﾃﾄﾅﾆﾇﾈﾉﾊﾋﾌﾍﾎﾏﾐﾑﾒﾓﾔﾕﾖﾗﾘﾙﾚﾛﾜﾝ1234567890'
+         '1234567890-=*_+|:<>"-=*_+|:<>"-=*_+|:<>"-=*_+|:<>"',
+    'n': '1234567890',
+    'o': 'qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM1234567890'
+         r'`-=~!@#$%^&*()_+[]{}|\;\':",./<>?"',
+    'p': '',
+    'P': '',
+    'r': 'mcclllxxxxvvvvviiiiii',
+    'R': 'MCCLLLXXXXVVVVVIIIIII',
+    's': '-=*_+|:<>"',
+    'S': r'`-=~!@#$%^&*()_+[]{}|\;\':",./<>?"',
+    'u': ''}
+
+colors_str = {
+    'green': curses.COLOR_GREEN,
+    'red': curses.COLOR_RED,
+    'blue': curses.COLOR_BLUE,
+    'white': curses.COLOR_WHITE,
+    'yellow': curses.COLOR_YELLOW,
+    'cyan': curses.COLOR_CYAN,
+    'magenta': curses.COLOR_MAGENTA,
+    'black': curses.COLOR_BLACK,
+    'default': -1}
+
+# Cell attributes, as stored by Grid and passed to put(): the color pair
+# number shifted left one bit, with the low bit set for bold.
+BOLD = 1
+RAIN = 1 << 1
+HEAD = 2 << 1
+STATUS = 3 << 1
+# Shades of a --gradient trail, brightest first: the cell d rows behind a
+# head has attribute TRAIL + (d << 1), up to the darkest shade
+TRAIL = 4 << 1
+TRAIL_SHADES = 6
+DARKEST = TRAIL + (TRAIL_SHADES - 1 << 1)
+# Number of cell attributes
+ATTR_COUNT = TRAIL + (TRAIL_SHADES << 1)
+
+# Engine quality with nothing given up, see Engine.set_quality
+FULL_QUALITY = 3
+
+# Key codes for the terminal's focus reports, past the last curses key code
+FOCUS_IN = curses.KEY_MAX + 1
+FOCUS_OUT = curses.KEY_MAX + 2
+
+# Settings below are filled in by configure()
+args = None
+chars = ''
+rng = None
+start_color = curses.COLOR_GREEN
+start_bg = -1
+start_delay = 150
+runtime = None
+
+
+def configure(argv=None):
+    """
+    Parses command line arguments (sys.argv when argv is None) and applies
+    them to the module-level settings. Must be called before building an
+    Engine, whether or not a terminal is attached.
+    """
+    global args, chars, start_color, start_bg, start_delay, runtime, rng
+
+    if argv is None:
+        argv = sys.argv[1:]
+    fast_start = '--fast-start' in argv
+    args = load_args(argv) if fast_start else None
+    if args is None:
+        args = make_parser().parse_args(argv)
+        if fast_start and not args.help:
+            save_args(argv, args)
+
+    if args.help:
+        print(help_msg)
+        exit()
+
+    char_set['u'] = args.custom_characters
+
+    start_color = colors_str[args.color]
+    start_bg = colors_str[args.bg_color]
+
+    speed = args.speed
+    start_delay = (100 - speed) * 10
+
+    runtime = None
+
+    if args.time:
+        runtime = args.time
+
+    # "-l" option has been used
+    if args.character_list:
+        chars = ''
+        for letter in args.character_list:
+            try:
+                chars += char_set[letter]
+            except KeyError:
+                print("Letter '%s' does not represent a valid character list."
+                      % letter)
+                exit()
+
+    # "-l" not used, but "-u" is set
+    elif args.custom_characters:
+        chars = args.custom_characters
+
+    # Neither "-l" nor "-u" has been set, use default characters
+    else:
+        chars = char_set['m']
+
+    if args.no_bold:
+        args.all_bold = False
+
+    rng = RandomStream(args.seed)
+
+    return args
+
+
+def cache_path():
+    """
+    Returns the file where --fast-start keeps parsed command lines
+    """
+    cache_dir = (os.environ.get('XDG_CACHE_HOME')
+                 or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'unimatrix', 'args')
+
+
+def read_cache():
+    """
+    Returns the --fast-start cache, a dict of {(version, argv): options},
+    or an empty dict if there isn't one yet
+    """
+    import marshal
+    try:
+        with open(cache_path(), 'rb') as f:
+            cache = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def load_args(argv):
+    """
+    Returns the options saved by --fast-start for exactly this command line,
+    or None if there are none. Options saved by a different copy of this
+    file (going by its modification time) are ignored.
+    """
+    try:
+        version = os.stat(__file__).st_mtime
+    except OSError:
+        return None
+    options = read_cache().get((version, tuple(argv)))
+    if options is None:
+        return None
+    from types import SimpleNamespace
+    return SimpleNamespace(**options)
+
+
+def save_args(argv, args):
+    """
+    Saves parsed options for load_args() to find next time. Failing to save
+    them is not an error, only slower.
+    """
+    import marshal
+    try:
+        version = os.stat(__file__).st_mtime
+    except OSError:
+        return
+    cache = {key: options for key, options in read_cache().items()
+             if key[0] == version}
+    cache[(version, tuple(argv))] = dict(vars(args))
+    path = cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            marshal.dump(cache, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+
+### Classes
+
+class RandomStream:
+    """
+    Source of all randomness in the simulation. Rather than calling the
+    random module for every cell, values are generated a block at a time and
+    handed out by endless iterators that refill themselves:
+    glyphs -> Random characters from the active character set
+    bolds  -> BOLD or 0, evenly
+    floats -> Floats in [0, 1), used for everything else
+    Give it a seed for repeatable output.
+    """
+
+    block_size = 4096
+
+    def __init__(self, seed=None):
+        self.random = Random(seed)
+        self.glyphs = chain.from_iterable(iter(self.glyph_block, None))
+        self.bolds = chain.from_iterable(iter(self.bold_block, None))
+        self.floats = chain.from_iterable(iter(self.float_block, None))
+
+    def glyph_block(self):
+        words = self.random.getrandbits(32 * self.block_size).to_bytes(
+            4 * self.block_size, 'little')
+        count = len(chars)
+        return [chars[word % count] for word in memoryview(words).cast('I')]
+
+    def bold_block(self):
+        bits = self.random.getrandbits(8 * self.block_size).to_bytes(
+            self.block_size, 'little')
+        return [byte & BOLD for byte in bits]
+
+    def float_block(self):
+        random = self.random.random
+        return [random() for _ in range(self.block_size)]
+
+    def randint(self, a, b):
+        """
+        Random integer N such that a <= N <= b, like random.randint
+        """
+        return a + int(next(self.floats) * (b - a + 1))
+
+
+class Canvas:
+    """
+    Represents the whole screen and stores its height and width. Resized in
+    place when the screen resizes, keeping its columns, nodes and flashers.
+    Serves as a container for columns.
+    Columns wait for their next spawn in a timing wheel, so that a step only
+    looks at the columns that are due:
+    clock  -> Number of the current step
+    wheel  -> Columns due to spawn, by step number
+    speeds -> async_speed of each node, in the same order as nodes
+    """
+
+    def __init__(self, rows, cols, pool=None):
+        self.col_count = cols
+        self.row_count = rows
+        self.columns = []
+        self.clock = 0
+        self.wheel = {}
+        for col in range(0, cols, 2):
+            self.add_column(Column(col, self.row_count))
+        self.nodes = []
+        self.speeds = bytearray()
+        self.pool = pool if pool is not None else NodePool()
+        self.flashers = FlasherIndex(rows, cols)
+        # Lowered by Engine.set_quality
+        self.white_heads = True
+        self.thin = False
+
+    def resize(self, rows, cols):
+        """
+        Fits the canvas to a new screen size, keeping the rain that is still
+        on screen. Columns are added or trimmed on the right, and nodes and
+        flashers that are now out of bounds are dropped.
+        """
+        if cols < self.col_count:
+            self.columns = [col for col in self.columns if col.x_coord < cols]
+            for step, due in list(self.wheel.items()):
+                due = [col for col in due if col.x_coord < cols]
+                if due:
+                    self.wheel[step] = due
+                else:
+                    del self.wheel[step]
+        else:
+            for col in range(len(self.columns) * 2, cols, 2):
+                self.add_column(Column(col, rows))
+
+        nodes = self.nodes
+        keep = 0
+        for node in nodes:
+            if node.x_coord < cols and node.y_coord < rows:
+                nodes[keep] = node
+                keep += 1
+            else:
+                node.expired = True
+                self.pool.release(node)
+        del nodes[keep:]
+        self.speeds = bytearray(node.async_speed for node in nodes)
+
+        self.flashers.resize(rows, cols)
+        self.row_count = rows
+        self.col_count = cols
+
+    def take(self, other, start, end, dx):
+        """
+        Moves the columns of another canvas from start up to end into this
+        one, dx columns further right, with their nodes and flashers. Used
+        by ShardedEngine to hand rain over to new slices.
+        """
+        def split(items):
+            kept = [item for item in items if not start <= item.x_coord < end]
+            return kept, [item for item in items
+                          if start <= item.x_coord < end]
+
+        # Step numbers in the wheel count from each canvas's own start
+        rebase = self.clock - other.clock
+        for step, due in other.wheel.items():
+            due[:], taken = split(due)
+            if taken:
+                self.wheel.setdefault(step + rebase, []).extend(taken)
+        other.columns, columns = split(other.columns)
+        other.nodes, nodes = split(other.nodes)
+        other.speeds = bytearray(node.async_speed for node in other.nodes)
+        for item in columns + nodes:
+            item.x_coord += dx
+        self.columns += columns
+        self.nodes += nodes
+        self.speeds += bytes(node.async_speed for node in nodes)
+        flashers = self.flashers
+        for x in range(start, min(end, len(other.flashers.columns))):
+            column = other.flashers.columns[x]
+            if column:
+                other.flashers.columns[x] = None
+                flashers.columns[x + dx] = column
+                flashers.count += column.count(1)
+
+    def add_column(self, col):
+        self.columns.append(col)
+        self.wheel.setdefault(self.clock + col.timer, []).append(col)
+
+    def spawn(self):
+        """
+        Spawns nodes in the columns whose timers run out this step, left to
+        right, and puts each back in the wheel for its next spawn
+        """
+        clock = self.clock
+        self.clock += 1
+        due = self.wheel.pop(clock, None)
+        if due is None:
+            return
+        due.sort(key=lambda col: col.x_coord)
+        wheel = self.wheel
+        for col in due:
+            col.timer = 0
+            col.spawn_node(self)
+            # No new timer once a single wave is over
+            if col.timer > 0:
+                wheel.setdefault(clock + col.timer, []).append(col)
+
+
+class FlasherIndex:
+    """
+    Positions of the flashers on the canvas, indexed by column. Each column
+    that has had a flasher gets a bytearray with one byte per row, set to 1
+    where a flasher sits, so adding, removing and clearing a range of rows
+    are all cheap. Redraws are spread out over steps of the rain: each call
+    to redraw() picks up where the last one stopped.
+    count  -> Number of flashers
+    limit  -> Most flashers allowed at once (density cap)
+    share  -> Part of the density cap in use, lowered by Engine.set_quality
+    cursor -> (x, y) where the next redraw starts
+    """
+
+    # Redraw every flasher once every this many steps
+    redraw_steps = 3
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.columns = [None] * cols
+        self.count = 0
+        self.share = 1
+        self.limit = int(rows * cols * args.flash_density)
+        self.cursor = (0, 0)
+
+    def __len__(self):
+        return self.count
+
+    def resize(self, rows, cols):
+        """
+        Drops flashers that fall outside the new size
+        """
+        columns = self.columns
+        for column in columns[cols:]:
+            if column:
+                self.count -= column.count(1)
+        del columns[cols:]
+        columns.extend([None] * (cols - len(columns)))
+        for column in columns:
+            if column is None:
+                continue
+            if rows < self.rows:
+                self.count -= column.count(1, rows)
+                del column[rows:]
+            else:
+                column.extend(bytes(rows - self.rows))
+        self.rows = rows
+        self.limit = int(rows * cols * args.flash_density * self.share)
+        self.cursor = (0, 0)
+
+    def set_share(self, share):
+        """
+        Allows only a share of the usual number of flashers. Flashers over
+        the new limit are left to be erased by the rain.
+        """
+        self.share = share
+        self.limit = int(self.rows * len(self.columns) * args.flash_density
+                         * share)
+
+    def __iter__(self):
+        """
+        Yields (y, x) of every flasher
+        """
+        for x, column in enumerate(self.columns):
+            if column:
+                y = column.find(1)
+                while y >= 0:
+                    yield y, x
+                    y = column.find(1, y + 1)
+
+    def add(self, y, x):
+        """
+        Makes (y, x) a flasher, unless the density cap has been reached
+        """
+        column = self.columns[x]
+        if column is None:
+            column = self.columns[x] = bytearray(self.rows)
+        if not column[y] and self.count < self.limit:
+            column[y] = 1
+            self.count += 1
+
+    def discard(self, y, x):
+        """
+        Stops (y, x) being a flasher, if it was one
+        """
+        column = self.columns[x]
+        if column and column[y]:
+            column[y] = 0
+            self.count -= 1
+
+    def discard_range(self, x, top, bottom):
+        """
+        Removes every flasher in column x from row top up to, but not
+        including, row bottom
+        """
+        column = self.columns[x]
+        if column:
+            top = max(top, 0)
+            bottom = min(bottom, self.rows)
+            if top < bottom:
+                self.count -= column.count(1, top, bottom)
+                column[top:bottom] = bytes(bottom - top)
+
+    def redraw(self, draw, budget=0):
+        """
+        Calls draw(y, x) for the next share of flashers: enough to get round
+        all of them every redraw_steps steps, but never more than budget
+        (if set)
+        """
+        quota = -(-self.count // self.redraw_steps)
+        if budget:
+            quota = min(quota, budget)
+        if not quota:
+            return
+        columns = self.columns
+        width = len(columns)
+        x, y = self.cursor
+        # Wrap around at most once, back to the starting column
+        for _ in range(width + 1):
+            column = columns[x]
+            if column:
+                y = column.find(1, y)
+                while y >= 0:
+                    draw(y, x)
+                    quota -= 1
+                    if not quota:
+                        self.cursor = (x, y + 1)
+                        return
+                    y = column.find(1, y + 1)
+            y = 0
+            x = x + 1 if x + 1 < width else 0
+        self.cursor = (x, 0)
+
+
+# Whether each character looked up so far is wide, see is_wide()
+wide_chars = {}
+
+
+def is_wide(character):
+    """
+    Returns True for characters that take up two columns on a terminal, such
+    as CJK characters and most emoji
+    """
+    wide = wide_chars.get(character)
+    if wide is None:
+        import unicodedata
+        wide = wide_chars[character] = (
+            unicodedata.east_asian_width(character) in 'WF')
+    return wide
+
+
+class Grid:
+    """
+    In-memory grid of cells, one character and one attribute per cell. Lets
+    the simulation run without a terminal.
+    """
+
+    # No keyboard to wait on
+    input_fd = None
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.chars = [' '] * (rows * cols)
+        self.attrs = [0] * (rows * cols)
+
+    def put(self, y, x, text, attr):
+        """
+        Writes text starting at (y, x). Anything falling off the grid is
+        silently dropped, as curses errors are on a real screen.
+        """
+        if not 0 <= y < self.rows or x < 0:
+            return
+        i = y * self.cols + x
+        for character in text[:self.cols - x]:
+            self.chars[i] = character
+            self.attrs[i] = attr
+            i += 1
+
+    # Writes that can wait when output is short of bandwidth, see FrameBuffer
+    put_low = put
+
+    def recolor(self, y, x, attr):
+        """
+        Gives the cell at (y, x) the colors of attr, keeping its character
+        and boldness. Blank cells are left alone.
+        """
+        if 0 <= y < self.rows and 0 <= x < self.cols:
+            i = y * self.cols + x
+            if self.chars[i] != ' ':
+                self.attrs[i] = attr | self.attrs[i] & BOLD
+
+    def copy_cells(self, x, cols, indices, codes, attrs):
+        """
+        Copies cells from a slice of the grid, cols wide and starting at
+        column x, as written by a ShardGrid: indices in the slice, code
+        points and attributes
+        """
+        own_chars = self.chars
+        own_attrs = self.attrs
+        width = self.cols
+        for i in indices:
+            y, dx = divmod(i, cols)
+            j = y * width + x + dx
+            own_chars[j] = chr(codes[i])
+            own_attrs[j] = attrs[i]
+
+    def clear(self):
+        size = self.rows * self.cols
+        self.chars = [' '] * size
+        self.attrs = [0] * size
+
+    def getmaxyx(self):
+        return self.rows, self.cols
+
+    def getch(self):
+        return -1
+
+    def init_pair(self, pair, fg, bg):
+        pass
+
+    def refresh(self):
+        pass
+
+    def full_runs(self):
+        """
+        Returns every cell as (y, x, text, attr) runs, one run for each
+        stretch of a row with the same attribute
+        """
+        chars = self.chars
+        attrs = self.attrs
+        cols = self.cols
+        runs = []
+        for row in range(0, self.rows * cols, cols):
+            start = row
+            end = row + cols
+            while start < end:
+                attr = attrs[start]
+                stop = start + 1
+                while stop < end and attrs[stop] == attr:
+                    stop += 1
+                runs.append((row // cols, start - row,
+                             ''.join(chars[start:stop]), attr))
+                start = stop
+        return runs
+
+    def text(self):
+        """
+        Returns the grid contents as a string, one line per row
+        """
+        cols = self.cols
+        return '\n'.join(''.join(self.chars[i:i + cols])
+                         for i in range(0, self.rows * cols, cols))
+
+
+class Overlay:
+    """
+    A line of text shown over the rain, such as the status message. It is a
+    layer of its own: the rain underneath is kept as it is, and shows again
+    when the overlay shrinks or is hidden.
+    y, x    -> Where the text starts
+    text    -> What is shown; '' when hidden
+    attr    -> Cell attribute of the whole text
+    changed -> True until the text has been sent to the terminal
+    window  -> The curses window it is drawn in, made by Screen
+    """
+
+    __slots__ = ('y', 'x', 'text', 'attr', 'changed', 'window')
+
+    def __init__(self, y, x):
+        self.y = y
+        self.x = x
+        self.text = ''
+        self.attr = STATUS
+        self.changed = False
+        self.window = None
+
+    def clipped(self, rows, cols):
+        """
+        Returns the part of the text that fits on a screen of rows x cols,
+        which is '' if the overlay starts off the screen
+        """
+        if not 0 <= self.y < rows or self.x >= cols:
+            return ''
+        return self.text[:cols - self.x]
+
+
+class FrameBuffer(Grid):
+    """
+    Off-screen copy of the whole screen. Keeps track of the cells written
+    since the last flush, so that only cells that really changed are sent to
+    the terminal, joined into runs of cells that share an attribute.
+    Overlays are composited on top: rain cells they cover are held back
+    until they are uncovered, and an overlay is only sent again when its
+    text changes.
+    shown_chars, shown_attrs -> What the terminal is showing now. None for
+                                cells it hasn't been sent yet, or that an
+                                overlay covers.
+    dirty                    -> Indexes of cells written since last flush
+    low_dirty                -> Indexes of cells written by put_low() or
+                                recolor() since last flush. With a byte
+                                limit, these are only sent once the cells in
+                                dirty have been.
+    overlays                 -> Overlays, bottom first
+    covered                  -> Indexes of cells covered by an overlay
+    redrawn                  -> Overlays sent by the last call to runs()
+    flushed_runs             -> Runs emitted by the last call to runs()
+    flushed_cells            -> Cells emitted by the last call to runs()
+    flushed_bytes            -> Estimated size of those runs on the terminal
+    last_runs                -> The runs themselves
+    """
+
+    # About what it takes to move the cursor to a run and set its attribute
+    run_bytes = 12
+
+    def __init__(self, rows, cols):
+        Grid.__init__(self, rows, cols)
+        self.overlays = []
+        self.covered = set()
+        self.redrawn = []
+        self.last_runs = []
+        self.flushed_runs = 0
+        self.flushed_cells = 0
+        self.flushed_bytes = 0
+        self.invalidate()
+
+    def overlay(self, y, x):
+        """
+        Returns a new, hidden overlay at (y, x), on top of the others
+        """
+        overlay = Overlay(y, x)
+        self.overlays.append(overlay)
+        return overlay
+
+    def show(self, overlay, text, attr=STATUS):
+        """
+        Changes the text of an overlay. Rain cells it no longer covers are
+        sent again on the next flush.
+        """
+        if text == overlay.text and attr == overlay.attr:
+            return
+        overlay.text = text
+        overlay.attr = attr
+        overlay.changed = True
+        self.cover()
+
+    def hide(self, overlay):
+        self.show(overlay, '', overlay.attr)
+
+    def cover(self):
+        """
+        Works out which cells the overlays cover, after one of them changed
+        or the size did
+        """
+        covered = set()
+        for overlay in self.overlays:
+            if 0 <= overlay.y < self.rows:
+                start = overlay.y * self.cols + overlay.x
+                width = min(len(overlay.text), self.cols - overlay.x)
+                covered.update(range(start, start + max(width, 0)))
+        for i in covered - self.covered:
+            self.shown_chars[i] = self.shown_attrs[i] = None
+        self.dirty.extend(self.covered - covered)
+        self.covered = covered
+
+    def put(self, y, x, text, attr):
+        if not 0 <= y < self.rows or x < 0:
+            return
+        i = y * self.cols + x
+        for character in text[:self.cols - x]:
+            self.chars[i] = character
+            self.attrs[i] = attr
+            self.dirty.append(i)
+            i += 1
+
+    def put_low(self, y, x, text, attr):
+        """
+        Writes like put(), but the cells are sent after the others, as far
+        as the byte limit allows
+        """
+        if not 0 <= y < self.rows or x < 0:
+            return
+        i = y * self.cols + x
+        for character in text[:self.cols - x]:
+            self.chars[i] = character
+            self.attrs[i] = attr
+            self.low_dirty.append(i)
+            i += 1
+
+    def recolor(self, y, x, attr):
+        if 0 <= y < self.rows and 0 <= x < self.cols:
+            i = y * self.cols + x
+            if self.chars[i] != ' ':
+                self.attrs[i] = attr | self.attrs[i] & BOLD
+                self.low_dirty.append(i)
+
+    def copy_cells(self, x, cols, indices, codes, attrs):
+        own_chars = self.chars
+        own_attrs = self.attrs
+        dirty = self.dirty
+        width = self.cols
+        for i in indices:
+            y, dx = divmod(i, cols)
+            j = y * width + x + dx
+            own_chars[j] = chr(codes[i])
+            own_attrs[j] = attrs[i]
+            dirty.append(j)
+
+    def clear(self):
+        Grid.clear(self)
+        self.dirty = list(range(self.rows * self.cols))
+        self.low_dirty = []
+
+    def resize(self, rows, cols, attr=RAIN):
+        """
+        Changes size, keeping the contents that still fit. New cells are
+        blank, with the given attribute. Everything is sent again on the next
+        flush, but nothing is cleared first, so the screen never goes blank.
+        """
+        old_chars = self.chars
+        old_attrs = self.attrs
+        old_rows = self.rows
+        old_cols = self.cols
+        width = min(cols, old_cols)
+        Grid.__init__(self, rows, cols)
+        self.attrs = [attr] * (rows * cols)
+        for y in range(min(rows, old_rows)):
+            new = y * cols
+            old = y * old_cols
+            self.chars[new:new + width] = old_chars[old:old + width]
+            self.attrs[new:new + width] = old_attrs[old:old + width]
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forgets what is on the terminal, so that the next flush sends every
+        cell
+        """
+        size = self.rows * self.cols
+        self.shown_chars = [None] * size
+        self.shown_attrs = [None] * size
+        self.dirty = list(range(size))
+        self.low_dirty = []
+        self.covered = set()
+        for overlay in self.overlays:
+            overlay.changed = True
+        self.cover()
+
+    def full_runs(self):
+        """
+        Returns every cell as runs, like Grid.full_runs, followed by the
+        overlays
+        """
+        runs = Grid.full_runs(self)
+        for overlay in self.overlays:
+            text = overlay.clipped(self.rows, self.cols)
+            if text:
+                runs.append((overlay.y, overlay.x, text, overlay.attr))
+        return runs
+
+    def runs(self, limit=None):
+        """
+        Returns the changes since the last call as a list of
+        (y, x, text, attr) runs, and marks them as shown. The runs of the
+        rain come first, then one run for each overlay in redrawn.
+        With a limit, in bytes, only as many changes as fit in it are sent,
+        oldest first, and the low priority ones (see put_low) only once
+        all the others are. The rest stay dirty for a later call. Overlays
+        are always sent, and go over the limit if they don't fit in it.
+        """
+        if limit is None:
+            runs, cells = self.make_runs(self.dirty + self.low_dirty)
+            self.dirty = []
+            self.low_dirty = []
+        else:
+            picked = set()
+            room, self.dirty = self.pick(self.dirty, limit, picked)
+            room, self.low_dirty = self.pick(self.low_dirty, room, picked)
+            runs, cells = self.make_runs(picked)
+
+        redrawn = []
+        for overlay in self.overlays:
+            if overlay.changed:
+                overlay.changed = False
+                text = overlay.clipped(self.rows, self.cols)
+                if text:
+                    redrawn.append(overlay)
+                    runs.append((overlay.y, overlay.x, text, overlay.attr))
+                    cells += len(text)
+        self.redrawn = redrawn
+        self.last_runs = runs
+        self.flushed_runs = len(runs)
+        self.flushed_cells = cells
+        self.flushed_bytes = self.estimate_bytes(runs)
+        return runs
+
+    def pick(self, indices, room, picked):
+        """
+        Adds the changed cells at indices to the set picked, oldest first,
+        for as long as they fit in room bytes. Returns the room left and
+        the indices still waiting. A cell is counted as starting a run
+        unless make_runs() is sure to join it to the cell before it, so
+        the runs never come to more than the estimate.
+        """
+        chars = self.chars
+        attrs = self.attrs
+        shown_chars = self.shown_chars
+        shown_attrs = self.shown_attrs
+        covered = self.covered
+        run_bytes = self.run_bytes
+        cols = self.cols
+        # Written again while waiting, a cell still only counts once
+        indices = list(dict.fromkeys(indices))
+        for n, i in enumerate(indices):
+            if i in picked or i in covered or (
+                    chars[i] == shown_chars[i] and attrs[i] == shown_attrs[i]):
+                continue
+            size = len(chars[i].encode())
+            if not (i - 1 in picked and i % cols and attrs[i - 1] == attrs[i]
+                    and not is_wide(chars[i - 1])):
+                size += run_bytes
+            if size > room:
+                return room, indices[n:]
+            room -= size
+            picked.add(i)
+        return room, []
+
+    def make_runs(self, indices):
+        """
+        Returns the runs of the cells at indices that changed since they
+        were last shown, and the number of cells in them, and marks them
+        as shown. A single unchanged cell between two changed ones is sent
+        along with them if it has the same attribute, as that is cheaper
+        than starting a new run. A wide character always ends its run: the
+        terminal moves two columns past it, but the next cell is only one
+        column over.
+        """
+        chars = self.chars
+        attrs = self.attrs
+        shown_chars = self.shown_chars
+        shown_attrs = self.shown_attrs
+        covered = self.covered
+        cols = self.cols
+        runs = []
+        start = end = row_end = -1
+        run_attr = None
+        # Whether the run ends in a wide character
+        wide_end = False
+        cells = 0
+
+        for i in sorted(set(indices)):
+            character = chars[i]
+            attr = attrs[i]
+            if character == shown_chars[i] and attr == shown_attrs[i]:
+                continue
+            if i in covered:
+                continue
+            shown_chars[i] = character
+            shown_attrs[i] = attr
+            if attr == run_attr and i < row_end and not wide_end:
+                if i == end:
+                    end += 1
+                    wide_end = is_wide(character)
+                    continue
+                if (i == end + 1 and attrs[end] == attr
+                        and chars[end] == shown_chars[end]
+                        and not is_wide(chars[end])):
+                    end += 2
+                    wide_end = is_wide(character)
+                    continue
+            if start >= 0:
+                runs.append((start // cols, start % cols,
+                             ''.join(chars[start:end]), run_attr))
+                cells += end - start
+            start = i
+            end = i + 1
+            row_end = i - i % cols + cols
+            run_attr = attr
+            wide_end = is_wide(character)
+        if start >= 0:
+            runs.append((start // cols, start % cols,
+                         ''.join(chars[start:end]), run_attr))
+            cells += end - start
+        return runs, cells
+
+    def estimate_bytes(self, runs):
+        """
+        Returns about how many bytes the runs take to draw on a terminal
+        """
+        return (self.run_bytes * len(runs)
+                + sum(len(run[2].encode()) for run in runs))
+
+
+def color_depth():
+    """
+    Guesses how many colors the terminal has from its environment, for
+    AnsiEncoder: 1 << 24 when COLORTERM says truecolor, 256 when TERM says
+    so, 8 otherwise
+    """
+    if os.environ.get('COLORTERM') in ('truecolor', '24bit'):
+        return 1 << 24
+    if '256' in os.environ.get('TERM', ''):
+        return 256
+    return 8
+
+
+def shade_ramp(fg, depth):
+    """
+    Returns the colors of the --gradient shades of fg, brightest first: as
+    (r, g, b) with truecolor and as 256-color palette numbers with 256
+    colors. None with fewer colors, or when fg is the terminal's default
+    color, which isn't known.
+    """
+    if fg < 0 or depth < 256:
+        return None
+    palette = GlyphAtlas.palette
+    bright = palette[3 * (fg | 8):3 * (fg | 8) + 3]
+    base = palette[3 * fg:3 * fg + 3]
+    # Levels of each component in the 6 x 6 x 6 color cube from 16 to 231
+    levels = (0, 95, 135, 175, 215, 255)
+    ramp = []
+    for shade in range(TRAIL_SHADES):
+        # From the bright version of fg down to a third of fg
+        t = shade / (TRAIL_SHADES - 1)
+        rgb = tuple(round(high * (1 - t) + low * t / 3)
+                    for high, low in zip(bright, base))
+        if depth > 256:
+            ramp.append(rgb)
+            continue
+        cube = [min(range(6), key=lambda i: abs(levels[i] - value))
+                for value in rgb]
+        ramp.append(16 + 36 * cube[0] + 6 * cube[1] + cube[2])
+    return ramp
+
+
+class PairAllocator:
+    """
+    Hands out curses color pairs for (fg, bg) combinations, so that more
+    colors can be used than the few pairs a terminal may have. Pairs are
+    cached: init_pair is only called for a combination not seen before, and
+    once every pair is taken, the least recently used one is given the new
+    colors.
+    """
+
+    def __init__(self, limit):
+        # Pair 0 is the terminal's own colors and can't be changed, and
+        # curses attributes have room for pair numbers up to 255
+        self.limit = min(limit, 256) - 1
+        # Pair of each combination, least recently used first
+        self.pairs = {}
+
+    def pair(self, fg, bg):
+        pairs = self.pairs
+        key = (fg, bg)
+        pair = pairs.pop(key, None)
+        if pair is None:
+            if len(pairs) < self.limit:
+                pair = len(pairs) + 1
+            else:
+                pair = pairs.pop(next(iter(pairs)))
+            curses.init_pair(pair, fg, bg)
+        pairs[key] = pair
+        return pair
+
+
+class Screen:
+    """
+    Wraps the curses window. Sets up colors, translates cell attributes into
+    curses attributes and copies changes from a FrameBuffer to the window.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.window.scrollok(0)
+        self.window.nodelay(True)
+        # Where key presses come from, for the frame scheduler to wait on
+        self.input_fd = sys.__stdin__.fileno()
+        curses.curs_set(0)
+        curses.use_default_colors()
+        self.pairs = PairAllocator(curses.COLOR_PAIRS)
+        # Colors of the rain, head and status pairs of cell attributes
+        self.colors = {1: (start_color, start_bg),
+                       2: (curses.COLOR_WHITE, start_bg),
+                       3: (curses.COLOR_BLACK, curses.COLOR_WHITE)}
+        self.repaint = False
+        # Keep curses from handling resizes itself: it clears the screen
+        # every time. Resizes are picked up by getmaxyx() and applied
+        # with resize() instead.
+        signal.signal(signal.SIGWINCH, lambda signum, frame: None)
+        self.curses_attrs = []
+        self.make_attrs()
+
+    def make_attrs(self):
+        """
+        Works out the curses attribute for every cell attribute, indexed by
+        cell attribute, from the current colors. With --gradient, the trail
+        shades are worked out here too, once per color change.
+        """
+        colors = self.colors
+        ramp = None
+        if args.gradient:
+            ramp = shade_ramp(colors[1][0], min(curses.COLORS, 256))
+        self.curses_attrs = []
+        for attr in range(ATTR_COUNT):
+            pair = max(attr >> 1, 1)
+            shade = pair - (TRAIL >> 1)
+            if shade < 0:
+                fg, bg = colors[pair]
+            elif ramp:
+                fg, bg = ramp[shade], colors[1][1]
+            else:
+                fg, bg = colors[1]
+            self.curses_attrs.append(
+                curses.color_pair(self.pairs.pair(fg, bg))
+                | (curses.A_BOLD if attr & BOLD else curses.A_NORMAL))
+
+    # curses doesn't say how much it writes
+    frame_bytes = None
+    # curses can't be used from two threads at once, see OutputThread
+    single_threaded = True
+
+    def flush(self, buffer, limit=None):
+        """
+        Writes every changed run of the rain to the window, one addstr per
+        run, and every changed overlay to a window of its own on top. The
+        terminal is updated once, by refresh(). limit is passed on to
+        FrameBuffer.runs().
+        """
+        if self.repaint:
+            buffer.invalidate()
+            self.repaint = False
+        addstr = self.window.addstr
+        curses_attrs = self.curses_attrs
+        runs = buffer.runs(limit)
+        for y, x, text, attr in runs[:len(runs) - len(buffer.redrawn)]:
+            try:
+                addstr(y, x, text, curses_attrs[attr])
+            except curses.error:
+                # Override scrolling error if characters pushed off the screen.
+                pass
+        self.window.noutrefresh()
+        for overlay in buffer.redrawn:
+            text = overlay.clipped(buffer.rows, buffer.cols)
+            window = overlay.window
+            if window is None or window.getmaxyx()[1] != len(text):
+                window = overlay.window = curses.newwin(1, len(text),
+                                                        overlay.y, overlay.x)
+            try:
+                window.addstr(0, 0, text, curses_attrs[overlay.attr])
+            except curses.error:
+                # Writing the last cell of a window moves the cursor out
+                pass
+            window.noutrefresh()
+
+    def clear(self):
+        self.window.clear()
+
+    def getmaxyx(self):
+        """
+        Returns the size of the terminal, which can differ from the size of
+        the window until resize() is called
+        """
+        size = os.get_terminal_size(sys.__stdout__.fileno())
+        return size.lines, size.columns
+
+    def resize(self, rows, cols):
+        """
+        Resizes the window without clearing the screen
+        """
+        curses.resize_term(rows, cols)
+
+    def getch(self):
+        """
+        Returns the next key press, or -1. curses doesn't know the
+        terminal's focus reports, so they are picked out of the input here
+        and returned as FOCUS_IN and FOCUS_OUT.
+        """
+        window = self.window
+        key = window.getch()
+        if key == 27:
+            following = window.getch()
+            if following == ord('['):
+                last = window.getch()
+                if last in AnsiScreen.focus_keys:
+                    return AnsiScreen.focus_keys[last]
+                if last != -1:
+                    curses.ungetch(last)
+            if following != -1:
+                curses.ungetch(following)
+        return key
+
+    def report_focus(self, on):
+        """
+        Turns the terminal's focus reports on or off
+        """
+        os.write(sys.__stdout__.fileno(),
+                 b'\x1b[?1004h' if on else b'\x1b[?1004l')
+
+    def init_pair(self, pair, fg, bg):
+        """
+        Changes the colors of the rain (1), head (2) or status (3). The new
+        colors may get a different curses pair, so the next flush repaints
+        everything.
+        """
+        self.colors[pair] = (fg, bg)
+        self.make_attrs()
+        self.repaint = True
+
+    def take_frame(self):
+        """
+        Returns what refresh() would send, for send(). curses keeps the frame
+        itself, so there is nothing to hand over.
+        """
+        return None
+
+    def send(self, frame):
+        curses.doupdate()
+
+    def refresh(self):
+        curses.doupdate()
+
+
+class AnsiEncoder:
+    """
+    Turns runs of cells into ANSI escape codes. Every glyph and every
+    attribute is encoded once and cached. Keeps track of the cursor and the
+    current attribute, so that cursor moves and attribute changes are only
+    sent when needed, and cursor moves on the same row are shortened.
+    depth -> Number of colors of the terminal, for --gradient shades
+    """
+
+    def __init__(self, fg=None, bg=None, depth=None):
+        if fg is None:
+            fg, bg = start_color, start_bg
+        self.depth = color_depth() if depth is None else depth
+        self.pairs = {1: (fg, bg),
+                      2: (curses.COLOR_WHITE, bg),
+                      3: (curses.COLOR_BLACK, curses.COLOR_WHITE)}
+        self.sgr = []
+        self.make_sgr()
+        # Encoded bytes and width of every character
+        self.glyphs = {}
+        for character in set(chars + ' '):
+            self.encode(character)
+        self.cursor = None
+        self.attr = None
+
+    def encode(self, character):
+        """
+        Adds a character to the glyph cache and returns its entry
+        """
+        import unicodedata
+        width = 2 if unicodedata.east_asian_width(character) in 'WF' else 1
+        glyph = self.glyphs[character] = (character.encode(), width)
+        return glyph
+
+    def make_sgr(self):
+        """
+        Builds the escape sequence for every cell attribute from the current
+        color pairs, and the shade ramp of the rain color
+        """
+        self.sgr = []
+        ramp = shade_ramp(self.pairs[1][0], self.depth)
+        for attr in range(ATTR_COUNT):
+            pair = max(attr >> 1, 1)
+            shade = pair - (TRAIL >> 1)
+            fg, bg = self.pairs[pair if shade < 0 else 1]
+            if shade >= 0 and ramp:
+                color = ramp[shade]
+                fg_code = (b'38;2;%d;%d;%d' % color if self.depth > 256
+                           else b'38;5;%d' % color)
+            else:
+                fg_code = b'%d' % (39 if fg < 0 else 30 + fg)
+            self.sgr.append(b'\x1b[0%s;%s;%dm'
+                            % (b';1' if attr & BOLD else b'', fg_code,
+                               49 if bg < 0 else 40 + bg))
+        # The terminal still has the old colors for whatever was sent last
+        self.attr = None
+
+    def set_colors(self, fg, bg):
+        """
+        Changes the rain colors, as KeyHandler does with init_pair
+        """
+        self.pairs[1] = (fg, bg)
+        self.pairs[2] = (curses.COLOR_WHITE, bg)
+        self.make_sgr()
+
+    def clear(self, out):
+        """
+        Appends the codes to clear the screen
+        """
+        out += b'\x1b[0m\x1b[2J'
+        self.cursor = None
+        self.attr = None
+
+    def write_runs(self, out, runs, rows, cols):
+        """
+        Appends the codes to draw runs of (y, x, text, attr) to out, clipped
+        to a terminal of rows x cols. Each character goes in its own cell,
+        so the cursor is moved back after a wide character that isn't the
+        last of its run.
+        """
+        sgr = self.sgr
+        glyphs = self.glyphs
+        cursor = self.cursor
+        cur_attr = self.attr
+        for y, x, text, attr in runs:
+            if y >= rows or x >= cols:
+                continue
+            if x + len(text) > cols:
+                text = text[:cols - x]
+            if cursor != (y, x):
+                if cursor is not None and cursor[0] == y and x > cursor[1]:
+                    # Cursor forward
+                    out += b'\x1b[%dC' % (x - cursor[1])
+                else:
+                    out += b'\x1b[%d;%dH' % (y + 1, x + 1)
+            if attr != cur_attr:
+                out += sgr[attr]
+                cur_attr = attr
+            column = x
+            for character in text:
+                if x != column:
+                    out += b'\x1b[%d;%dH' % (y + 1, column + 1)
+                    x = column
+                glyph = glyphs.get(character) or self.encode(character)
+                out += glyph[0]
+                x += glyph[1]
+                column += 1
+            # The cursor is left in limbo after writing the last column
+            cursor = (y, x) if x < cols else None
+        self.cursor = cursor
+        self.attr = cur_attr
+
+
+def write_all(fd, data):
+    """
+    Writes all of data to fd, waiting for room whenever the terminal is
+    behind. The terminal is usually both stdin and stdout, so when
+    AnsiScreen makes stdin non-blocking, stdout is too, and a plain write
+    fails with BlockingIOError on a slow terminal or ssh link.
+    """
+    written = 0
+    while written < len(data):
+        try:
+            written += os.write(fd, data[written:])
+        except BlockingIOError:
+            import select
+            select.select([], [fd], [])
+
+
+class AnsiScreen:
+    """
+    Stands in for Screen, but drives the terminal with raw ANSI escape codes
+    instead of curses. Each frame is encoded by an AnsiEncoder into one
+    bytearray and sent to the terminal with a single os.write.
+    """
+
+    # Escape sequences for arrow keys, as curses key codes
+    arrow_keys = {ord('A'): curses.KEY_UP, ord('B'): curses.KEY_DOWN,
+                  ord('C'): curses.KEY_RIGHT, ord('D'): curses.KEY_LEFT}
+    # Focus reports, ESC [ I and ESC [ O
+    focus_keys = {ord('I'): FOCUS_IN, ord('O'): FOCUS_OUT}
+    # Frames are plain bytes once taken, see OutputThread
+    single_threaded = False
+
+    def __init__(self, fd_in=0, fd_out=1):
+        import termios
+        import tty
+        self.fd_in = self.input_fd = fd_in
+        self.fd_out = fd_out
+        self.saved_tty = termios.tcgetattr(fd_in)
+        tty.setcbreak(fd_in)
+        os.set_blocking(fd_in, False)
+
+        self.encoder = AnsiEncoder()
+        self.keys = bytearray()
+        self.out = bytearray()
+        self.repaint = False
+        self.size = self.getmaxyx()
+        # Bytes sent by the last refresh
+        self.frame_bytes = 0
+        # Alternate screen, cursor off, no wrapping at the right edge
+        self.out += b'\x1b[?1049h\x1b[?25l\x1b[?7l'
+        self.clear()
+        self.refresh()
+
+    def close(self):
+        """
+        Puts the terminal back the way it was
+        """
+        import termios
+        self.out += b'\x1b[0m\x1b[?7h\x1b[?25h\x1b[?1049l'
+        self.refresh()
+        os.set_blocking(self.fd_in, True)
+        termios.tcsetattr(self.fd_in, termios.TCSADRAIN, self.saved_tty)
+
+    def flush(self, buffer, limit=None):
+        """
+        Appends the changed runs of the buffer to the frame
+        """
+        if self.repaint:
+            buffer.invalidate()
+            self.repaint = False
+        # The terminal may be a different size than the buffer for a moment
+        # while it is being resized, so runs are clipped to the terminal
+        self.encoder.write_runs(self.out, buffer.runs(limit), *self.size)
+
+    def refresh(self):
+        """
+        Sends the frame to the terminal in one write
+        """
+        self.send(self.take_frame())
+
+    def take_frame(self):
+        """
+        Returns the frame encoded so far and starts a new one
+        """
+        frame = bytes(self.out)
+        del self.out[:]
+        return frame
+
+    def send(self, frame):
+        """
+        Writes a frame from take_frame() to the terminal
+        """
+        self.frame_bytes = len(frame)
+        write_all(self.fd_out, frame)
+
+    def clear(self):
+        self.encoder.clear(self.out)
+
+    def getmaxyx(self):
+        size = os.get_terminal_size(self.fd_out)
+        self.size = size.lines, size.columns
+        return self.size
+
+    def resize(self, rows, cols):
+        pass
+
+    def getch(self):
+        """
+        Returns the next key press like curses does: a character code, a
+        curses key code for the arrow keys, or -1 if nothing was pressed
+        """
+        keys = self.keys
+        if not keys:
+            try:
+                keys += os.read(self.fd_in, 1024)
+            except (BlockingIOError, InterruptedError):
+                return -1
+            if not keys:
+                return -1
+        if (keys[0] == 27 and len(keys) >= 3 and keys[1] in b'[O'
+                and keys[2] in self.arrow_keys):
+            key = self.arrow_keys[keys[2]]
+            del keys[:3]
+            return key
+        if (keys[0] == 27 and len(keys) >= 3 and keys[1] == ord('[')
+                and keys[2] in self.focus_keys):
+            key = self.focus_keys[keys[2]]
+            del keys[:3]
+            return key
+        key = keys[0]
+        del keys[0]
+        return key
+
+    def report_focus(self, on):
+        """
+        Turns the terminal's focus reports on or off, with the next refresh
+        """
+        self.out += b'\x1b[?1004h' if on else b'\x1b[?1004l'
+
+    def init_pair(self, pair, fg, bg):
+        """
+        Changes a color pair. Unlike curses, the terminal doesn't recolor
+        what is already on screen, so the next flush repaints everything.
+        """
+        self.encoder.pairs[pair] = (fg, bg)
+        self.encoder.make_sgr()
+        self.repaint = True
+
+
+def write_varint(out, number):
+    """
+    Appends a non-negative integer to out as a LEB128 varint
+    """
+    while number > 0x7f:
+        out.append(number & 0x7f | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def read_varint(data, pos):
+    """
+    Reads a varint from data at pos. Returns (number, new pos).
+    """
+    number = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+class Recorder:
+    """
+    Records what is sent to the screen, frame by frame, so it can be played
+    back later with --replay without running the simulation. Files whose
+    name ends in .cast are written as an asciicast v2 stream, anything else
+    in a compact binary format: b'UMX1', then for each frame
+        varint  milliseconds since the previous frame
+        ops, each starting with one byte, ended by a 0 byte:
+        1  varint y, varint x, byte attr, varint length, UTF-8 text -> run
+        2  byte fg + 1, byte bg + 1                                -> colors
+        3  varint rows, varint cols                                -> resize
+    A whole frame is recorded whenever the size or colors change.
+    """
+
+    magic = b'UMX1'
+    RUN, COLORS, SIZE = 1, 2, 3
+
+    def __init__(self, path, rows, cols):
+        self.cast = path.endswith('.cast')
+        self.file = open(path, 'wb')
+        self.start = time.monotonic()
+        self.last_ms = 0
+        self.size = None
+        self.colors = None
+        if self.cast:
+            import json
+            self.json = json
+            self.encoder = AnsiEncoder()
+            header = {'version': 2, 'width': cols, 'height': rows,
+                      'timestamp': int(time.time())}
+            self.file.write(json.dumps(header).encode() + b'\n')
+        else:
+            self.file.write(self.magic)
+
+    def frame(self, buffer, fg, bg):
+        """
+        Records the runs last flushed from the buffer, with the current
+        colors
+        """
+        seconds = time.monotonic() - self.start
+        size = (buffer.rows, buffer.cols)
+        colors = (fg, bg)
+        runs = buffer.last_runs
+        if size != self.size or colors != self.colors:
+            runs = buffer.full_runs()
+        if self.cast:
+            self.cast_frame(seconds, size, colors, runs)
+        else:
+            self.binary_frame(seconds, size, colors, runs)
+        self.size = size
+        self.colors = colors
+
+    def binary_frame(self, seconds, size, colors, runs):
+        out = bytearray()
+        ms = int(1000 * seconds)
+        encode_frame(out, ms - self.last_ms, runs,
+                     size if size != self.size else None,
+                     colors if colors != self.colors else None)
+        self.last_ms = ms
+        self.file.write(out)
+
+    def cast_frame(self, seconds, size, colors, runs):
+        out = bytearray()
+        if size != self.size:
+            if self.size is not None:
+                self.file.write(self.json.dumps(
+                    [round(seconds, 6), 'r', '%dx%d' % (size[1], size[0])]
+                ).encode() + b'\n')
+            self.encoder.clear(out)
+        if colors != self.colors:
+            self.encoder.set_colors(*colors)
+        self.encoder.write_runs(out, runs, *size)
+        if out:
+            self.file.write(self.json.dumps(
+                [round(seconds, 6), 'o', out.decode()]).encode() + b'\n')
+
+    def close(self):
+        self.file.close()
+
+
+def encode_frame(out, ms, runs, size=None, colors=None):
+    """
+    Appends one frame in the format written by Recorder to out: ms since
+    the previous frame, then a resize and a color change if given, then the
+    runs
+    """
+    write_varint(out, ms)
+    if size is not None:
+        out.append(Recorder.SIZE)
+        write_varint(out, size[0])
+        write_varint(out, size[1])
+    if colors is not None:
+        out.append(Recorder.COLORS)
+        out.append(colors[0] + 1)
+        out.append(colors[1] + 1)
+    for y, x, text, attr in runs:
+        data = text.encode()
+        out.append(Recorder.RUN)
+        write_varint(out, y)
+        write_varint(out, x)
+        out.append(attr)
+        write_varint(out, len(data))
+        out += data
+    out.append(0)
+
+
+def decode_frame(data, pos, encoder, out, rows, cols):
+    """
+    Decodes the frame at data[pos:] into ANSI codes for a terminal of
+    rows x cols, appended to out. Returns (ms since the previous frame,
+    position of the next frame)
+    """
+    ms, pos = read_varint(data, pos)
+    runs = []
+    while True:
+        op = data[pos]
+        pos += 1
+        if op == Recorder.RUN:
+            y, pos = read_varint(data, pos)
+            x, pos = read_varint(data, pos)
+            attr = data[pos]
+            length, pos = read_varint(data, pos + 1)
+            runs.append((y, x, data[pos:pos + length].decode(), attr))
+            pos += length
+        elif op == Recorder.COLORS:
+            encoder.set_colors(data[pos] - 1, data[pos + 1] - 1)
+            pos += 2
+        elif op == Recorder.SIZE:
+            size, pos = read_varint(data, pos)
+            size, pos = read_varint(data, pos)
+            encoder.clear(out)
+        else:
+            break
+    encoder.write_runs(out, runs, rows, cols)
+    return ms, pos
+
+
+def load_recording(path, rows, cols):
+    """
+    Reads a recording made with --record and returns its frames, already
+    encoded as ANSI for a terminal of rows x cols, as a list of
+    (seconds since previous frame, bytes)
+    """
+    frames = []
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(Recorder.magic):
+        # asciicast: a JSON header line, then one event per line
+        import json
+        last = 0.0
+        for line in data.splitlines()[1:]:
+            if not line.strip():
+                continue
+            seconds, kind, payload = json.loads(line)
+            if kind == 'o':
+                frames.append((seconds - last, payload.encode()))
+                last = seconds
+        return frames
+
+    encoder = AnsiEncoder()
+    pos = len(Recorder.magic)
+    while pos < len(data):
+        out = bytearray()
+        ms, pos = decode_frame(data, pos, encoder, out, rows, cols)
+        frames.append((ms / 1000, bytes(out)))
+    return frames
+
+
+def replay(path, speed=1.0, loop=False):
+    """
+    Plays a recording straight to the terminal. Space, q or ESC stops it.
+    """
+    screen = AnsiScreen()
+    try:
+        frames = load_recording(path, *screen.getmaxyx())
+        while True:
+            due = time.monotonic()
+            for seconds, data in frames:
+                due += seconds / speed
+                pause = due - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+                elif pause < -0.25:
+                    # Too far behind, don't rush to catch up
+                    due = time.monotonic()
+                if screen.getch() in (ord(' '), ord('q'), 27):
+                    return
+                screen.out += data
+                screen.refresh()
+            if not loop:
+                return
+            screen.clear()
+    finally:
+        screen.close()
+
+
+def parse_address(address):
+    """
+    Splits a --serve or --connect address into (host, port, path). An
+    address with a '/' in it is the path of a Unix socket, anything else is
+    [HOST:]PORT, with HOST defaulting to localhost.
+    """
+    if '/' in address:
+        return None, None, address
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port), None
+
+
+class RemoteClient:
+    """
+    A client connected to a BroadcastServer
+    rows, cols -> Size of the client's terminal
+    stale      -> True when the client has to be sent a whole frame: it is
+                  new, has been resized, or has missed frames
+    sent       -> Frames sent to it
+    skipped    -> Frames skipped because it wasn't keeping up
+    """
+
+    __slots__ = ('writer', 'rows', 'cols', 'stale', 'sent', 'skipped')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = self.cols = 0
+        self.stale = True
+        self.sent = 0
+        self.skipped = 0
+
+
+class BroadcastServer:
+    """
+    Runs one simulation and streams it to any number of clients (--serve).
+    Each client sends the size of its terminal as a line of text,
+    "ROWS COLS", when it connects and whenever it is resized. The canvas is
+    kept as big as the largest client, and every client is sent the part of
+    each frame that fits its terminal, in the format written by Recorder,
+    preceded by the length of the frame as 4 bytes, big-endian. Clients of
+    the same size share the same encoded frame.
+
+    A slow client is never waited for: while more than max_backlog bytes
+    are still queued for it, it is skipped, and once it has caught up it is
+    sent a whole frame instead of the changes it missed.
+    """
+
+    max_backlog = 1 << 14
+    # Largest terminal a client may ask for
+    max_rows = 500
+    max_cols = 2000
+
+    def __init__(self, rows=24, cols=80):
+        self.buffer = FrameBuffer(rows, cols)
+        writer = Writer(self.buffer)
+        writer.clear(rows, cols)
+        self.engine = make_engine(writer, rows, cols)
+        self.colors = (start_color, start_bg)
+        self.clients = set()
+
+    async def handle(self, reader, writer):
+        """
+        Serves one client, for as long as it stays connected. Only reads
+        its size: frames are sent by broadcast().
+        """
+        import asyncio
+        import socket
+        # Keep the kernel from queueing much more than max_backlog either,
+        # so that a slow client is noticed before its frames are stale
+        writer.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, self.max_backlog)
+        client = RemoteClient(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                try:
+                    rows, cols = map(int, line.split())
+                except ValueError:
+                    # End of file, or not a size
+                    break
+                client.rows = min(max(rows, 1), self.max_rows)
+                client.cols = min(max(cols, 1), self.max_cols)
+                client.stale = True
+                self.clients.add(client)
+        except (ConnectionError, asyncio.CancelledError):
+            # Disconnected, or the server is shutting down
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
+
+    def fit(self):
+        """
+        Resizes the canvas to fit the largest client
+        """
+        rows = max(client.rows for client in self.clients)
+        cols = max(client.cols for client in self.clients)
+        if (rows, cols) != (self.buffer.rows, self.buffer.cols):
+            self.buffer.resize(rows, cols)
+            self.engine.resize(rows, cols)
+
+    def encode(self, runs, rows, cols, whole):
+        """
+        Encodes the runs that fit a client of rows x cols as one frame. A
+        whole frame starts with the client's size and the colors.
+        """
+        visible = []
+        for run in runs:
+            y, x, text, attr = run
+            if y < rows and x < cols:
+                if x + len(text) > cols:
+                    run = (y, x, text[:cols - x], attr)
+                visible.append(run)
+        out = bytearray(4)
+        if whole:
+            encode_frame(out, 0, visible, (rows, cols), self.colors)
+        else:
+            encode_frame(out, 0, visible)
+        out[:4] = (len(out) - 4).to_bytes(4, 'big')
+        return out
+
+    def broadcast(self):
+        """
+        Sends the changes since the last frame to every client that can
+        take them
+        """
+        runs = self.buffer.runs()
+        full_runs = None
+        frames = {}
+        for client in self.clients:
+            transport = client.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > self.max_backlog:
+                client.stale = True
+                client.skipped += 1
+                continue
+            key = (client.rows, client.cols, client.stale)
+            frame = frames.get(key)
+            if frame is None:
+                if client.stale:
+                    if full_runs is None:
+                        full_runs = self.buffer.full_runs()
+                    frame = self.encode(full_runs, client.rows, client.cols,
+                                        True)
+                else:
+                    frame = self.encode(runs, client.rows, client.cols,
+                                        False)
+                frames[key] = frame
+            client.writer.write(frame)
+            client.stale = False
+            client.sent += 1
+
+    async def run(self):
+        """
+        Steps the simulation and broadcasts a frame at the usual pace, for
+        as long as there are clients to send it to
+        """
+        import asyncio
+        scheduler = FrameScheduler(args.max_fps)
+        while True:
+            if not self.clients:
+                await asyncio.sleep(0.1)
+                continue
+            self.fit()
+            for _ in range(scheduler.due(start_delay)):
+                if not self.engine.step():
+                    return
+            self.broadcast()
+            await asyncio.sleep(scheduler.pause(start_delay))
+
+
+def serve(address):
+    """
+    Runs a BroadcastServer on address until interrupted
+    """
+    import asyncio
+    host, port, path = parse_address(address)
+    server = BroadcastServer()
+
+    async def run():
+        # Room for a whole wall of screens connecting at once
+        backlog = 1024
+        if path:
+            listener = await asyncio.start_unix_server(
+                server.handle, path, backlog=backlog)
+        else:
+            listener = await asyncio.start_server(
+                server.handle, host, port, backlog=backlog)
+        async with listener:
+            await server.run()
+
+    try:
+        asyncio.run(run())
+    finally:
+        if path and os.path.exists(path):
+            os.unlink(path)
+
+
+def connect(address):
+    """
+    Thin client for --connect: draws what a --serve server sends, without
+    running a simulation of its own. Space, q or ESC quits.
+    """
+    import select
+    import socket
+    host, port, path = parse_address(address)
+    if path:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(path)
+    else:
+        sock = socket.create_connection((host, port))
+    screen = AnsiScreen()
+    try:
+        resizes = ResizeWatcher(screen)
+        sock.sendall(b'%d %d\n' % screen.size)
+        data = bytearray()
+        while True:
+            ready = select.select([sock, screen.fd_in], [], [], 0.1)[0]
+            if sock in ready:
+                received = sock.recv(1 << 16)
+                if not received:
+                    return
+                data += received
+                pos = 0
+                while pos + 4 <= len(data):
+                    end = pos + 4 + int.from_bytes(data[pos:pos + 4], 'big')
+                    if end > len(data):
+                        break
+                    decode_frame(data, pos + 4, screen.encoder, screen.out,
+                                 *screen.size)
+                    pos = end
+                del data[:pos]
+                screen.refresh()
+            if screen.getch() in (ord(' '), ord('q'), 27):
+                return
+            size = resizes.check()
+            if size:
+                sock.sendall(b'%d %d\n' % size)
+    finally:
+        screen.close()
+        sock.close()
+
+
+class GlyphAtlas:
+    """
+    Glyphs for --export, rasterized once and kept: cell_width x
+    cell_height pixels, as rows of palette indices. Shapes are cached per
+    character. They are drawn with Pillow in the given TrueType font, or
+    its default font, when Pillow is installed, and as stand-in block
+    patterns otherwise. Colored glyphs are cached per character and cell
+    attribute.
+    """
+
+    # xterm's 16 colors: the 8 curses colors, then their bright versions
+    palette = bytes((0, 0, 0, 205, 0, 0, 0, 205, 0, 205, 205, 0,
+                     0, 0, 238, 205, 0, 205, 0, 205, 205, 229, 229, 229,
+                     127, 127, 127, 255, 0, 0, 0, 255, 0, 255, 255, 0,
+                     92, 92, 255, 255, 0, 255, 0, 255, 255, 255, 255, 255))
+
+    def __init__(self, fg, bg, font=None, font_size=16):
+        self.cell_height = font_size
+        self.cell_width = max(font_size // 2, 1)
+        # Palette indices for (foreground, background) of each attribute.
+        # Terminal default colors become white on black.
+        fg = 7 if fg < 0 else fg
+        bg = 0 if bg < 0 else bg
+        pairs = {0: (fg, bg), 1: (fg, bg), 2: (7, bg), 3: (0, 7)}
+        self.colors = []
+        for attr in range(ATTR_COUNT):
+            # Trail shades are drawn in the rain color
+            pair_fg, pair_bg = pairs.get(attr >> 1, (fg, bg))
+            self.colors.append((pair_fg | 8 if attr & BOLD else pair_fg,
+                                pair_bg))
+        self.font = None
+        try:
+            from PIL import ImageFont
+        except ImportError:
+            pass
+        else:
+            if font:
+                self.font = ImageFont.truetype(font, font_size)
+            else:
+                try:
+                    self.font = ImageFont.load_default(font_size)
+                except TypeError:
+                    # Pillow before 10.1 has only a small bitmap font
+                    self.font = ImageFont.load_default()
+        self.shapes = {}
+        self.glyphs = {}
+
+    def shape(self, character):
+        """
+        Returns the shape of a character: one byte per pixel, 1 where the
+        glyph is drawn
+        """
+        shape = self.shapes.get(character)
+        if shape is not None:
+            return shape
+        width = self.cell_width
+        height = self.cell_height
+        if character == ' ':
+            shape = bytes(width * height)
+        elif self.font is not None:
+            from PIL import Image, ImageDraw
+            image = Image.new('L', (width, height))
+            draw = ImageDraw.Draw(image)
+            try:
+                draw.text((width / 2, height / 2), character, fill=255,
+                          font=self.font, anchor='mm')
+            except ValueError:
+                # Bitmap fonts can't be anchored
+                draw.text((0, 0), character, fill=255, font=self.font)
+            shape = image.point(lambda value: value > 127).tobytes()
+        else:
+            # A 5 x 7 block pattern, mirrored like the glyphs it stands
+            # in for often are, and different for every character
+            bits = Random(ord(character)).getrandbits(21)
+            pattern = []
+            for row in range(7):
+                left = [bits >> (row * 3 + col) & 1 for col in range(3)]
+                pattern.append(left + left[1::-1])
+            shape = bytes(pattern[row * 7 // height][col * 5 // width]
+                          for row in range(height) for col in range(width))
+        self.shapes[character] = shape
+        return shape
+
+    def glyph(self, character, attr):
+        """
+        Returns a character in the colors of attr, as a list of rows of
+        palette indices
+        """
+        glyph = self.glyphs.get((character, attr))
+        if glyph is None:
+            fg, bg = self.colors[attr]
+            colored = self.shape(character).translate(
+                bytes((bg, fg)) + bytes(254))
+            width = self.cell_width
+            glyph = [colored[row:row + width]
+                     for row in range(0, len(colored), width)]
+            self.glyphs[(character, attr)] = glyph
+        return glyph
+
+
+def simulate(engine, grid, count):
+    """
+    Steps the engine count times (or until a single wave is over), yielding
+    the grid after every step. The same grid is yielded each time.
+    """
+    for _ in range(count):
+        if not engine.step():
+            return
+        yield grid
+
+
+def rasterize(grids, atlas):
+    """
+    Turns every grid into an image, yielded as a list of scanlines of
+    palette indices
+    """
+    glyph = atlas.glyph
+    cell_height = atlas.cell_height
+    for grid in grids:
+        chars = grid.chars
+        attrs = grid.attrs
+        cols = grid.cols
+        lines = []
+        for start in range(0, grid.rows * cols, cols):
+            row = [glyph(chars[i], attrs[i])
+                   for i in range(start, start + cols)]
+            for y in range(cell_height):
+                lines.append(b''.join([cell[y] for cell in row]))
+        yield lines
+
+
+def write_images(path, images, width, height, palette):
+    """
+    Writes every image to its own PNG or PPM file, numbered from 0. path
+    is either a pattern like 'rain%04d.png', or is numbered like
+    rain00000.png, rain00001.png, etc. Returns the number of images.
+    """
+    import struct
+    import zlib
+    if '%' not in path:
+        base, ext = os.path.splitext(path)
+        path = base + '%05d' + ext
+    png = path.lower().endswith('.png')
+    if png:
+        def chunk(tag, data):
+            return (struct.pack('>I', len(data)) + tag + data
+                    + struct.pack('>I', zlib.crc32(tag + data)))
+        header = (b'\x89PNG\r\n\x1a\n'
+                  + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                               8, 3, 0, 0, 0))
+                  + chunk(b'PLTE', palette))
+    else:
+        header = b'P6 %d %d 255\n' % (width, height)
+        reds, greens, blues = (bytes(palette[i::3]) + bytes(256 - 16)
+                               for i in range(3))
+    count = 0
+    for lines in images:
+        with open(path % count, 'wb') as f:
+            f.write(header)
+            if png:
+                # Filter type 0 for every scanline. Fast compression:
+                # exports are for speed, they can be optimized later.
+                data = b'\x00' + b'\x00'.join(lines)
+                f.write(chunk(b'IDAT', zlib.compress(data, 1)))
+                f.write(chunk(b'IEND', b''))
+            else:
+                data = b''.join(lines)
+                rgb = bytearray(len(data) * 3)
+                rgb[0::3] = data.translate(reds)
+                rgb[1::3] = data.translate(greens)
+                rgb[2::3] = data.translate(blues)
+                f.write(rgb)
+        count += 1
+    return count
+
+
+def lzw_encode(data, min_size):
+    """
+    Compresses data the way GIF does. Used when Pillow is not installed.
+    """
+    clear = 1 << min_size
+    out = bytearray()
+    bits = 0
+    bit_count = 0
+    size = min_size + 1
+    table = {bytes((i,)): i for i in range(clear)}
+    next_code = clear + 2
+    codes = [clear]
+    prefix = b''
+    for value in data:
+        extended = prefix + bytes((value,))
+        if extended in table:
+            prefix = extended
+            continue
+        codes.append(table[prefix])
+        if next_code < 4096:
+            table[extended] = next_code
+            next_code += 1
+        else:
+            codes.append(clear)
+            table = {bytes((i,)): i for i in range(clear)}
+            next_code = clear + 2
+        prefix = bytes((value,))
+    codes.append(table[prefix])
+    codes.append(clear + 1)
+
+    # Pack the codes, growing the code size as the decoder will
+    next_code = clear + 2
+    for code in codes:
+        bits |= code << bit_count
+        bit_count += size
+        while bit_count >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            bit_count -= 8
+        if code == clear:
+            size = min_size + 1
+            next_code = clear + 2
+        elif code != clear + 1:
+            if next_code == 1 << size and size < 12:
+                size += 1
+            next_code += 1
+    if bit_count:
+        out.append(bits & 0xff)
+    return out
+
+
+def write_gif(path, images, width, height, palette, delay):
+    """
+    Writes the images as an animated GIF that loops forever, one frame
+    every delay hundredths of a second. Frames are written as they come,
+    so memory use doesn't grow with the length of the animation. Returns
+    the number of frames.
+    """
+    import struct
+    try:
+        from PIL import Image, GifImagePlugin
+    except ImportError:
+        Image = None
+    count = 0
+    with open(path, 'wb') as f:
+        # Header, with a 16 color global palette
+        f.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xf3, 0, 0)
+                + palette)
+        # Loop forever
+        f.write(b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+        for lines in images:
+            data = b''.join(lines)
+            f.write(b'!\xf9\x04\x04' + struct.pack('<H', delay) + b'\x00\x00')
+            if Image is not None:
+                image = Image.frombytes('P', (width, height), data)
+                f.write(b''.join(GifImagePlugin.getdata(image)))
+            else:
+                f.write(b',' + struct.pack('<HHHHB', 0, 0, width, height, 0))
+                f.write(b'\x04')
+                compressed = lzw_encode(data, 4)
+                for start in range(0, len(compressed), 255):
+                    block = compressed[start:start + 255]
+                    f.write(bytes((len(block),)) + block)
+                f.write(b'\x00')
+            count += 1
+        f.write(b';')
+    return count
+
+
+def export(path, frames, rows, cols, font=None, font_size=16):
+    """
+    Renders frames of the rain headless, without a terminal, straight to
+    an animated GIF or to a numbered sequence of PNG or PPM images
+    (--export). Returns the number of frames written.
+    """
+    if not path.lower().endswith(('.gif', '.png', '.ppm')):
+        print("Can't export to '%s': use a .gif, .png or .ppm file name."
+              % path)
+        exit()
+    grid = Grid(rows, cols)
+    writer = Writer(grid)
+    writer.clear(rows, cols)
+    engine = make_engine(writer, rows, cols)
+    atlas = GlyphAtlas(start_color, start_bg, font, font_size)
+    width = cols * atlas.cell_width
+    height = rows * atlas.cell_height
+    images = rasterize(simulate(engine, grid, frames), atlas)
+    try:
+        if path.lower().endswith('.gif'):
+            # One frame per step, at the speed the rain would fall.
+            # Viewers slow down anything faster than 2/100 s.
+            delay = max(round(start_delay / 10), 2)
+            return write_gif(path, images, width, height, atlas.palette,
+                             delay)
+        return write_images(path, images, width, height, atlas.palette)
+    finally:
+        if hasattr(engine, 'close'):
+            engine.close()
+
+
+class ResizeWatcher:
+    """
+    Debounces terminal resizes. A drag-resize changes the size dozens of
+    times; a new size is only reported once it has held for `settle`
+    seconds, so the rain is reflowed once, at the end.
+    """
+
+    settle = 0.1
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.size = screen.getmaxyx()
+        self.changed = None
+
+    def check(self):
+        """
+        Returns the new (rows, cols) once the size has settled after a
+        change, otherwise None
+        """
+        size = self.screen.getmaxyx()
+        now = time.monotonic()
+        if size != self.size:
+            self.size = size
+            self.changed = now
+        elif self.changed is not None and now - self.changed >= self.settle:
+            self.changed = None
+            return size
+        return None
+
+
+class Status:
+    """
+    Displays a status message at top left when a setting is changed, in an
+    overlay of the FrameBuffer, so the rain carries on underneath.
+    """
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.overlay = screen.overlay(0, 0)
+        self.countdown = 0
+
+    def update(self, message, delay):
+        """
+        Writes new message to the status area
+        """
+        if not args.status_off:
+            self.screen.show(self.overlay, message.ljust(11))
+            # More frames for faster speeds:
+            self.countdown = (100 // (delay // 10 + 1)) + 2
+
+    def clear(self):
+        """
+        Hides the message when the countdown runs out, uncovering the rain
+        """
+        self.screen.hide(self.overlay)
+
+
+class Column:
+    """
+    Creates nodes (points that move down the screen) that are then stored in
+    canvas.nodes. Countdown timer determines time to spawn new node: the
+    number of steps from when it is set, as kept by the canvas.
+    """
+
+    __slots__ = ('drawing', 'x_coord', 'timer', 'async_speed')
+
+    def __init__(self, x_coord, row_count):
+        self.drawing = None  # None means not yet. Later will be True or False
+        self.x_coord = x_coord
+        self.timer = rng.randint(1, row_count)
+        self.async_speed = rng.randint(1, 3)
+        if args.single_wave:
+            # Speeds it up a bit
+            self.timer = int(0.6 * self.timer)
+
+    def spawn_node(self, canvas):
+        """
+        Creates nodes: points that move down the screen either writing or
+        erasing characters as they go down
+        """
+        if args.single_wave and self.drawing is False:
+            return
+
+        if canvas.thin and not self.drawing and self.x_coord % 4:
+            # Every other column stays dark while quality is lowered
+            self.timer = rng.randint(1, canvas.row_count)
+            return
+
+        self.drawing = not self.drawing
+
+        # Multiplier (mult) is for spawning slow-moving asynchronous nodes
+        # less frequently in order to maintain their length
+        if args.asynchronous:
+            mult = self.async_speed
+        else:
+            mult = 1
+
+        if self.drawing:
+            # "max_range" prevents crash with very small terminal height
+            max_range = max((3 * mult), ((canvas.row_count - 3) * mult))
+            self.timer = rng.randint(3 * mult, max_range)
+            if args.single_wave:
+                # A bit faster for single wave mode
+                self.timer = int(0.8 * self.timer)
+        else:
+            self.timer = rng.randint(1 * mult, canvas.row_count * mult)
+
+        x = self.x_coord
+        n_type = 'eraser'
+        async_speed = self.async_speed
+        white = False
+        if self.drawing:
+            n_type = 'writer'
+            if rng.randint(0, 2) == 0 and canvas.white_heads:
+                white = True
+
+        canvas.nodes.append(canvas.pool.acquire(x, n_type, async_speed, white))
+        canvas.speeds.append(async_speed)
+
+
+class Node:
+    """
+    A point that runs down the screen drawing or erasing characters.
+    n_type    -> 'writer' or 'eraser'
+    white     -> Bool. If True, a white char is written before the green one.
+    last_char -> Stores last character, since white characters have to be
+                     overwritten with the same one in green one.
+    expired   -> Bool. If True, node is marked for deletion
+    """
+
+    __slots__ = ('x_coord', 'y_coord', 'n_type', 'white', 'last_char',
+                 'expired', 'async_speed')
+
+    def __init__(self, x_coord, n_type, async_speed, white=False):
+        self.reset(x_coord, n_type, async_speed, white)
+
+    def reset(self, x_coord, n_type, async_speed, white=False):
+        """
+        (Re)initializes the node at the top of a column
+        """
+        self.x_coord = x_coord
+        self.y_coord = 0
+        self.n_type = n_type
+        self.white = white
+        self.last_char = None
+        self.expired = False
+        self.async_speed = async_speed
+
+
+class NodePool:
+    """
+    Free list of expired nodes. Nodes are handed back out instead of building
+    new ones, so once the rain has filled the screen, frames allocate no
+    nodes at all.
+    created -> Number of Node objects ever built
+    reused  -> Number of times a node was taken from the free list
+    """
+
+    __slots__ = ('free', 'created', 'reused')
+
+    def __init__(self):
+        self.free = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, x_coord, n_type, async_speed, white=False):
+        """
+        Returns a node ready to start at the top of a column
+        """
+        if self.free:
+            self.reused += 1
+            node = self.free.pop()
+            node.reset(x_coord, n_type, async_speed, white)
+            return node
+        self.created += 1
+        return Node(x_coord, n_type, async_speed, white)
+
+    def release(self, node):
+        """
+        Takes back an expired node
+        """
+        self.free.append(node)
+
+    def __len__(self):
+        """
+        Number of nodes waiting on the free list
+        """
+        return len(self.free)
+
+
+class Engine:
+    """
+    Runs the green rain simulation one frame at a time, drawing through a
+    Writer. Holds no reference to curses, so it works just as well against a
+    Grid with no terminal attached.
+    """
+
+    # For each value of the async clock, a table for bytes.translate() that
+    # maps a speed to 1 if nodes of that speed move on that step
+    async_due = [bytes(speed > 0 and clock % speed == 0
+                       for speed in range(256))
+                 for clock in range(6)]
+    # Chance of a writer leaving a flasher, by speed. An async writer only
+    # gets one try per move, so it gets the same chance as one try for each
+    # step it waits on the row.
+    flash_chance = (0, 0.1, 0.1, 0.1)
+    async_flash_chance = (0, 0.1, 1 - 0.9 ** 2, 1 - 0.9 ** 3)
+
+    def __init__(self, writer, rows, cols):
+        self.writer = writer
+        # Prevent single_wave mode from shutting down too early:
+        if args.single_wave:
+            self.wave_delay = 10
+        else:
+            self.wave_delay = 0
+        self.pool = NodePool()
+        self.canvas = None
+        # Set a rhythm for asynchronous movement
+        self.async_clock = 5
+        self.reflow_time = 0
+        # A FrameProfiler, when timing phases of the frame
+        self.profiler = None
+        self.quality = FULL_QUALITY
+        self.resize(rows, cols)
+
+    def set_quality(self, quality):
+        """
+        Trades looks for speed, for QualityGovernor. Below full quality, new
+        rain has no white heads, which are drawn twice. Below 2, only a
+        quarter of the flashers are allowed. Below 1, every other column
+        stops starting new rain.
+        """
+        self.quality = quality
+        self.canvas.white_heads = quality >= FULL_QUALITY
+        self.canvas.flashers.set_share(1 if quality >= 2 else 0.25)
+        self.canvas.thin = quality < 1
+
+    def resize(self, rows, cols):
+        """
+        Fits the simulation to a new screen size, keeping the rain that is
+        still on screen. Records how long it took in reflow_time.
+        """
+        start = time.perf_counter()
+        self.reflow(rows, cols)
+        self.reflow_time = time.perf_counter() - start
+
+    def node_count(self):
+        return len(self.canvas.nodes)
+
+    def flasher_count(self):
+        return len(self.canvas.flashers)
+
+    def reflow(self, rows, cols):
+        if self.canvas is None:
+            self.canvas = Canvas(rows, cols, self.pool)
+        else:
+            self.canvas.resize(rows, cols)
+
+    def step(self):
+        """
+        Advances the simulation by one frame. Returns False once single-wave
+        mode has finished, True otherwise.
+        """
+        canvas = self.canvas
+        writer = self.writer
+        async_clock = self.async_clock
+        nodes = canvas.nodes
+        release = self.pool.release
+        flashers = canvas.flashers
+        floats = rng.floats
+        # Set to 0 for expired nodes, once there are any
+        keep = None
+
+        profiler = self.profiler
+
+        # Spawn new nodes
+        canvas.spawn()
+        if profiler is not None:
+            profiler.mark('spawn')
+
+        if args.asynchronous:
+            # Only visit the nodes whose speed is due this step, still in the
+            # order they spawned in. Nodes that wait have nothing to do.
+            due = canvas.speeds.translate(self.async_due[async_clock])
+            moving = compress(range(len(nodes)), due)
+            flash_chance = self.async_flash_chance
+        else:
+            moving = range(len(nodes))
+            flash_chance = self.flash_chance
+
+        for i in moving:
+            node = nodes[i]
+
+            if node.n_type == 'writer':
+                if (args.flashers
+                        and next(floats) < flash_chance[node.async_speed]):
+                    flashers.add(node.y_coord, node.x_coord)
+            else:
+                # Even with flashers turned off, or they would be left
+                # behind to flash on empty screen when turned back on
+                flashers.discard(node.y_coord, node.x_coord)
+
+            writer.draw(node)
+            node.y_coord += 1
+
+            # Mark old nodes for deletion
+            if node.y_coord >= canvas.row_count:
+                if node.white:
+                    # Stop white nodes from staying 'stuck' on last row.
+                    # Creates a special green node with a last_char
+                    # attribute to overwrite last white node.
+                    node.white = False
+                    node.y_coord -= 1
+                else:
+                    if args.gradient and node.n_type == 'writer':
+                        writer.end_trail(node.x_coord, canvas.row_count)
+                    node.expired = True
+                    release(node)
+                    if keep is None:
+                        keep = bytearray(b'\x01') * len(nodes)
+                    keep[i] = 0
+        if profiler is not None:
+            profiler.mark('nodes')
+
+        # Drop expired nodes, in place and in order
+        if keep is not None:
+            nodes[:] = compress(nodes, keep)
+            canvas.speeds = bytearray(compress(canvas.speeds, keep))
+        if profiler is not None:
+            profiler.mark('compact')
+
+        if args.flashers:
+            flashers.redraw(writer.draw_flasher, args.flash_budget)
+            if profiler is not None:
+                profiler.mark('flashers')
+
+        if args.single_wave:
+            if len(canvas.nodes) == 0 and self.wave_delay < 0:
+                return False
+            self.wave_delay -= 1
+
+        # update async clock
+        if async_clock:
+            self.async_clock -= 1
+        else:
+            self.async_clock = 5
+
+        return True
+
+
+class ArrayEngine(Engine):
+    """
+    Engine that keeps its nodes in NumPy arrays, one array per node attribute,
+    and advances, expires and spawns them in batches. Draws the same rain as
+    Engine, but scales far better on very large screens.
+    Node arrays:
+    x, y      -> Position
+    is_writer -> Bool. False for erasers
+    white     -> Bool. Same as Node.white
+    speed     -> Async speed (1-3), copied from the column
+    last      -> Index in glyphs of the last character drawn, -1 for none
+    """
+
+    node_fields = ('x', 'y', 'is_writer', 'white', 'speed', 'last')
+
+    def __init__(self, writer, rows, cols, numpy):
+        self.np = numpy
+        self.rng = numpy.random.default_rng(args.seed)
+        self.rows = None
+        self.white_heads = True
+        self.thin = False
+        self.flash_share = 1
+        Engine.__init__(self, writer, rows, cols)
+
+    def set_quality(self, quality):
+        self.quality = quality
+        self.white_heads = quality >= FULL_QUALITY
+        self.flash_share = 1 if quality >= 2 else 0.25
+        self.flash_limit = int(self.rows * self.cols * args.flash_density
+                               * self.flash_share)
+        self.thin = quality < 1
+
+    def reflow(self, rows, cols):
+        """
+        Fits the arrays to a new screen size, dropping nodes and flashers
+        that are out of bounds and adding or trimming columns
+        """
+        if self.rows is None:
+            self.start(rows, cols)
+            return
+        np = self.np
+
+        keep = (self.x < cols) & (self.y < rows)
+        for name in self.node_fields:
+            setattr(self, name, getattr(self, name)[keep])
+
+        col_x = np.arange(0, cols, 2)
+        added = len(col_x) - len(self.col_x)
+        if added > 0:
+            timer, speed = self.new_columns(added, rows)
+            self.timer = np.concatenate((self.timer, timer))
+            self.col_speed = np.concatenate((self.col_speed, speed))
+            self.drawing = np.concatenate(
+                (self.drawing, np.full(added, -1, np.int8)))
+        else:
+            self.timer = self.timer[:len(col_x)]
+            self.col_speed = self.col_speed[:len(col_x)]
+            self.drawing = self.drawing[:len(col_x)]
+        self.col_x = col_x
+
+        flashers = np.zeros((rows, cols), bool)
+        height = min(rows, self.rows)
+        width = min(cols, self.cols)
+        flashers[:height, :width] = self.flashers[:height, :width]
+        self.flashers = flashers
+        self.flash_limit = int(rows * cols * args.flash_density
+                               * self.flash_share)
+        self.rows = rows
+        self.cols = cols
+
+    def node_count(self):
+        return len(self.x)
+
+    def flasher_count(self):
+        return int(self.flashers.sum())
+
+    def new_columns(self, count, rows):
+        """
+        Returns spawn timers and async speeds for count new columns
+        """
+        timer = self.rng.integers(1, rows, count, endpoint=True)
+        speed = self.rng.integers(1, 3, count, endpoint=True)
+        if args.single_wave:
+            # Speeds it up a bit
+            timer = (0.6 * timer).astype(int)
+        return timer, speed
+
+    def start(self, rows, cols):
+        """
+        Sets up empty arrays for a screen of the given size
+        """
+        np = self.np
+        self.rows = rows
+        self.cols = cols
+        # Eraser nodes draw the extra space at the end of the glyph list
+        self.glyphs = list(chars) + [' ']
+        self.space = len(chars)
+
+        # Columns
+        self.col_x = np.arange(0, cols, 2)
+        self.timer, self.col_speed = self.new_columns(len(self.col_x), rows)
+        # -1 means not yet, later 1 for drawing and 0 for erasing
+        self.drawing = np.full(len(self.col_x), -1, np.int8)
+
+        # Nodes
+        self.x = np.empty(0, int)
+        self.y = np.empty(0, int)
+        self.is_writer = np.empty(0, bool)
+        self.white = np.empty(0, bool)
+        self.speed = np.empty(0, int)
+        self.last = np.empty(0, int)
+
+        self.flashers = np.zeros((rows, cols), bool)
+        self.flash_limit = int(rows * cols * args.flash_density)
+        self.flash_phase = 0
+        # Where the next budgeted redraw starts, in each phase
+        self.flash_cursors = [0] * FlasherIndex.redraw_steps
+
+    def spawn_nodes(self):
+        """
+        Batched Column.spawn_node for every column whose timer is up
+        """
+        np = self.np
+        rows = self.rows
+        due = np.flatnonzero(self.timer == 0)
+        if args.single_wave:
+            due = due[self.drawing[due] != 0]
+        if self.thin:
+            # Every other column stays dark while quality is lowered
+            dark = (self.drawing[due] != 1) & (self.col_x[due] % 4 != 0)
+            self.timer[due[dark]] = self.rng.integers(1, rows, dark.sum(),
+                                                      endpoint=True)
+            due = due[~dark]
+        if len(due):
+            drawing = self.drawing[due] != 1
+            self.drawing[due] = drawing
+
+            # Multiplier (mult) is for spawning slow-moving asynchronous nodes
+            # less frequently in order to maintain their length
+            if args.asynchronous:
+                mult = self.col_speed[due]
+            else:
+                mult = np.ones(len(due), int)
+            low = np.where(drawing, 3 * mult, mult)
+            high = np.where(drawing, np.maximum(3 * mult, (rows - 3) * mult),
+                            rows * mult)
+            timers = self.rng.integers(low, high, endpoint=True)
+            if args.single_wave:
+                # A bit faster for single wave mode
+                timers = np.where(drawing, (0.8 * timers).astype(int), timers)
+            self.timer[due] = timers
+
+            white = drawing & (self.rng.integers(0, 3, len(due)) == 0)
+            white &= self.white_heads
+            self.x = np.concatenate((self.x, self.col_x[due]))
+            self.y = np.concatenate((self.y, np.zeros(len(due), int)))
+            self.is_writer = np.concatenate((self.is_writer, drawing))
+            self.white = np.concatenate((self.white, white))
+            self.speed = np.concatenate((self.speed, self.col_speed[due]))
+            self.last = np.concatenate((self.last, np.full(len(due), -1)))
+        self.timer -= 1
+
+    def bold_bits(self, count):
+        """
+        Vectorized Writer.get_attr for nodes that aren't white heads
+        """
+        if args.no_bold:
+            return self.np.zeros(count, int)
+        elif args.all_bold:
+            return self.np.ones(count, int)
+        return self.rng.integers(0, 2, count)
+
+    def step(self):
+        """
+        Advances the simulation by one frame. Returns False once single-wave
+        mode has finished, True otherwise.
+        """
+        np = self.np
+        async_clock = self.async_clock
+        profiler = self.profiler
+
+        self.spawn_nodes()
+        if profiler is not None:
+            profiler.mark('spawn')
+
+        if args.flashers and len(self.x):
+            add = self.is_writer & (self.rng.integers(0, 10, len(self.x)) == 0)
+            room = self.flash_limit - self.flashers.sum()
+            add = np.flatnonzero(add)[:max(room, 0)]
+            self.flashers[self.y[add], self.x[add]] = True
+        if len(self.x):
+            # Even with flashers turned off, like Engine.step
+            erase = ~self.is_writer
+            self.flashers[self.y[erase], self.x[erase]] = False
+
+        if args.asynchronous:
+            moving = np.flatnonzero(async_clock % self.speed == 0)
+        else:
+            moving = np.arange(len(self.x))
+
+        if len(moving):
+            y = self.y[moving]
+            x = self.x[moving]
+            white = self.white[moving]
+            last = self.last[moving]
+            glyph = np.where(
+                self.is_writer[moving],
+                np.where(~white & (last >= 0), last,
+                         self.rng.integers(0, self.space, len(moving))),
+                self.space)
+            bold = np.where(white, int(not args.no_bold),
+                            self.bold_bits(len(moving)))
+            color = RAIN
+            if args.gradient:
+                color = np.where(self.is_writer[moving], TRAIL, RAIN)
+            attr = np.where(white, HEAD, color) | bold
+            self.writer.draw_cells(y, x, glyph, attr, self.glyphs)
+
+            # White heads also overwrite the last white character in green
+            above = np.flatnonzero(white & (last >= 0))
+            if len(above):
+                color = TRAIL + 2 if args.gradient else RAIN
+                self.writer.draw_cells(y[above] - 1, x[above], last[above],
+                                       color | self.bold_bits(len(above)),
+                                       self.glyphs, low=True)
+            if args.gradient:
+                writers = np.flatnonzero(self.is_writer[moving])
+                self.writer.fade_cells(y[writers], x[writers])
+            self.last[moving[white]] = glyph[white]
+            self.y[moving] += 1
+        if profiler is not None:
+            profiler.mark('nodes')
+
+        # Mark old nodes for deletion
+        off = self.y >= self.rows
+        if off.any():
+            # Stop white nodes from staying 'stuck' on last row
+            stuck = off & self.white
+            if args.gradient:
+                for x in self.x[off & ~stuck & self.is_writer].tolist():
+                    self.writer.end_trail(x, self.rows)
+            self.white[stuck] = False
+            self.y[stuck] -= 1
+            keep = ~off | stuck
+            for name in self.node_fields:
+                setattr(self, name, getattr(self, name)[keep])
+        if profiler is not None:
+            profiler.mark('compact')
+
+        if args.flashers:
+            # Redraw a third of the rows each step, like FlasherIndex, and
+            # never more than --flash-budget cells, carrying on next time
+            # from where this one stopped
+            phase = self.flash_phase
+            self.flash_phase = (phase + 1) % FlasherIndex.redraw_steps
+            y, x = np.nonzero(
+                self.flashers[phase::FlasherIndex.redraw_steps])
+            y = y * FlasherIndex.redraw_steps + phase
+            if args.flash_budget and len(y) > args.flash_budget:
+                start = self.flash_cursors[phase] % len(y)
+                pick = (start + np.arange(args.flash_budget)) % len(y)
+                self.flash_cursors[phase] = start + args.flash_budget
+                y = y[pick]
+                x = x[pick]
+            self.writer.draw_cells(
+                y, x, self.rng.integers(0, self.space, len(y)),
+                RAIN | self.rng.integers(0, 2, len(y)), self.glyphs,
+                low=True)
+            if profiler is not None:
+                profiler.mark('flashers')
+
+        if args.single_wave:
+            if len(self.x) == 0 and self.wave_delay < 0:
+                return False
+            self.wave_delay -= 1
+
+        # update async clock
+        if async_clock:
+            self.async_clock -= 1
+        else:
+            self.async_clock = 5
+
+        return True
+
+
+class ShardGrid:
+    """
+    What a --workers shard draws on: its slice of the canvas, kept in memory
+    shared with the main process, and the list of cells changed since the
+    main process last collected them.
+    chars   -> Code point of every cell
+    attrs   -> Attribute of every cell
+    changed -> Indices of changed cells, each listed once
+    """
+
+    def __init__(self, memory, rows, cols):
+        size = rows * cols
+        self.rows = rows
+        self.cols = cols
+        self.memory = memoryview(memory)
+        self.chars = self.memory[:4 * size].cast('I')
+        self.attrs = self.memory[4 * size:5 * size]
+        self.changed = self.memory[5 * size:9 * size].cast('I')
+        self.count = 0
+        # Generation in which each cell was last listed as changed
+        self.listed = [0] * size
+        self.generation = 1
+
+    @staticmethod
+    def memory_size(rows, cols):
+        return 9 * rows * cols
+
+    def fill(self, target, x):
+        """
+        Copies its slice, starting at column x, from the target grid, so
+        that cells the worker recolors before writing them keep what is on
+        screen
+        """
+        chars = self.chars
+        attrs = self.attrs
+        width = target.cols
+        i = 0
+        for y in range(self.rows):
+            j = y * width + x
+            for character in target.chars[j:j + self.cols]:
+                chars[i] = ord(character)
+                i += 1
+            attrs[i - self.cols:i] = bytes(target.attrs[j:j + self.cols])
+
+    def put(self, y, x, text, attr):
+        if not 0 <= y < self.rows or x < 0:
+            return
+        i = y * self.cols + x
+        listed = self.listed
+        generation = self.generation
+        for character in text[:self.cols - x]:
+            self.chars[i] = ord(character)
+            self.attrs[i] = attr
+            if listed[i] != generation:
+                listed[i] = generation
+                self.changed[self.count] = i
+                self.count += 1
+            i += 1
+
+    # The FrameBuffer can't tell which cells from a shard could have waited
+    put_low = put
+
+    def recolor(self, y, x, attr):
+        if 0 <= y < self.rows and 0 <= x < self.cols:
+            i = y * self.cols + x
+            if self.chars[i] != 32:
+                self.attrs[i] = attr | self.attrs[i] & BOLD
+                if self.listed[i] != self.generation:
+                    self.listed[i] = self.generation
+                    self.changed[self.count] = i
+                    self.count += 1
+
+    def collect(self):
+        """
+        Returns the number of changed cells, and starts a new list
+        """
+        count = self.count
+        self.count = 0
+        self.generation += 1
+        return count
+
+    def release(self):
+        for view in (self.chars, self.attrs, self.changed, self.memory):
+            view.release()
+
+
+def shard_worker(conn, memory, rows, cols, seed, state=None):
+    """
+    Body of a --workers process. Runs a plain Engine on its slice of the
+    canvas, one step per message from the main process. A message holds the
+    settings the keyboard can change; 'state' asks for the simulation
+    instead, to carry it over a resize, and None means stop. The engine
+    starts from state if given: (canvas, async_clock, wave_delay).
+    """
+    global rng
+    # Ctrl-C reaches the whole process group; the main process stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    rng = RandomStream(seed)
+    grid = ShardGrid(memory, rows, cols)
+    engine = Engine(Writer(grid), rows, cols)
+    if state is not None:
+        engine.canvas, engine.async_clock, engine.wave_delay = state
+        engine.pool = engine.canvas.pool
+    parent = os.getppid()
+    try:
+        while True:
+            if not conn.poll(1):
+                # Other workers hold copies of the pipe, so it doesn't
+                # close if the main process is killed; check for that
+                if os.getppid() != parent:
+                    break
+                continue
+            settings = conn.recv()
+            if settings is None:
+                break
+            if settings == 'state':
+                conn.send((engine.canvas, engine.async_clock,
+                           engine.wave_delay))
+                continue
+            (args.asynchronous, args.flashers, args.all_bold,
+             args.no_bold, quality) = settings
+            if quality != engine.quality:
+                engine.set_quality(quality)
+            running = engine.step()
+            conn.send((running, grid.collect(), engine.node_count(),
+                       engine.flasher_count()))
+    finally:
+        grid.release()
+
 
-  Use the letters from the name of your favorite operating system in bold blue:
-    $ unimatrix -b -u Linux -c blue
+class Shard:
+    """
+    The main process's end of a --workers process: its slice of the canvas,
+    starting at column x, and the pipe to talk to it. The worker starts
+    from state if given, as for shard_worker().
+    """
 
-  Use default character set, plus dollar symbol (note single quotes around
-      special character):
-    $ unimatrix -l knnssssu -u '$'
+    def __init__(self, context, x, rows, cols, seed, state=None):
+        import mmap
+        self.x = x
+        self.rows = rows
+        self.cols = cols
+        self.running = True
+        self.nodes = self.flashers = 0
+        # Anonymous shared memory, inherited by the forked worker
+        self.memory = mmap.mmap(-1, ShardGrid.memory_size(rows, cols))
+        self.grid = ShardGrid(self.memory, rows, cols)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=shard_worker,
+            args=(child_conn, self.memory, rows, cols, seed, state),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
 
-  No bold characters, slowly, using emojis, numbers and a few symbols:
-    $ unimatrix -n -l ens -s 50
-'''
+    def state(self):
+        """
+        Returns the worker's simulation: (canvas, async_clock, wave_delay)
+        """
+        self.conn.send('state')
+        return self.conn.recv()
 
-### Set up parser and apply arguments settings
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.grid.release()
+        self.memory.close()
 
-parser = argparse.ArgumentParser(add_help=False)
-
-parser.add_argument('-a', '--asynchronous',
-                    action='store_true',
-                    help='use asynchronous scrolling')
-parser.add_argument('-b', '--all-bold',
-                    action='store_true',
-                    help='use all bold characters')
-parser.add_argument('-c', '--color',
-                    default='green',
-                    help='one of: green (default), red, blue, white, yellow, \
-                          cyan, magenta, black',
-                    type=str)
-parser.add_argument('-f', '--flashers',
-                    action='store_true',
-                    help='some characters will continuously change in place')
-parser.add_argument('-g', '--bg-color',
-                    default='default',
-                    help='background color (see -c)',
-                    type=str)
-parser.add_argument('-h', '--help',
-                    help='display extended usage information and exit.',
-                    action='store_true')
-parser.add_argument('-i', '--ignore-keyboard',
-                    help='ignore all keyboard input.',
-                    action='store_true')
-parser.add_argument('-l', '--character-list',
-                    help='character set. See details below',
-                    type=str)
-parser.add_argument('-n', '--no-bold',
-                    action='store_true',
-                    help='do not use bold characters')
-parser.add_argument('-o', '--status-off',
-                    action='store_true',
-                    help='Disable on-screen status')
-parser.add_argument('-s', '--speed',
-                    help='speed, integer up to 100. Default=85',
-                    default=85,
-                    type=int)
-parser.add_argument('-t', '--time',
-                    help='time. See details below',
-                    type=int)
-parser.add_argument('-u', '--custom-characters',
-                    help='your own string of characters to display',
-                    default='',
-                    type=str)
-parser.add_argument('-w', '--single-wave',
-                    help='runs a single "wave" of green rain then exits',
-                    action='store_true')
-
-args = parser.parse_args()
-
-if args.help:
-    print(help_msg)
-    exit()
 
-char_set = {
+class ShardedEngine:
+    """
+    Engine for very wide screens (--workers N). Columns don't depend on each
+    other, so the canvas is cut into N slices of whole columns, each stepped
+    by a plain Engine in its own process. Workers draw into shared memory
+    and list the cells they changed; the main process only copies those
+    cells into the frame buffer and does the output. Workers are forked, so
+    this needs a POSIX system.
 
-    'a': 'qwertyuiopasdfghjklzxcvbnm',
-    'A': 'QWERTYUIOPASDFGHJKLZXCVBNM',
-    'b': 'ⰰⰱⰲⰳⰴⰼⰵⰶⰷⰸⱚⰺⰻⰽⰾⰿⱞⱀⱁⱂⱃⱄⱅⱛⱆⱇⱈⱉⱋⱌⱍⱎⱏⱜⰹⱐⱓⱑⱔⱕⱗⱘⱙⱊⱝⱒⱖ',
-    'B': 'ⰀⰁⰂⰃⰄⰌⰅⰆⰇⰈⰪⰊⰋⰍⰎⰏⰮⰐⰑⰒⰓⰔⰕⰫⰖⰗⰘⰙⰛⰜⰝⰞⰟⰬⰉⰠⰣⰡⰤⰥⰧⰨⰩⰚⰭⰢⰦ',
-    'c': 'абвгдежзиклмнопрстуфхцчшщъыьэюя',
-    'C': 'АБВГДЕЖЗИКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ',
-    'e': '☺☻✌♡♥❤⚘❀❃❁✼☀✌♫♪☃❄❅❆☕☂★',
-    'g': 'αβγδεζηθικλμνξοπρστυφχψως',
-    'G': 'ΑΒΓΔΕΖΗΘΙΚΛΜΝΞΟΠΡΣΤΥΦΧΨΩ',
-    'k': 'ｦｧｨｩｪｫｬｭｮｯｰｱｲｳｴｵｶｷｸｹｺｻｼｽｾｿﾀﾁﾂﾃﾄﾅﾆﾇﾈﾉﾊﾋﾌﾍﾎﾏﾐﾑﾒﾓﾔﾕﾖﾗﾘﾙﾚﾛﾜﾝ',
-    'm': 'ｦｧｨｩｪｫｬｭｮｯｰｱｲｳｴｵｶｷｸｹｺｻｼｽｾｿﾀﾁﾂﾃﾄﾅﾆﾇﾈﾉﾊﾋﾌﾍﾎﾏﾐﾑﾒﾓﾔﾕﾖﾗﾘﾙﾚﾛﾜﾝ1234567890'
-         '1234567890-=*_+|:<>"-=*_+|:<>"-=*_+|:<>"-=*_+|:<>"',
-    'n': '1234567890',
-    'o': 'qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM1234567890'
-         r'`-=~!@#$%^&*()_+[]{}|\;\':",./<>?"',
-    'p': '',
-    'P': '',
-    'r': 'mcclllxxxxvvvvviiiiii',
-    'R': 'MCCLLLXXXXVVVVVIIIIII',
-    's': '-=*_+|:<>"',
-    'S': r'`-=~!@#$%^&*()_+[]{}|\;\':",./<>?"',
-    'u': args.custom_characters}
+    A resize collects the simulation from every worker and starts new
+    workers on the new slices, each with the columns, nodes and flashers
+    that fall in it, so the rain carries on as it does with Engine.resize.
+    """
 
-colors_str = {
-    'green': curses.COLOR_GREEN,
-    'red': curses.COLOR_RED,
-    'blue': curses.COLOR_BLUE,
-    'white': curses.COLOR_WHITE,
-    'yellow': curses.COLOR_YELLOW,
-    'cyan': curses.COLOR_CYAN,
-    'magenta': curses.COLOR_MAGENTA,
-    'black': curses.COLOR_BLACK,
-    'default': -1}
+    def __init__(self, writer, rows, cols, workers):
+        import multiprocessing
+        self.context = multiprocessing.get_context('fork')
+        self.writer = writer
+        self.workers = workers
+        self.shards = []
+        self.reflow_time = 0
+        self.profiler = None
+        self.quality = FULL_QUALITY
+        # Seeds for the workers: different for each, but repeatable
+        self.seeds = 0
+        self.resize(rows, cols)
+
+    def resize(self, rows, cols):
+        start = time.perf_counter()
+        parts = [(shard.x, shard.cols, shard.state()) for shard in self.shards]
+        self.close()
+        width = -(-cols // (2 * self.workers)) * 2
+        for x in range(0, cols, width):
+            seed = None
+            if args.seed is not None:
+                seed = '%d/%d' % (args.seed, self.seeds)
+            self.seeds += 1
+            end = min(x + width, cols)
+            state = None
+            if parts:
+                state = self.remap(parts, x, end, rows)
+            shard = Shard(self.context, x, rows, end - x, seed, state)
+            shard.grid.fill(self.writer.target, x)
+            self.shards.append(shard)
+        self.reflow_time = time.perf_counter() - start
+
+    @staticmethod
+    def remap(parts, start, end, rows):
+        """
+        Builds the state of a new slice, from column start up to end, out
+        of the old slices, given as (x, cols, state). Rain beyond the new
+        size is dropped and new columns start empty, as in Canvas.resize.
+        """
+        first, async_clock, wave_delay = parts[0][2]
+        old_cols = max(x + cols for x, cols, _ in parts)
+        covered = max(min(end, old_cols) - start, 0)
+        canvas = Canvas(first.row_count, 0)
+        canvas.clock = first.clock
+        canvas.col_count = covered
+        canvas.flashers.columns = [None] * covered
+        canvas.flashers.share = first.flashers.share
+        canvas.white_heads = first.white_heads
+        canvas.thin = first.thin
+        for x, cols, (part, _, _) in parts:
+            if x < end and start < x + cols:
+                canvas.take(part, max(start - x, 0), min(end - x, cols),
+                            x - start)
+        canvas.resize(rows, end - start)
+        return canvas, async_clock, wave_delay
 
-start_color = colors_str[args.color]
-start_bg = colors_str[args.bg_color]
+    def close(self):
+        for shard in self.shards:
+            shard.stop()
+        self.shards = []
 
-speed = args.speed
-start_delay = (100 - speed) * 10
+    def set_quality(self, quality):
+        # Passed on to the workers with the next step
+        self.quality = quality
 
-runtime = None
+    def node_count(self):
+        return sum(shard.nodes for shard in self.shards)
 
-if args.time:
-    runtime = args.time
+    def flasher_count(self):
+        return sum(shard.flashers for shard in self.shards)
 
-# "-l" option has been used
-if args.character_list:
-    chars = ''
-    for letter in args.character_list:
+    def step(self):
+        """
+        Steps every slice at once, then copies the cells they changed into
+        the frame. Returns False once single-wave mode has finished
+        everywhere.
+        """
+        settings = (args.asynchronous, args.flashers, args.all_bold,
+                    args.no_bold, self.quality)
+        shards = [shard for shard in self.shards if shard.running]
+        for shard in shards:
+            shard.conn.send(settings)
+        target = self.writer.target
+        for shard in shards:
+            shard.running, count, shard.nodes, shard.flashers = \
+                shard.conn.recv()
+            grid = shard.grid
+            target.copy_cells(shard.x, shard.cols, grid.changed[:count],
+                              grid.chars, grid.attrs)
+        if self.profiler is not None:
+            self.profiler.mark('nodes')
+        return any(shard.running for shard in self.shards)
+
+
+def make_engine(writer, rows, cols):
+    """
+    Returns a ShardedEngine if --workers was given and processes can be
+    forked, an ArrayEngine if --numpy was given and NumPy can be imported,
+    otherwise a plain Engine.
+    """
+    if args.workers > 1 and hasattr(os, 'fork'):
+        return ShardedEngine(writer, rows, cols, args.workers)
+    if args.numpy:
         try:
-            chars += char_set[letter]
-        except KeyError:
-            print("Letter '%s' does not represent a valid character list."
-                  % letter)
-            exit()
+            import numpy
+        except ImportError:
+            pass
+        else:
+            return ArrayEngine(writer, rows, cols, numpy)
+    return Engine(writer, rows, cols)
 
-# "-l" not used, but "-u" is set
-elif args.custom_characters:
-    chars = args.custom_characters
 
-# Neither "-l" nor "-u" has been set, use default characters
-else:
-    chars = char_set['m']
+class FrameScheduler:
+    """
+    Keeps the rain on a fixed timestep: one simulation step every `delay`
+    milliseconds, counted from when the last step was due rather than from
+    when the last frame was done, so the time spent drawing doesn't slow the
+    rain down. Frames are drawn at most max_fps times a second, with several
+    steps per frame when steps come faster than that. When the process falls
+    too far behind (slow SSH, SIGSTOP), missed steps are dropped instead of
+    being replayed.
+    """
 
-if args.no_bold:
-    args.all_bold = False
+    # Shortest timestep, used at speed 100 instead of spinning the CPU
+    min_period = 0.005
+    # Falling further behind than this drops steps
+    max_lag = 0.25
+    # Longest sleep while paused, so that PowerSaver can check on tmux
+    idle_pause = 1
 
-chars_len = len(chars) - 1
+    def __init__(self, max_fps):
+        self.render_period = 1 / max_fps
+        self.last_step = self.last_render = time.monotonic()
+        # The first frame gets its step straight away, so rain shows up
+        # without waiting one timestep on a blank screen
+        self.started = False
+        self.dropped = 0
+        # Frames per second while nobody is watching, None when someone is
+        self.idle_fps = None
 
+    def period(self, delay):
+        """
+        Seconds per simulation step at the given delay
+        """
+        return max(delay / 1000, self.min_period)
 
-### Classes
+    def set_idle(self, fps):
+        """
+        Slows frames down to fps while nobody is watching, or back to normal
+        with None. The rain then carries on from now, rather than running
+        all the steps it missed.
+        """
+        if fps is None and self.idle_fps is not None:
+            self.last_step = time.monotonic()
+        self.idle_fps = fps
 
-class Canvas:
+    def frame_period(self, delay):
+        """
+        Seconds between frames at the given delay
+        """
+        return max(self.period(delay), self.render_period)
+
+    def due(self, delay):
+        """
+        Returns the number of simulation steps due to run before this frame
+        is drawn
+        """
+        now = time.monotonic()
+        if not self.started:
+            self.started = True
+            self.last_step = self.last_render = now
+            return 1
+        if self.idle_fps is not None:
+            # One step per idle frame, with nothing left to catch up on
+            if not self.idle_fps or now - self.last_render < 1 / self.idle_fps:
+                return 0
+            self.last_step = self.last_render = now
+            return 1
+        period = self.period(delay)
+        steps = int((now - self.last_step) / period)
+        max_steps = max(1, int(self.max_lag / period))
+        if steps > max_steps:
+            self.dropped += steps - max_steps
+            steps = max_steps
+            self.last_step = now
+        else:
+            self.last_step += steps * period
+        self.last_render = now
+        return steps
+
+    def pause(self, delay):
+        """
+        Returns the seconds left until the next frame is due
+        """
+        if self.idle_fps is not None:
+            if not self.idle_fps:
+                return self.idle_pause
+            return max(self.last_render + 1 / self.idle_fps
+                       - time.monotonic(), 0)
+        wake = max(self.last_step + self.period(delay),
+                   self.last_render + self.render_period)
+        return max(wake - time.monotonic(), 0)
+
+    def wait(self, delay, selector=None):
+        """
+        Sleeps until the next frame is due. Given a selector, wakes up as
+        soon as there is input instead, so that keys are handled right away
+        even when the rain is slow, but never sooner than max_fps allows.
+        """
+        if selector is not None:
+            soonest = self.last_render + self.render_period - time.monotonic()
+            if soonest > 0:
+                time.sleep(soonest)
+            pause = self.pause(delay)
+            if pause > 0:
+                selector.select(pause)
+            return
+        pause = self.pause(delay)
+        if pause > 0:
+            time.sleep(pause)
+
+
+class OutputThread:
     """
-    Represents the whole screen and stores its height and width. Gets
-    overwritten whenever the screen resizes. Serves as a container for columns.
+    Sends frames to the terminal from a thread of its own, for --pipeline.
+    The main loop works out the next frame while the last one is still being
+    written, which matters when the terminal reads slowly (SSH, serial
+    lines). Frames wait in a queue of at most `depth`. When the queue is
+    full, the main loop hands nothing over that frame: its changes stay in
+    the FrameBuffer and go out with the next one, so a slow terminal gets
+    fewer, bigger frames instead of falling further and further behind.
+    curses keeps Python's interpreter lock while it writes, so nothing
+    overlaps with a Screen; frames are still merged rather than waited for.
+    lock    -> Held by whichever thread is using the screen. The output
+               thread only takes it for screens that can't be used from two
+               threads at once (curses).
+    frames  -> Frames sent
+    dropped -> Frames merged into a later one
+    work    -> Seconds the main loop spent working out frames
+    overlap -> Seconds of that work done while a frame was being sent
     """
 
+    depth = 2
+
     def __init__(self, screen):
-        screen.clear()
-        rows, cols = screen.getmaxyx()
-        self.col_count = cols
-        self.row_count = rows
-        self.size_changed = False
-        self.columns = []
-        for col in range(0, cols, 2):
-            self.columns.append(Column(col, self.row_count))
-        self.nodes = []
-        self.flashers = set()
+        import queue
+        import threading
+        self.screen = screen
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(self.depth)
+        self.stop = object()
+        self.error = None
+        self.frames = self.dropped = self.bytes = 0
+        self.work = self.overlap = 0.0
+        self.started = time.perf_counter()
+        # Seconds spent sending, and when the frame being sent was started,
+        # replaced as one so that the main loop always sees a matching pair
+        self.sending = (0.0, None)
+        self.work_started = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        screen = self.screen
+        if screen.single_threaded:
+            lock = self.lock
+        else:
+            from contextlib import nullcontext
+            lock = nullcontext()
+        while True:
+            frame = self.queue.get()
+            if frame is self.stop:
+                return
+            start = time.perf_counter()
+            self.sending = (self.sending[0], start)
+            try:
+                with lock:
+                    screen.send(frame)
+            except Exception as error:
+                # Raised again in the main loop by hand_over()
+                self.error = error
+                return
+            finally:
+                self.sending = (self.sending[0] + time.perf_counter() - start,
+                                None)
+            self.frames += 1
+            if screen.frame_bytes is not None:
+                self.bytes += screen.frame_bytes
+
+    def busy(self):
+        """
+        Returns the seconds spent sending so far, counting the frame being
+        sent up to now
+        """
+        busy, since = self.sending
+        if since is not None:
+            busy += time.perf_counter() - since
+        return busy
+
+    def start_work(self):
+        """
+        Called by the main loop when it starts working out a frame
+        """
+        self.work_started = (time.perf_counter(), self.busy())
+
+    def end_work(self):
+        """
+        Called by the main loop once the frame is handed over (or merged)
+        """
+        started, busy = self.work_started
+        self.work += time.perf_counter() - started
+        self.overlap += self.busy() - busy
+
+    def hand_over(self, buffer, limit=None):
+        """
+        Flushes the buffer to the screen, with the byte limit if any, and
+        queues the frame. Returns False,
+        leaving the changes in the buffer for a later frame, if the queue is
+        full or the screen is busy sending.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.queue.full() or not self.lock.acquire(blocking=False):
+            self.dropped += 1
+            return False
+        try:
+            self.screen.flush(buffer, limit)
+        finally:
+            self.lock.release()
+        self.queue.put(self.screen.take_frame())
+        return True
 
-        # Draw a background
-        for x in range(self.row_count):
+    def get_keys(self, key):
+        """
+        Handles key presses, unless a frame is being sent through a screen
+        that can't be shared: then they wait for the next frame, rather
+        than the main loop waiting for the terminal
+        """
+        if self.lock.acquire(blocking=False):
             try:
-                screen.addstr(x, 0, ' ' * self.col_count, curses.color_pair(1))
-            except curses.error:
+                key.get()
+            finally:
+                self.lock.release()
+
+    def close(self):
+        """
+        Stops the thread once it has sent the frame it is on. Frames still
+        waiting are thrown away, as the screen is about to be put back.
+        """
+        import queue
+        if self.thread.is_alive():
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
                 pass
+            self.queue.put(self.stop)
+            self.thread.join()
 
+    def report(self):
+        """
+        Returns a line on the frames sent, how much the work overlapped
+        sending them, and how busy the output was
+        """
+        seconds = time.perf_counter() - self.started
+        line = 'unimatrix: sent %d frames in %.0fs (%.1f/s' % (
+            self.frames, seconds, self.frames / seconds)
+        if self.bytes:
+            line += ', %.0f bytes/s' % (self.bytes / seconds)
+        line += '), %d merged into later ones; ' % self.dropped
+        line += '%.0f%% of the work overlapped output, ' % (
+            100 * self.overlap / self.work if self.work else 0)
+        line += 'which was busy %.0f%% of the time' % (
+            100 * self.busy() / seconds)
+        return line
 
-class Status:
+
+class FrameProfiler:
     """
-    Displays a status message at top left when a setting is changed.
+    Times the phases of every frame. The main loop and the engine call
+    mark(phase) at the end of each phase; the time since the previous mark
+    goes to that phase. Nothing calls it unless --stats or --stats-file is
+    given, so it costs nothing otherwise.
+    times  -> Seconds spent in each phase during the current frame
+    record -> Everything measured for the last finished frame
     """
 
-    def __init__(self, screen):
-        curses.init_pair(3, curses.COLOR_BLACK, curses.COLOR_WHITE)
-        self.screen = screen
-        self.countdown = 0
-        self.last_message = ''
+    phases = ('keys', 'spawn', 'nodes', 'flashers', 'compact', 'status',
+              'output')
 
-    def update(self, message, delay):
+    def __init__(self, path=None):
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.last = time.perf_counter()
+        self.frame = 0
+        self.record = None
+        # Smoothed frame time, for the overlay
+        self.average = 0.0
+        self.file = open(path, 'w', buffering=1) if path else None
+
+    def start(self):
         """
-        Writes new message to the status area
+        Starts timing a new frame
         """
-        if not args.status_off:
-            message_str = message.ljust(11)
-            self.screen.addstr(0, 0, message_str, curses.color_pair(3))
-            self.last_message = message_str
-            # More frames for faster speeds:
-            self.countdown = (100 // (delay // 10 + 1)) + 2
+        self.last = time.perf_counter()
 
-    def refresh(self):
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.times[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self, steps, engine, buffer, screen, flushed=True):
         """
-        Used to keep refreshing status message until countdown runs out
+        Wraps up the frame: builds its record, writes it out and resets the
+        phase times. flushed is False for a frame that sent nothing, its
+        changes left for a later one.
         """
-        message_str = self.last_message
-        self.screen.addstr(0, 0, message_str, curses.color_pair(3))
+        total = sum(self.times.values())
+        self.average += (total - self.average) / 10
+        self.record = {
+            'frame': self.frame,
+            'steps': steps,
+            'ms': {phase: round(1000 * t, 4)
+                   for phase, t in self.times.items()},
+            'total_ms': round(1000 * total, 4),
+            'nodes': engine.node_count(),
+            'flashers': engine.flasher_count(),
+            'runs': buffer.flushed_runs if flushed else 0,
+            'cells': buffer.flushed_cells if flushed else 0,
+            'bytes': screen.frame_bytes if flushed else 0,
+            'bytes_estimate': buffer.flushed_bytes if flushed else 0,
+            'deferred': len(buffer.dirty) + len(buffer.low_dirty)}
+        if self.file:
+            import json
+            self.file.write(json.dumps(self.record) + '\n')
+        self.frame += 1
+        for phase in self.times:
+            self.times[phase] = 0.0
 
-    def clear(self):
+    def overlay(self):
         """
-        Erases message with spaces when the countdown runs out
+        Returns a one-line summary of the last frame
         """
-        self.screen.addstr(0, 0, ' ' * 11, curses.color_pair(1))
+        record = self.record
+        if record is None:
+            return ''
+        text = ' %.2fms n:%d f:%d r:%d ' % (
+            1000 * self.average, record['nodes'], record['flashers'],
+            record['runs'])
+        if record['bytes'] is not None:
+            text += 'b:%d ' % record['bytes']
+        else:
+            # curses doesn't say, so this is FrameBuffer's guess
+            text += 'b:~%d ' % record['bytes_estimate']
+        return text
 
 
-class Column:
+class PowerSaver:
     """
-    Creates nodes (points that move down the screen) that are then stored in
-    canvas.nodes. Countdown timer determines time to spawn new node.
+    Tells when nobody can see the rain: the terminal has reported losing
+    focus (see KeyHandler), or the tmux pane unimatrix runs in is not on
+    screen, which tmux is asked every few seconds. Keeps count of the time
+    and CPU time spent watched and unwatched, for report().
     """
 
-    def __init__(self, x_coord, row_count):
-        self.drawing = None  # None means not yet. Later will be True or False
-        self.x_coord = x_coord
-        self.timer = randint(1, row_count)
-        self.async_speed = randint(1, 3)
-        if args.single_wave:
-            # Speeds it up a bit
-            self.timer = int(0.6 * self.timer)
+    # Seconds between questions to tmux
+    poll_every = 2
 
-    def spawn_node(self, canvas):
+    def __init__(self, key):
+        self.key = key
+        self.pane = os.environ.get('TMUX_PANE') if 'TMUX' in os.environ \
+            else None
+        self.visible = True
+        self.next_poll = 0
+        self.idle = False
+        self.since = time.monotonic()
+        self.cpu = time.process_time()
+        # Seconds and CPU seconds, watched (False) and unwatched (True)
+        self.times = [0.0, 0.0]
+        self.cpu_times = [0.0, 0.0]
+
+    def check(self):
         """
-        Creates nodes: points that move down the screen either writing or
-        erasing characters as they go down
+        Returns True while nobody can see the rain
         """
-        if args.single_wave and self.drawing is False:
-            return
+        now = time.monotonic()
+        if self.pane and now >= self.next_poll:
+            self.next_poll = now + self.poll_every
+            self.visible = self.pane_visible()
+        idle = not (self.key.focused and self.visible)
+        if idle != self.idle:
+            self.count(now)
+            self.idle = idle
+        return idle
 
-        self.drawing = not self.drawing
+    def count(self, now):
+        cpu = time.process_time()
+        self.times[self.idle] += now - self.since
+        self.cpu_times[self.idle] += cpu - self.cpu
+        self.since = now
+        self.cpu = cpu
 
-        # Multiplier (mult) is for spawning slow-moving asynchronous nodes
-        # less frequently in order to maintain their length
-        if args.asynchronous:
-            mult = self.async_speed
-        else:
-            mult = 1
+    def pane_visible(self):
+        """
+        Asks tmux whether our pane is on screen: its session is attached,
+        its window is the current one, and no other pane is zoomed
+        """
+        import subprocess
+        try:
+            fields = subprocess.run(
+                ['tmux', 'display-message', '-p', '-t', self.pane,
+                 '#{session_attached} #{window_active} '
+                 '#{window_zoomed_flag} #{pane_active}'],
+                capture_output=True, text=True, timeout=1).stdout.split()
+        except (OSError, subprocess.SubprocessError):
+            # No tmux to ask after all
+            self.pane = None
+            return True
+        if len(fields) != 4:
+            return True
+        attached, active, zoomed, pane_active = fields
+        return (attached != '0' and active == '1'
+                and (zoomed == '0' or pane_active == '1'))
 
-        if self.drawing:
-            # "max_range" prevents crash with very small terminal height
-            max_range = max((3 * mult), ((canvas.row_count - 3) * mult))
-            self.timer = randint(3 * mult, max_range)
-            if args.single_wave:
-                # A bit faster for single wave mode
-                self.timer = int(0.8 * self.timer)
-        else:
-            self.timer = randint(1 * mult, canvas.row_count * mult)
+    def report(self):
+        """
+        Returns a line on the time spent unwatched and the CPU time that
+        saved, estimated from the CPU use while watched. None if the rain
+        was watched all along.
+        """
+        self.count(time.monotonic())
+        watched, unwatched = self.times
+        if not unwatched:
+            return None
+        rate = self.cpu_times[0] / watched if watched else 0
+        return ('unimatrix: unwatched for %.0fs of %.0fs, using %.2fs of CPU '
+                'instead of about %.2fs' % (unwatched, watched + unwatched,
+                                            self.cpu_times[1],
+                                            rate * unwatched))
 
-        x = self.x_coord
-        n_type = 'eraser'
-        async_speed = self.async_speed
-        white = False
-        if self.drawing:
-            n_type = 'writer'
-            if randint(0, 2) == 0:
-                white = True
 
-        canvas.nodes.append(Node(x, n_type, async_speed, white))
+class ByteBudget:
+    """
+    Token bucket for --max-bps. Fills up at `rate` bytes a second, holding
+    at most `burst` seconds' worth, and never less than one cell's worth,
+    or a low rate would never send anything. Each frame passes what is in
+    it to FrameBuffer.runs() as its limit, so every change to the rain,
+    repaints included, waits its turn, and then spends what its runs are
+    estimated to take. Overlays (the status message and --stats) are
+    always sent and spent too, so they can take the bucket below zero:
+    the rain then waits until it has filled up again. To leave the
+    rain most of the budget, --stats is only updated every
+    `stats_period` seconds.
+    """
 
+    burst = 0.25
+    stats_period = 0.5
+    # Starting a run, plus the longest UTF-8 character
+    smallest = FrameBuffer.run_bytes + 4
 
-class Node:
+    def __init__(self, rate):
+        self.rate = rate
+        self.size = max(rate * self.burst, self.smallest)
+        self.tokens = self.size
+        self.last = time.monotonic()
+
+    def available(self):
+        """
+        Returns the bytes the next frame may use
+        """
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate,
+                          self.size)
+        self.last = now
+        return self.tokens
+
+    def spend(self, size):
+        self.tokens -= size
+
+
+class QualityGovernor:
     """
-    A point that runs down the screen drawing or erasing characters.
-    n_type    -> 'writer' or 'eraser'
-    white     -> Bool. If True, a white char is written before the green one.
-    last_char -> Stores last character, since white characters have to be
-                     overwritten with the same one in green one.
-    expired   -> Bool. If True, node is marked for deletion
+    Keeps frames on time when the machine is loaded or the terminal is huge,
+    by lowering the engine's quality (see Engine.set_quality) one level at a
+    time while frames take longer than the target, and raising it again once
+    there is plenty of headroom. The two thresholds and the frame counts
+    keep it from flapping between levels.
+    target  -> Seconds of work allowed per frame, or None for 80% of the
+               time between frames
+    average -> Smoothed seconds of work per frame
     """
 
-    def __init__(self, x_coord, n_type, async_speed, white=False):
-        self.x_coord = x_coord
-        self.y_coord = 0
-        self.n_type = n_type
-        self.white = white
-        self.last_char = None
-        self.expired = False
-        self.async_speed = async_speed
+    # Frames in a row over the target before quality is lowered
+    lower_after = 15
+    # Frames in a row under this share of the target before it is raised
+    restore_share = 0.5
+    raise_after = 120
+
+    def __init__(self, engine, target=None):
+        self.engine = engine
+        self.target = target
+        self.average = 0.0
+        self.over = 0
+        self.under = 0
+
+    def frame(self, seconds, period):
+        """
+        Takes the work time of a frame and the time between frames. Returns
+        True when the quality level changed.
+        """
+        self.average += (seconds - self.average) * 0.2
+        target = self.target or 0.8 * period
+        quality = self.engine.quality
+        if self.average > target and quality > 0:
+            self.over += 1
+            self.under = 0
+            if self.over >= self.lower_after:
+                return self.set(quality - 1)
+        elif (self.average < target * self.restore_share
+              and quality < FULL_QUALITY):
+            self.under += 1
+            self.over = 0
+            if self.under >= self.raise_after:
+                return self.set(quality + 1)
+        else:
+            self.over = self.under = 0
+        return False
+
+    def set(self, quality):
+        self.engine.set_quality(quality)
+        # Give the new level time to show in the average
+        self.over = self.under = 0
+        return True
+
+
+def make_governor(engine):
+    """
+    Returns a QualityGovernor for the engine, with --frame-target as its
+    target, or None when --frame-target is 0
+    """
+    if args.frame_target == 0:
+        return None
+    return QualityGovernor(engine,
+                           args.frame_target and args.frame_target / 1000)
 
 
 class KeyHandler:
@@ -434,10 +4128,11 @@ class KeyHandler:
     def __init__(self, screen, stat):
         self.screen = screen
         self.stat = stat
-        self.screen.nodelay(True)
         self.delay = start_delay
         self.fg = start_color
         self.bg = start_bg
+        # Whether the terminal has focus, as far as it has told us
+        self.focused = True
 
     def cycle_bold(self):
         """
@@ -459,17 +4154,28 @@ class KeyHandler:
 
     def get(self):
         """
-        Handles key presses. Returns True if a key was found, False otherwise.
+        Handles every key pressed since the last frame, all at once, so that
+        a held key never holds up the rain. Returns the number of keys.
         """
         if args.ignore_keyboard:
-            return False;
+            return 0
 
-        kp = self.screen.getch()
+        count = 0
+        while True:
+            kp = self.screen.getch()
+            if kp == -1:
+                return count
+            self.handle(kp)
+            count += 1
 
-        if kp == -1:
-            return False
-        elif kp == ord(" ") or kp == ord("q") or kp == 27:  # 27 = ESC
+    def handle(self, kp):
+        """
+        Handles one key press
+        """
+        if kp == ord(" ") or kp == ord("q") or kp == 27:  # 27 = ESC
             exit()
+        elif kp == FOCUS_IN or kp == FOCUS_OUT:
+            self.focused = kp == FOCUS_IN
         elif kp == ord('a'):
             args.asynchronous = not args.asynchronous
             on_off = 'on' if args.asynchronous else 'off'
@@ -537,14 +4243,12 @@ class KeyHandler:
         elif kp == ord('('):
             self.set_bg_color('default')
 
-        return True
-
     def set_fg_color(self, name):
         """
         Set foreground color
         """
         self.fg = colors_str[name.lower()]
-        curses.init_pair(1, self.fg, self.bg)
+        self.screen.init_pair(1, self.fg, self.bg)
         if name == 'default':
             name = "Def't color"
         self.stat.update(name, self.delay)
@@ -554,8 +4258,8 @@ class KeyHandler:
         Set background color
         """
         self.bg = colors_str[name.lower()]
-        curses.init_pair(1, self.fg, self.bg)
-        curses.init_pair(2, curses.COLOR_WHITE, self.bg)
+        self.screen.init_pair(1, self.fg, self.bg)
+        self.screen.init_pair(2, curses.COLOR_WHITE, self.bg)
         self.stat.update('BG: %s' % name, self.delay)
 
     def show_speed(self):
@@ -575,43 +4279,45 @@ class KeyHandler:
 
 class Writer:
     """
-    Initializes character writing options and contains methods for writing and
-    erasing characters from the screen.
+    Contains methods for writing and erasing characters. Draws onto a target,
+    which is a FrameBuffer when running in a terminal or a Grid when
+    headless.
     """
 
-    def __init__(self, screen):
-        self.screen = screen
-        self.screen.scrollok(0)
-        curses.curs_set(0)
-        curses.use_default_colors()
-        curses.init_pair(1, start_color, start_bg)
-        curses.init_pair(2, curses.COLOR_WHITE, start_bg)
-        curses.init_pair(3, curses.COLOR_BLACK, curses.COLOR_WHITE)
-        self.white = curses.color_pair(2)
+    def __init__(self, target):
+        self.target = target
+
+    def clear(self, rows, cols):
+        """
+        Clears the target and paints the background color over it
+        """
+        self.target.clear()
+        for y in range(rows):
+            self.target.put(y, 0, ' ' * cols, RAIN)
 
     @staticmethod
     def get_char():
         """
         Returns a random character from the active character set
         """
-        return chars[randint(0, chars_len)]
+        return next(rng.glyphs)
 
     @staticmethod
     def get_attr(node, above=False):
         """
-        Returns either A_BOLD attribute or A_NORMAL based on Bold setting
+        Returns BOLD or 0 based on Bold setting
         "above=True" means it an extra green character used to overwrite the
         while head character.
         """
         if args.no_bold:
-            return curses.A_NORMAL
+            return 0
         elif args.all_bold:
-            return curses.A_BOLD
+            return BOLD
         else:
             if node.white and not above:
-                return curses.A_BOLD
+                return BOLD
             else:
-                return choice([curses.A_BOLD, curses.A_NORMAL])
+                return next(rng.bolds)
 
     def draw(self, node):
         """
@@ -621,7 +4327,7 @@ class Writer:
         x = node.x_coord
         character = ' '
         attr = self.get_attr(node)
-        color = curses.color_pair(1)
+        color = RAIN
         if node.n_type == 'writer':
             if not node.white and node.last_char:
                 # Special green character for overwriting last white one
@@ -630,138 +4336,218 @@ class Writer:
             else:
                 character = self.get_char()
             if node.white:
-                color = curses.color_pair(2)
+                color = HEAD
+            elif args.gradient:
+                color = TRAIL
 
-        try:
-            # Draw the character
-            self.screen.addstr(y, x, character, color | attr)
-            if node.white:
-                if node.last_char:
-                    # If it's a white node, also write a green character above
-                    # to overwrite last white character
-                    attr = self.get_attr(node, above=True)
-                    self.screen.addstr(y - 1, x, node.last_char,
-                                       curses.color_pair(1) | attr)
-                node.last_char = character
-        except curses.error:
-            # Override scrolling error if characters pushed off the screen.
-            pass
+        # Draw the character
+        self.target.put(y, x, character, color | attr)
+        if node.white:
+            if node.last_char:
+                # If it's a white node, also write a green character above
+                # to overwrite last white character
+                attr = self.get_attr(node, above=True)
+                color = TRAIL + 2 if args.gradient else RAIN
+                self.target.put_low(y - 1, x, node.last_char, color | attr)
+            node.last_char = character
+        if args.gradient and node.n_type == 'writer':
+            self.fade(y, x)
 
-    def draw_flasher(self, flasher):
+    def fade(self, y, x):
         """
-        Draws characters, included spaces to overwrite/erase characters.
+        Moves the --gradient shades behind a head at (y, x) down with it
         """
-        color = curses.color_pair(1)
-        attr = choice([curses.A_BOLD, curses.A_NORMAL])
-        y = flasher[0]
-        x = flasher[1]
-        try:
-            self.screen.addstr(y, x, self.get_char(), color | attr)
-        except curses.error:
-            pass
+        recolor = self.target.recolor
+        for distance in range(1, TRAIL_SHADES):
+            recolor(y - distance, x, TRAIL + (distance << 1))
+
+    def end_trail(self, x, rows):
+        """
+        Gives the last rows of a --gradient trail the darkest shade at once,
+        when its writer runs off the bottom
+        """
+        for y in range(rows - TRAIL_SHADES + 1, rows):
+            self.target.recolor(y, x, DARKEST)
+
+    def draw_cells(self, ys, xs, glyphs, attrs, glyph_list, low=False):
+        """
+        Draws a batch of cells from the ArrayEngine. glyphs are indexes into
+        glyph_list; all four sequences are NumPy arrays of equal length.
+        low cells can wait when output is short of bandwidth, see put_low.
+        """
+        put = self.target.put_low if low else self.target.put
+        for y, x, glyph, attr in zip(ys.tolist(), xs.tolist(),
+                                     glyphs.tolist(), attrs.tolist()):
+            put(y, x, glyph_list[glyph], attr)
+
+    def fade_cells(self, ys, xs):
+        """
+        Moves the --gradient shades down behind a batch of heads from the
+        ArrayEngine
+        """
+        for y, x in zip(ys.tolist(), xs.tolist()):
+            self.fade(y, x)
+
+    def draw_flasher(self, y, x):
+        """
+        Draws a new random character at a flasher's position
+        """
+        attr = next(rng.bolds)
+        self.target.put_low(y, x, self.get_char(), RAIN | attr)
 
 
 ### Main loop
 
 def _main(screen):
-    writer = Writer(screen)
-    stat = Status(screen)
+    rows, cols = screen.getmaxyx()
+    buffer = FrameBuffer(rows, cols)
+    writer = Writer(buffer)
+    stat = Status(buffer)
+    stats = buffer.overlay(0, 12)
     key = KeyHandler(screen, stat)
-    # Prevent single_wave mode from shutting down too early:
-    if args.single_wave:
-        wave_delay = 10
-    else:
-        wave_delay = 0
+    writer.clear(rows, cols)
+    engine = make_engine(writer, rows, cols)
+    scheduler = FrameScheduler(args.max_fps)
+    resizes = ResizeWatcher(screen)
+    governor = make_governor(engine)
+    profiler = None
+    if args.stats or args.stats_file:
+        profiler = engine.profiler = FrameProfiler(args.stats_file)
+    recorder = None
+    if args.record:
+        recorder = Recorder(args.record, rows, cols)
+    selector = None
+    if not args.ignore_keyboard and screen.input_fd is not None:
+        import selectors
+        selector = selectors.DefaultSelector()
+        selector.register(screen.input_fd, selectors.EVENT_READ)
+    saver = PowerSaver(key)
+    # Focus reports come in as keys, so they need the keyboard
+    report_focus = selector is not None and not args.ignore_focus
+    if report_focus:
+        screen.report_focus(True)
+    output = None
+    if args.pipeline:
+        output = OutputThread(screen)
+    budget = None
+    if args.max_bps:
+        budget = ByteBudget(args.max_bps)
+    next_stats = 0
 
     starttime = time.time()
 
-    # Keep restarting however many times the screen resizes
-    while True:
-        canvas = Canvas(screen)
-        # Set a rhythm for asynchronous movement
-        async_clock = 5
-        # Loop to draw the green rain
-        while not canvas.size_changed:
+    # Loop to draw the green rain
+    try:
+        while True:
+            frame_start = time.perf_counter()
+            if profiler is not None:
+                profiler.start()
+            if output is not None:
+                output.start_work()
             if runtime and time.time() - starttime > runtime:
                 exit()
-            # Catch keypress
-            if key.get():
-                continue
-            # Spawn new nodes
-            for col in canvas.columns:
-                if col.timer == 0:
-                    col.spawn_node(canvas)
-                col.timer -= 1
-
-            for node in canvas.nodes:
-
-                if args.flashers:
-                    if node.n_type == 'writer' and not randint(0, 9):
-                        canvas.flashers.add((node.y_coord, node.x_coord))
-                    elif node.n_type == 'eraser':
-                        try:
-                            canvas.flashers.remove((node.y_coord, node.x_coord))
-                        except KeyError:
-                            pass
-
-                if args.asynchronous:
-                    if async_clock % node.async_speed == 0:
-                        writer.draw(node)
-                        node.y_coord += 1
-                else:
-                    writer.draw(node)
-                    node.y_coord += 1
-
-                # Mark old nodes for deletion
-                if node.y_coord >= canvas.row_count:
-                    if node.white:
-                        # Stop white nodes from staying 'stuck' on last row.
-                        # Creates a special green node with a last_char
-                        # attribute to overwrite last white node.
-                        node.white = False
-                        node.y_coord -= 1
-                    else:
-                        node.expired = True
-
-            if args.flashers and (not async_clock % 3):
-                for f in canvas.flashers:
-                    writer.draw_flasher(f)
-
-            # Rewrite nodes list without expired nodes
-            canvas.nodes = [node for node in canvas.nodes if not node.expired]
+            # Handle all key presses since the last frame
+            if output is None:
+                key.get()
+            else:
+                output.get_keys(key)
+            scheduler.set_idle(args.idle_fps if saver.check() else None)
+            if profiler is not None:
+                profiler.mark('keys')
 
-            if args.single_wave:
-                if len(canvas.nodes) == 0 and wave_delay < 0:
+            steps = scheduler.due(key.delay)
+            for _ in range(steps):
+                if not engine.step():
                     exit()
-                wave_delay -= 1
 
             # End of loop, refresh screen
             if stat.countdown > 0:
                 if stat.countdown == 1:
                     stat.clear()
-                else:
-                    stat.refresh()
                 stat.countdown -= 1
-            screen.refresh()
-
-            # Check for screen resize
-            if screen.getmaxyx() != (canvas.row_count, canvas.col_count):
-                canvas.size_changed = True
+            if args.stats and time.monotonic() >= next_stats:
+                buffer.show(stats, profiler.overlay())
+                if budget is not None:
+                    next_stats = time.monotonic() + budget.stats_period
+            if profiler is not None:
+                profiler.mark('status')
+            flushed = True
+            limit = None
+            if budget is not None:
+                limit = budget.available()
+            if output is None:
+                screen.flush(buffer, limit)
+                screen.refresh()
+            else:
+                # When the terminal is behind, the changes go out with the
+                # next frame that fits in the queue
+                flushed = output.hand_over(buffer, limit)
+                output.end_work()
+            if budget is not None and flushed:
+                budget.spend(buffer.flushed_bytes)
+            if governor is not None and governor.frame(
+                    time.perf_counter() - frame_start,
+                    scheduler.frame_period(key.delay)):
+                stat.update('Quality: %d' % engine.quality, key.delay)
+            if recorder is not None and flushed:
+                recorder.frame(buffer, key.fg, key.bg)
+            if profiler is not None:
+                profiler.mark('output')
+                profiler.end_frame(steps, engine, buffer, screen, flushed)
 
-            # Add delay before next loop
-            curses.napms(key.delay)
+            # Check for screen resize, and fit the rain to the new size if so
+            size = resizes.check()
+            if size:
+                rows, cols = size
+                if output is None:
+                    screen.resize(rows, cols)
+                else:
+                    with output.lock:
+                        screen.resize(rows, cols)
+                buffer.resize(rows, cols)
+                engine.resize(rows, cols)
 
-            # update async clock
-            if async_clock:
-                async_clock -= 1
-            else:
-                async_clock = 5
+            # Wait for the next frame
+            scheduler.wait(key.delay, selector)
+    finally:
+        reports = [saver.report()]
+        if output is not None:
+            output.close()
+            reports.append(output.report())
+        if recorder is not None:
+            recorder.close()
+        if report_focus:
+            screen.report_focus(False)
+        reports = [report for report in reports if report]
+        if reports:
+            import atexit
+            # Once the terminal is back to normal. Last registered runs first.
+            for report in reversed(reports):
+                atexit.register(print, report, file=sys.stderr)
 
 
 def main():
+    configure()
     # Wrapper to allow CTRL-C to exit smoothly:
     try:
-        curses.wrapper(_main)
+        if args.replay:
+            replay(args.replay, args.replay_speed, args.loop)
+        elif args.serve:
+            serve(args.serve)
+        elif args.connect:
+            connect(args.connect)
+        elif args.export:
+            cols, rows = map(int, args.export_size.lower().split('x'))
+            export(args.export, args.export_frames, rows, cols,
+                   args.export_font, args.export_font_size)
+        elif args.ansi:
+            screen = AnsiScreen()
+            try:
+                _main(screen)
+            finally:
+                screen.close()
+        else:
+            curses.wrapper(lambda window: _main(Screen(window)))
     except KeyboardInterrupt:
         pass
 
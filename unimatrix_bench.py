@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+#
+# unimatrix_bench.py
+# <https://github.com/will8211/unimatrix>
+#
+# Benchmarks for unimatrix. Runs the rain simulation headless, against an
+# in-memory grid, so that the cost of a frame can be measured without a
+# terminal getting in the way.
+#
+# Unimatrix is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Unimatrix is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License at
+# <http://www.gnu.org/licenses/> for more details.
+
+import argparse
+import asyncio
+import gc
+import math
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import unimatrix
+
+DEFAULT_SIZES = '80x24,200x60,1000x300'
+
+# Every mode worth timing, as unimatrix command line options
+DEFAULT_MODES = ['', '-a', '-f', '-w', '-b', '-n', '-a -f']
+
+# Ways of starting a single wave, as used from .bashrc
+STARTUP_MODES = ['-w -s 100', '-w -s 100 --fast-start', '-w -s 100 --ansi',
+                 '-w -s 100 --ansi --fast-start']
+
+# Option combinations for the soak test
+SOAK_MODES = ['', '-a', '-f', '-a -f', '-f -b', '-f -w', '-a -f -w',
+              '-f --numpy', '-a -f --numpy', '-a -f -w --numpy']
+
+# Escape sequences and blanks, to tell when the first rain has been drawn
+INVISIBLE = re.compile(rb'\x1b(\[[0-9;?]*[ -/]*[@-~]|[()][0-9A-Za-z]|[=>78])'
+                       rb'|\s')
+
+
+def parse_sizes(sizes):
+    """
+    Turns '80x24,200x60' into [(24, 80), (60, 200)] (rows, cols)
+    """
+    result = []
+    for size in sizes.split(','):
+        cols, rows = size.lower().split('x')
+        result.append((int(rows), int(cols)))
+    return result
+
+
+def make_engine(argv, rows, cols, grid_class=unimatrix.Grid):
+    """
+    Configures unimatrix with the given options and returns a headless
+    engine, together with the grid it draws on.
+    """
+    unimatrix.configure(argv)
+    grid = grid_class(rows, cols)
+    writer = unimatrix.Writer(grid)
+    writer.clear(rows, cols)
+    return unimatrix.make_engine(writer, rows, cols), grid
+
+
+def bench_frames(opts):
+    """
+    Times opts.frames frames of every mode at every size
+    """
+    grid_class = unimatrix.FrameBuffer if opts.flush else unimatrix.Grid
+    print('%-10s %-10s %8s %10s %10s %10s %10s %10s %10s'
+          % ('mode', 'size', 'frames', 'ms/frame', 'max ms', 'fps',
+             'runs/frm', 'cells/frm', 'bytes/frm'))
+    for mode in opts.modes:
+        for rows, cols in parse_sizes(opts.sizes):
+            argv = mode.split() + opts.extra + ['--seed', str(opts.seed)]
+            engine, grid = make_engine(argv, rows, cols, grid_class)
+            runs = cells = size = 0
+            # Fill the screen with rain first, unless told otherwise
+            warmup = rows if opts.warmup is None else opts.warmup
+            frames = -warmup
+            while frames < opts.frames:
+                if frames == 0:
+                    start = time.perf_counter()
+                    runs = cells = size = 0
+                    slowest = 0
+                frames += 1
+                frame_start = time.perf_counter()
+                if not engine.step():
+                    # Single wave is over, start another one
+                    engine, grid = make_engine(argv, rows, cols, grid_class)
+                if opts.flush:
+                    grid.runs()
+                    runs += grid.flushed_runs
+                    cells += grid.flushed_cells
+                    size += grid.flushed_bytes
+                if frames > 0:
+                    slowest = max(slowest, time.perf_counter() - frame_start)
+            elapsed = time.perf_counter() - start
+            print('%-10s %-10s %8d %10.3f %10.3f %10.1f %10.1f %10.1f %10.1f'
+                  % (mode or '(default)', '%dx%d' % (cols, rows), frames,
+                     1000 * elapsed / frames, 1000 * slowest,
+                     frames / elapsed, runs / frames, cells / frames,
+                     size / frames))
+
+
+def bench_memory(opts):
+    """
+    Checks that steady-state frames don't allocate: counts nodes built by
+    the pool, Python memory blocks and traced memory after warming up
+    """
+    print('%-10s %-10s %8s %9s %9s %11s %11s'
+          % ('mode', 'size', 'frames', 'created', 'reused', 'blocks/frm',
+             'peak KiB'))
+    for mode in opts.modes:
+        for rows, cols in parse_sizes(opts.sizes):
+            engine, grid = make_engine(
+                mode.split() + ['--seed', str(opts.seed)], rows, cols)
+            # Let the rain fill the screen and the pool fill up
+            for _ in range(opts.warmup or 4 * rows):
+                engine.step()
+            created = engine.pool.created
+            reused = engine.pool.reused
+            tracemalloc.start()
+            blocks = sys.getallocatedblocks()
+            for _ in range(opts.frames):
+                engine.step()
+            blocks = sys.getallocatedblocks() - blocks
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('%-10s %-10s %8d %9d %9d %11.2f %11.1f'
+                  % (mode or '(default)', '%dx%d' % (cols, rows), opts.frames,
+                     engine.pool.created - created,
+                     engine.pool.reused - reused, blocks / opts.frames,
+                     peak / 1024))
+
+
+def bench_resize(opts):
+    """
+    Times reflowing a running simulation and its frame buffer between
+    sizes, as happens at the end of a drag-resize
+    """
+    print('%-10s %-20s %8s %12s %12s %12s %8s'
+          % ('mode', 'sizes', 'resizes', 'engine ms', 'max ms', 'buffer ms',
+             'kept %'))
+    sizes = parse_sizes(opts.sizes)
+    for mode in opts.modes:
+        argv = mode.split() + opts.extra + ['--seed', str(opts.seed)]
+        rows, cols = sizes[0]
+        engine, grid = make_engine(argv, rows, cols, unimatrix.FrameBuffer)
+        engine_time = buffer_time = slowest = 0
+        kept = before = 0
+        for resize in range(opts.resizes):
+            for _ in range(opts.frames):
+                engine.step()
+                grid.runs()
+            rows, cols = sizes[(resize + 1) % len(sizes)]
+            start = time.perf_counter()
+            grid.resize(rows, cols)
+            grid.runs()
+            buffer_time += time.perf_counter() - start
+            before += engine.node_count()
+            engine.resize(rows, cols)
+            engine_time += engine.reflow_time
+            slowest = max(slowest, engine.reflow_time)
+            kept += engine.node_count()
+        print('%-10s %-20s %8d %12.3f %12.3f %12.3f %8.1f'
+              % (mode or '(default)', opts.sizes, opts.resizes,
+                 1000 * engine_time / opts.resizes, 1000 * slowest,
+                 1000 * buffer_time / opts.resizes,
+                 100 * kept / max(before, 1)))
+
+
+def bench_replay(opts):
+    """
+    Decodes a recording made with --record, as --replay would, and reports
+    what playing it back costs
+    """
+    rows, cols = parse_sizes(opts.size)[0]
+    start = time.perf_counter()
+    frames = unimatrix.load_recording(opts.file, rows, cols)
+    elapsed = time.perf_counter() - start
+    length = sum(seconds for seconds, data in frames)
+    sent = sum(len(data) for seconds, data in frames)
+    print('%-10s %8s %10s %10s %12s %10s'
+          % ('size', 'frames', 'seconds', 'load ms', 'bytes/frame', 'KiB/s'))
+    print('%-10s %8d %10.2f %10.3f %12.1f %10.1f'
+          % (opts.size, len(frames), length, 1000 * elapsed,
+             sent / max(len(frames), 1), sent / 1024 / max(length, 0.001)))
+
+
+def run_in_pty(argv, rows, cols, timeout):
+    """
+    Runs a command in a new pseudo-terminal of rows x cols and reads its
+    output until it exits. Returns (seconds until something other than
+    escape codes and blanks was drawn, seconds until exit)
+    """
+    import fcntl
+    import pty
+    import select
+    import struct
+    import subprocess
+    import termios
+
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ,
+                struct.pack('HHHH', rows, cols, 0, 0))
+    start = time.perf_counter()
+    process = subprocess.Popen(argv, stdin=slave, stdout=slave,
+                               stderr=slave)
+    os.close(slave)
+    output = b''
+    first = None
+    while time.perf_counter() - start < timeout:
+        if not select.select([master], [], [], 0.05)[0]:
+            if process.poll() is not None:
+                break
+            continue
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            # Linux reports EIO once the child has closed the terminal
+            break
+        if not data:
+            break
+        if first is None:
+            output += data
+            if INVISIBLE.sub(b'', output):
+                first = time.perf_counter() - start
+    else:
+        process.kill()
+    process.wait()
+    elapsed = time.perf_counter() - start
+    os.close(master)
+    return first or elapsed, elapsed
+
+
+def bench_startup(opts):
+    """
+    Times how long unimatrix takes to draw its first rain, and to run a
+    whole single wave, when started from a shell
+    """
+    import tempfile
+
+    rows, cols = parse_sizes(opts.size)[0]
+    python = [sys.executable, '-c', 'pass']
+    baseline = sorted(run_in_pty(python, rows, cols, 10)[1]
+                      for _ in range(opts.runs))[opts.runs // 2]
+    print('python itself starts in %.1f ms' % (1000 * baseline))
+    print('%-32s %6s %14s %14s %10s'
+          % ('mode', 'runs', 'first ms', 'min first ms', 'wall s'))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Keep --fast-start from touching the real cache
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        for mode in opts.modes:
+            argv = [sys.executable, unimatrix.__file__] + mode.split()
+            # Untimed run, which also fills the --fast-start cache
+            run_in_pty(argv, rows, cols, opts.timeout)
+            firsts = []
+            walls = []
+            for _ in range(opts.runs):
+                first, wall = run_in_pty(argv, rows, cols, opts.timeout)
+                firsts.append(first)
+                walls.append(wall)
+            firsts.sort()
+            walls.sort()
+            print('%-32s %6d %14.1f %14.1f %10.2f'
+                  % (mode, opts.runs, 1000 * firsts[opts.runs // 2],
+                     1000 * firsts[0], walls[opts.runs // 2]))
+
+
+async def load_client(path, rows, cols, seconds, slow, stats):
+    """
+    One simulated --connect client. Counts the frames it receives, and how
+    many of them were whole frames. A slow client reads only 4 KiB a tenth
+    of a second, like a terminal on a bad link.
+    """
+    # A small limit keeps a slow client from buffering ahead of itself
+    reader, writer = await asyncio.open_unix_connection(
+        path, limit=4096 if slow else 1 << 16)
+    writer.write(b'%d %d\n' % (rows, cols))
+    frames = whole = received = 0
+    data = bytearray()
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        try:
+            chunk = await asyncio.wait_for(
+                reader.read(4096 if slow else 1 << 16),
+                end - time.perf_counter())
+        except asyncio.TimeoutError:
+            break
+        if not chunk:
+            break
+        received += len(chunk)
+        data += chunk
+        pos = 0
+        while pos + 4 <= len(data):
+            frame_end = pos + 4 + int.from_bytes(data[pos:pos + 4], 'big')
+            if frame_end > len(data):
+                break
+            frames += 1
+            # Whole frames start with a resize: ms (always 0 from the
+            # server), then op 3
+            whole += data[pos + 5] == unimatrix.Recorder.SIZE
+            pos = frame_end
+        del data[:pos]
+        if slow:
+            await asyncio.sleep(0.1)
+    writer.close()
+    stats.append((slow, frames, whole, received))
+
+
+def bench_serve(opts):
+    """
+    Load test for --serve: runs a server and many simulated clients on a
+    Unix socket, some of them slow, and checks that the fast clients still
+    get every frame
+    """
+    import signal
+    import subprocess
+    import tempfile
+
+    sizes = parse_sizes(opts.sizes)
+    print('%8s %6s %8s %10s %10s %10s %10s %10s %8s'
+          % ('clients', 'slow', 'seconds', 'fast fps', 'min fps',
+             'slow fps', 'catch-ups', 'MiB/s', 'server %'))
+    for count in opts.clients:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'unimatrix.sock')
+            server = subprocess.Popen(
+                [sys.executable, unimatrix.__file__, '--serve', path,
+                 '--seed', str(opts.seed)] + opts.args.split())
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            stats = []
+
+            async def run_clients():
+                await asyncio.gather(*(
+                    load_client(path, *sizes[i % len(sizes)], opts.seconds,
+                                i < count * opts.slow, stats)
+                    for i in range(count)))
+
+            asyncio.run(run_clients())
+            server.send_signal(signal.SIGINT)
+            usage = os.wait4(server.pid, 0)[2]
+            server.returncode = 0
+
+        fast = sorted(frames for slow, frames, whole, received in stats
+                      if not slow)
+        slow = [frames for is_slow, frames, whole, received in stats
+                if is_slow]
+        # Every client gets one whole frame to start with
+        catch_ups = sum(stat[2] - 1 for stat in stats)
+        received = sum(stat[3] for stat in stats)
+        print('%8d %6d %8.1f %10.1f %10.1f %10.1f %10d %10.2f %8.1f'
+              % (count, len(slow), opts.seconds,
+                 sum(fast) / max(len(fast), 1) / opts.seconds,
+                 fast[0] / opts.seconds if fast else 0,
+                 sum(slow) / max(len(slow), 1) / opts.seconds, catch_ups,
+                 received / opts.seconds / (1 << 20),
+                 100 * (usage.ru_utime + usage.ru_stime) / opts.seconds))
+
+
+def bench_scale(opts):
+    """
+    Times --workers at each worker count on one big canvas: wall time per
+    frame, and the share of it the main process spends copying cells
+    """
+    rows, cols = parse_sizes(opts.size)[0]
+    print('%d CPUs' % os.cpu_count())
+    print('%8s %10s %10s %12s %10s %10s'
+          % ('workers', 'size', 'frames', 'ms/frame', 'main ms', 'speedup'))
+    base = None
+    for workers in opts.workers:
+        argv = ['--workers', str(workers), '--seed', str(opts.seed)]
+        engine, grid = make_engine(argv, rows, cols, unimatrix.FrameBuffer)
+        for _ in range(opts.warmup or rows):
+            engine.step()
+            grid.runs()
+        start = time.perf_counter()
+        cpu = time.process_time()
+        for _ in range(opts.frames):
+            engine.step()
+            grid.runs()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        if hasattr(engine, 'close'):
+            engine.close()
+        base = base or elapsed
+        print('%8d %10s %10d %12.3f %10.3f %10.2f'
+              % (workers, opts.size, opts.frames,
+                 1000 * elapsed / opts.frames, 1000 * cpu / opts.frames,
+                 base / elapsed))
+
+
+def bench_export(opts):
+    """
+    Times --export to every format, and the size of what it writes
+    """
+    import tempfile
+
+    rows, cols = parse_sizes(opts.size)[0]
+    print('%-8s %10s %8s %10s %10s %12s'
+          % ('format', 'size', 'frames', 'ms/frame', 'fps', 'KiB/frame'))
+    for fmt in opts.formats.split(','):
+        unimatrix.configure(opts.args.split() + ['--seed', str(opts.seed)])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rain.' + fmt)
+            start = time.perf_counter()
+            frames = unimatrix.export(path, opts.frames, rows, cols)
+            elapsed = time.perf_counter() - start
+            written = sum(os.path.getsize(os.path.join(tmp, name))
+                          for name in os.listdir(tmp))
+        print('%-8s %10s %8d %10.3f %10.1f %12.1f'
+              % (fmt, opts.size, frames, 1000 * elapsed / frames,
+                 frames / elapsed, written / frames / 1024))
+
+
+def bench_spawn(opts):
+    """
+    Times the spawn phase of a frame at growing widths. Only the columns
+    due are visited, so the cost per spawn stays flat however wide the
+    screen is; sweep is what checking every column each frame would cost.
+    """
+    print('%-12s %8s %10s %12s %12s %12s'
+          % ('size', 'frames', 'spawns/frm', 'spawn us/frm', 'us/spawn',
+             'sweep us/frm'))
+    for rows, cols in parse_sizes(opts.sizes):
+        engine, grid = make_engine(['--seed', str(opts.seed)], rows, cols)
+        profiler = engine.profiler = unimatrix.FrameProfiler()
+        for _ in range(opts.warmup or rows):
+            engine.step()
+        canvas = engine.canvas
+        nodes = engine.pool.created + engine.pool.reused
+        spent = 0.0
+        for _ in range(opts.frames):
+            profiler.start()
+            engine.step()
+            spent += profiler.times['spawn']
+            profiler.times['spawn'] = 0.0
+        spawns = engine.pool.created + engine.pool.reused - nodes
+        # The loop over every column that the timing wheel replaced. The
+        # engine is done with, so its timers can be counted down for nothing.
+        columns = canvas.columns
+        start = time.perf_counter()
+        for _ in range(opts.frames):
+            for col in columns:
+                if col.timer == 0:
+                    pass
+                col.timer -= 1
+        sweep = time.perf_counter() - start
+        print('%-12s %8d %10.1f %12.2f %12.3f %12.2f'
+              % ('%dx%d' % (cols, rows), opts.frames, spawns / opts.frames,
+                 1e6 * spent / opts.frames, 1e6 * spent / max(spawns, 1),
+                 1e6 * sweep / opts.frames))
+
+
+def resident_kib():
+    """
+    Resident set size of this process in KiB, or its peak where the current
+    size can't be read
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def soak_changes(engine, grid, sizes, change):
+    """
+    Does what a user might do over a long run, a different thing each time:
+    flashers and async mode on and off, the quality governor stepping up
+    and down, and the terminal being resized
+    """
+    if change % 2:
+        unimatrix.args.flashers = not unimatrix.args.flashers
+    if change % 3 == 0:
+        unimatrix.args.asynchronous = not unimatrix.args.asynchronous
+    engine.set_quality(unimatrix.FULL_QUALITY - change % 4)
+    rows, cols = sizes[change % len(sizes)]
+    if (rows, cols) != grid.getmaxyx():
+        grid.resize(rows, cols)
+        engine.resize(rows, cols)
+
+
+def soak_problems(engine, sizes):
+    """
+    Checks the node and flasher counts against what the screen can hold.
+    Returns a list of what is wrong.
+    """
+    problems = []
+    rows = max(size[0] for size in sizes)
+    cols = max(size[1] for size in sizes)
+    # Nodes in a column are at least one step apart and take at most three
+    # steps a row (async speed)
+    max_nodes = 3 * (rows + 2) * cols
+    max_flashers = int(rows * cols * unimatrix.args.flash_density)
+    nodes = engine.node_count()
+    flashers = engine.flasher_count()
+    if nodes > max_nodes:
+        problems.append('%d nodes > %d' % (nodes, max_nodes))
+    if flashers > max_flashers:
+        problems.append('%d flashers > %d' % (flashers, max_flashers))
+    index = getattr(engine, 'canvas', None)
+    if index is not None:
+        index = index.flashers
+        marked = sum(column.count(1) for column in index.columns if column)
+        if marked != index.count:
+            problems.append('flasher count %d, but %d marked'
+                            % (index.count, marked))
+    return problems
+
+
+def bench_soak(opts):
+    """
+    Runs a long headless session per mode, changing options and sizes along
+    the way, and checks that nothing grows: node and flasher counts, traced
+    Python memory, RSS and CPU time per frame
+    """
+    sizes = parse_sizes(opts.sizes)
+    print('%-16s %10s %8s %8s %10s %10s %9s %9s  %s'
+          % ('mode', 'frames', 'nodes', 'flashers', 'heap KiB', 'RSS KiB',
+             'first ms', 'last ms', 'result'))
+    failed = False
+    for mode in opts.modes:
+        argv = mode.split() + ['--seed', str(opts.seed)]
+        rows, cols = sizes[0]
+        engine, grid = make_engine(argv, rows, cols, unimatrix.FrameBuffer)
+        problems = []
+        most_nodes = most_flashers = 0
+        # Go through every combination of changes once before measuring
+        warmup = opts.warmup
+        if warmup is None:
+            warmup = 12 * len(sizes) // math.gcd(12, len(sizes)) * opts.every
+        tracemalloc.start()
+        heap = tracemalloc.get_traced_memory()[0]
+        rss = resident_kib()
+        times = []
+        cpu = time.process_time()
+        change = 0
+        for frame in range(-warmup, opts.frames):
+            if frame == 0:
+                gc.collect()
+                heap = tracemalloc.get_traced_memory()[0]
+                rss = resident_kib()
+                cpu = time.process_time()
+            if not engine.step():
+                # A single wave leaves nothing behind when it is over
+                if engine.node_count() or engine.flasher_count():
+                    problems.append('wave over with %d nodes, %d flashers'
+                                    % (engine.node_count(),
+                                       engine.flasher_count()))
+                engine, grid = make_engine(argv, *grid.getmaxyx(),
+                                           unimatrix.FrameBuffer)
+                # The old engine's random streams refer to themselves, so
+                # only the cycle collector frees them
+                gc.collect()
+            grid.runs()
+            most_nodes = max(most_nodes, engine.node_count())
+            most_flashers = max(most_flashers, engine.flasher_count())
+            if opts.every and (frame + 1) % opts.every == 0:
+                change += 1
+                soak_changes(engine, grid, sizes, change)
+            if frame >= 0 and (frame + 1) % opts.check == 0:
+                problems += soak_problems(engine, sizes)
+                now = time.process_time()
+                times.append((now - cpu) / opts.check)
+                cpu = now
+            if len(problems) > 5:
+                break
+        gc.collect()
+        heap = (tracemalloc.get_traced_memory()[0] - heap) / 1024
+        rss = resident_kib() - rss
+        tracemalloc.stop()
+        if hasattr(engine, 'close'):
+            engine.close()
+        if heap > opts.max_heap:
+            problems.append('heap grew %.1f KiB' % heap)
+        if rss > opts.max_rss:
+            problems.append('RSS grew %d KiB' % rss)
+        if len(times) > 1 and times[-1] > opts.max_slowdown * times[0]:
+            problems.append('frames %.1fx slower' % (times[-1] / times[0]))
+        failed = failed or bool(problems)
+        times = times or [0]
+        print('%-16s %10d %8d %8d %10.1f %10d %9.3f %9.3f  %s'
+              % (mode or '(default)', opts.frames, most_nodes, most_flashers,
+                 heap, rss, 1000 * times[0], 1000 * times[-1],
+                 '; '.join(problems[:5]) or 'ok'))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='unimatrix benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    frames = commands.add_parser('frames',
+                                 help='simulation cost per frame')
+    frames.add_argument('-n', '--frames', type=int, default=500,
+                        help='frames to run per mode and size')
+    frames.add_argument('-s', '--sizes', default=DEFAULT_SIZES,
+                        help='comma separated COLSxROWS list, default '
+                             + DEFAULT_SIZES)
+    frames.add_argument('-m', '--mode', dest='modes', action='append',
+                        help='unimatrix options to time, e.g. -m="-a -f" '
+                             '(repeatable, default: all modes)')
+    frames.add_argument('-w', '--warmup', type=int,
+                        help='untimed frames to run first, default: one '
+                             'per row')
+    frames.add_argument('--seed', type=int, default=0,
+                        help='random seed, default 0')
+    frames.add_argument('--numpy', dest='extra', action='append_const',
+                        const='--numpy', default=[],
+                        help='time the NumPy engine')
+    frames.add_argument('--flush', action='store_true',
+                        help='draw into a FrameBuffer and time flushing '
+                             'its changes too')
+    frames.set_defaults(func=bench_frames)
+
+    memory = commands.add_parser('memory',
+                                 help='node allocations in steady state')
+    memory.add_argument('-n', '--frames', type=int, default=500,
+                        help='frames to measure per mode and size')
+    memory.add_argument('-s', '--sizes', default='80x24,200x60',
+                        help='comma separated COLSxROWS list, default '
+                             '80x24,200x60')
+    memory.add_argument('-m', '--mode', dest='modes', action='append',
+                        help='unimatrix options to measure (repeatable)')
+    memory.add_argument('-w', '--warmup', type=int,
+                        help='frames to run first, default: four per row')
+    memory.add_argument('--seed', type=int, default=0,
+                        help='random seed, default 0')
+    memory.set_defaults(func=bench_memory)
+
+    resize = commands.add_parser('resize',
+                                 help='time to reflow after a resize')
+    resize.add_argument('-r', '--resizes', type=int, default=50,
+                        help='number of resizes, default 50')
+    resize.add_argument('-n', '--frames', type=int, default=20,
+                        help='frames to run between resizes, default 20')
+    resize.add_argument('-s', '--sizes', default='200x60,180x50,220x70',
+                        help='comma separated COLSxROWS list to cycle '
+                             'through, default 200x60,180x50,220x70')
+    resize.add_argument('-m', '--mode', dest='modes', action='append',
+                        help='unimatrix options to measure (repeatable)')
+    resize.add_argument('--numpy', dest='extra', action='append_const',
+                        const='--numpy', default=[],
+                        help='time the NumPy engine')
+    resize.add_argument('--seed', type=int, default=0,
+                        help='random seed, default 0')
+    resize.set_defaults(func=bench_resize)
+
+    replay = commands.add_parser('replay',
+                                 help='cost of playing back a recording')
+    replay.add_argument('file', help='recording made with unimatrix --record')
+    replay.add_argument('-s', '--size', default='80x24',
+                        help='COLSxROWS of the terminal to play back on, '
+                             'default 80x24')
+    replay.set_defaults(func=bench_replay)
+
+    startup = commands.add_parser('startup',
+                                  help='time to first frame from a shell')
+    startup.add_argument('-r', '--runs', type=int, default=5,
+                         help='runs per mode, default 5')
+    startup.add_argument('-s', '--size', default='80x24',
+                         help='COLSxROWS of the terminal, default 80x24')
+    startup.add_argument('-m', '--mode', dest='modes', action='append',
+                         help='unimatrix options to time (repeatable), '
+                              'default: -w -s 100 with and without '
+                              '--ansi and --fast-start')
+    startup.add_argument('--timeout', type=float, default=30,
+                         help='seconds to wait for one run, default 30')
+    startup.set_defaults(func=bench_startup)
+
+    serve = commands.add_parser('serve',
+                                help='load test for --serve')
+    serve.add_argument('-c', '--clients', default='10,100,300',
+                       type=lambda text: [int(n) for n in text.split(',')],
+                       help='comma separated numbers of clients to try, '
+                            'default 10,100,300')
+    serve.add_argument('-s', '--sizes', default='80x24,200x60,120x40',
+                       help='comma separated COLSxROWS list the clients '
+                            'cycle through, default 80x24,200x60,120x40')
+    serve.add_argument('--slow', type=float, default=0.1,
+                       help='fraction of clients that read slowly, default '
+                            '0.1')
+    serve.add_argument('-t', '--seconds', type=float, default=5,
+                       help='seconds to run for, default 5')
+    serve.add_argument('-a', '--args', default='-s 100',
+                       help='options for the server, default "-s 100"')
+    serve.add_argument('--seed', type=int, default=0,
+                       help='random seed, default 0')
+    serve.set_defaults(func=bench_serve)
+
+    scale = commands.add_parser('scale',
+                                help='throughput by --workers count')
+    scale.add_argument('-j', '--workers', default='1,2,4,8',
+                       type=lambda text: [int(n) for n in text.split(',')],
+                       help='comma separated worker counts, default 1,2,4,8')
+    scale.add_argument('-s', '--size', default='4000x1000',
+                       help='COLSxROWS of the canvas, default 4000x1000')
+    scale.add_argument('-n', '--frames', type=int, default=100,
+                       help='frames to time per worker count, default 100')
+    scale.add_argument('-w', '--warmup', type=int,
+                       help='untimed frames to run first, default: one '
+                            'per row')
+    scale.add_argument('--seed', type=int, default=0,
+                       help='random seed, default 0')
+    scale.set_defaults(func=bench_scale)
+
+    export = commands.add_parser('export',
+                                 help='frames per second of --export')
+    export.add_argument('-n', '--frames', type=int, default=300,
+                        help='frames to export per format, default 300')
+    export.add_argument('-s', '--size', default='80x24',
+                        help='COLSxROWS to export, default 80x24')
+    export.add_argument('-f', '--formats', default='gif,png,ppm',
+                        help='comma separated formats, default gif,png,ppm')
+    export.add_argument('-a', '--args', default='-f',
+                        help='unimatrix options to export with, default -f')
+    export.add_argument('--seed', type=int, default=0,
+                        help='random seed, default 0')
+    export.set_defaults(func=bench_export)
+
+    spawn = commands.add_parser('spawn',
+                                help='spawn cost per frame by width')
+    spawn.add_argument('-n', '--frames', type=int, default=500,
+                       help='frames to time per size, default 500')
+    spawn.add_argument('-s', '--sizes',
+                       default='200x50,2000x50,20000x50,100000x50',
+                       help='comma separated COLSxROWS list, default '
+                            '200x50,2000x50,20000x50,100000x50')
+    spawn.add_argument('-w', '--warmup', type=int,
+                       help='untimed frames to run first, default: one '
+                            'per row')
+    spawn.add_argument('--seed', type=int, default=0,
+                       help='random seed, default 0')
+    spawn.set_defaults(func=bench_spawn)
+
+    soak = commands.add_parser('soak',
+                               help='long run checking that nothing leaks')
+    soak.add_argument('-n', '--frames', type=int, default=100000,
+                      help='frames to run per mode, default 100000')
+    soak.add_argument('-s', '--sizes', default='80x24,120x40',
+                      help='comma separated COLSxROWS list to resize '
+                           'between, default 80x24,120x40')
+    soak.add_argument('-m', '--mode', dest='modes', action='append',
+                      help='unimatrix options to soak (repeatable), default: '
+                           + ', '.join(repr(mode) for mode in SOAK_MODES))
+    soak.add_argument('-e', '--every', type=int, default=1000,
+                      help='frames between changes of options or size, '
+                           'default 1000, 0=never')
+    soak.add_argument('-c', '--check', type=int, default=10000,
+                      help='frames between checks of the counts, default '
+                           '10000')
+    soak.add_argument('-w', '--warmup', type=int,
+                      help='frames to run before measuring, default: one '
+                           'round of changes')
+    soak.add_argument('--max-heap', type=float, default=256,
+                      help='KiB the traced heap may grow by, default 256')
+    soak.add_argument('--max-rss', type=int, default=4096,
+                      help='KiB RSS may grow by, default 4096')
+    soak.add_argument('--max-slowdown', type=float, default=2,
+                      help='how much slower the last frames may be than the '
+                           'first, default 2')
+    soak.add_argument('--seed', type=int, default=0,
+                      help='random seed, default 0')
+    soak.set_defaults(func=bench_soak)
+
+    opts = parser.parse_args(argv)
+    if getattr(opts, 'modes', True) is None:
+        opts.modes = {'startup': STARTUP_MODES,
+                      'soak': SOAK_MODES}.get(opts.command, DEFAULT_MODES)
+    return opts.func(opts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())